@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+'''
+    Benchmark harness. Generates a synthetic pcap (benchmarks/synthetic_traffic.py), runs it through the same
+    steps as an offline run and times every stage: dissection, device store updates, detections, the packet
+    index, store flushes and the reporter. The results go to benchmarks/results/<scenario>_<time>.json together
+    with the git revision, so runs of different versions can be compared with --compare.
+
+    Frames the native dissector hands to the fallback (the encrypted ones) are counted but not dissected,
+    tshark would be all we measure then.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+import misc.zigsniff_processing
+import misc.zigsniff_detections
+from misc.zigsniff_pcap import read_pcap
+from misc.zigsniff_logging import configure_logging
+from misc.zigsniff_sqlite import create_db, zigsniff_reporter
+from misc.zigsniff_store import open_device_store, close_device_store
+from misc.zigsniff_sticky import open_sticky_note_cache
+from misc.zigsniff_sink import open_detection_sink
+from misc.zigsniff_index import open_packet_index, PcapLocator
+from misc.zigsniff_processing import process_dissector
+from zigbee_native_dissector import zigbee_native_dissector, NATIVE_FALLBACK
+from synthetic_traffic import generate_pcap, DEFAULT_CLUSTER_MIX
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# settings for generate_pcap
+SCENARIOS = {
+    "small": {"frames": 20000, "devices": 50, "mesh_depth": 2, "encrypted_ratio": 0.1, "detection_rate": 0.05},
+    "mesh": {"frames": 50000, "devices": 500, "mesh_depth": 5, "encrypted_ratio": 0.1, "detection_rate": 0.05},
+    "busy": {"frames": 50000, "devices": 100, "mesh_depth": 2, "encrypted_ratio": 0.0, "detection_rate": 0.5},
+    "encrypted": {"frames": 20000, "devices": 100, "mesh_depth": 3, "encrypted_ratio": 0.8, "detection_rate": 0.05},
+}
+
+STORE_FUNCTIONS = ["nwk_add_dev_to_devices", "match_nwk_addresses", "wpan_add_dev_to_devices", "match_wpan_addresses", "parse_the_rest"]
+
+
+class StageTimer:
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+
+    def add(self, stage: str, seconds: float):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def wrap(self, stage: str, function):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        return timed
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPOSITORY, capture_output=True, text=True, check=True).stdout.strip()
+        return revision + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_once(pcap_path: str, report_every: int, index: bool):
+    '''
+    One run over the pcap in a fresh work directory. Returns the numbers for the result file.
+    '''
+    path = tempfile.mkdtemp(prefix="zigsniff_benchmark_")
+    timer = StageTimer()
+    counts = {"frames": 0, "fallback": 0, "errors": 0, "empty": 0, "detections": 0}
+
+    # time the stages where process_dissector calls them, without touching process_dissector itself
+    originals = {name: getattr(misc.zigsniff_processing, name) for name in STORE_FUNCTIONS + ["zigbee_detections"]}
+    original_write = misc.zigsniff_detections.write_zigsniff_message
+    for name in STORE_FUNCTIONS:
+        setattr(misc.zigsniff_processing, name, timer.wrap("store", originals[name]))
+    misc.zigsniff_processing.zigbee_detections = timer.wrap("detections", originals["zigbee_detections"])
+
+    def count_detection(message, message_path):
+        counts["detections"] += 1
+        original_write(message, message_path)
+    misc.zigsniff_detections.write_zigsniff_message = count_detection
+
+    try:
+        configure_logging(path, level="WARNING")
+        create_db(path)
+        store = open_device_store(path)
+        store.flush = timer.wrap("flush", store.flush)
+        open_sticky_note_cache(path)
+        sink = open_detection_sink(path)
+        packet_index = None
+        if index:
+            packet_index = open_packet_index(path)
+            packet_index.register(pcap_path, PcapLocator(pcap_path).locate)
+            packet_index.add = timer.wrap("index", packet_index.add)
+            packet_index.flush = timer.wrap("index", packet_index.flush)
+
+        started = time.perf_counter()
+        for record in read_pcap(pcap_path):
+            counts["frames"] += 1
+            dissect_started = time.perf_counter()
+            dissector = zigbee_native_dissector(record)
+            timer.add("dissect", time.perf_counter() - dissect_started)
+            if dissector is NATIVE_FALLBACK:
+                counts["fallback"] += 1
+                continue
+            if dissector is None:
+                counts["empty"] += 1
+            elif isinstance(dissector, str):
+                counts["errors"] += 1
+            process_dissector(dissector, 11, pcap_path, path)
+            if report_every and counts["frames"] % report_every == 0:
+                report_started = time.perf_counter()
+                zigsniff_reporter(path, 0, "devices")
+                timer.add("report", time.perf_counter() - report_started)
+
+        # what is still in memory is part of the run
+        close_device_store(path)
+        sink.close()
+        if packet_index is not None:
+            packet_index.close()
+        total = time.perf_counter() - started
+    finally:
+        for name, function in originals.items():
+            setattr(misc.zigsniff_processing, name, function)
+        misc.zigsniff_detections.write_zigsniff_message = original_write
+        shutil.rmtree(path, ignore_errors=True)
+
+    processed = counts["frames"] - counts["fallback"]
+    timer.seconds["total"] = total
+    return {
+        "counts": counts,
+        "seconds": {stage: round(seconds, 6) for stage, seconds in timer.seconds.items()},
+        "calls": timer.calls,
+        "packets_per_second": round(processed / total, 1) if total else None,
+    }
+
+
+def compare(scenario: str):
+    '''
+    Prints every stored run of the scenario, oldest first, with the time per 1000 frames per stage.
+    '''
+    if not os.path.isdir(RESULTS):
+        print("No results yet")
+        return
+    runs = []
+    for name in sorted(os.listdir(RESULTS)):
+        if name.startswith(f"{scenario}_") and name.endswith(".json"):
+            with open(os.path.join(RESULTS, name)) as file:
+                runs.append(json.load(file))
+    if not runs:
+        print(f"No results for {scenario}")
+        return
+    stages = ["dissect", "store", "detections", "index", "flush", "report", "total"]
+    print(f"{'time':<20}{'revision':<16}{'pkts/s':>10}" + "".join(f"{stage:>12}" for stage in stages) + "   (ms per 1000 frames)")
+    for run in sorted(runs, key=lambda run: run["time"]):
+        processed = max(run["counts"]["frames"] - run["counts"]["fallback"], 1)
+        columns = "".join(f"{run['seconds'].get(stage, 0) * 1000000 / processed:>12.2f}" for stage in stages)
+        print(f"{run['time']:<20}{run['revision']:<16}{run['packets_per_second']:>10.1f}{columns}")
+
+
+def main():
+    argParser = argparse.ArgumentParser(prog="Zigsniff benchmarks", description="Time zigsniff over synthetic Zigbee traffic.")
+    argParser.add_argument("-s", "--scenario", type=str, default="small", help=f"One of {', '.join(SCENARIOS)} (Default is small)")
+    argParser.add_argument("--frames", type=int, help="Override the number of frames")
+    argParser.add_argument("--devices", type=int, help="Override the number of devices")
+    argParser.add_argument("--mesh-depth", type=int, help="Override the depth of the mesh")
+    argParser.add_argument("--encrypted-ratio", type=float, help="Override the share of encrypted messages (0-1)")
+    argParser.add_argument("--detection-rate", type=float, help="Override the chance a report changes state (0-1)")
+    argParser.add_argument("--cluster-mix", type=str, help=f"Json of cluster: weight (Default is {json.dumps(DEFAULT_CLUSTER_MIX)})")
+    argParser.add_argument("--seed", type=int, default=1, help="Seed of the generator (Default is 1)")
+    argParser.add_argument("-r", "--repeat", type=int, default=3, help="Runs, the fastest one is kept (Default is 3)")
+    argParser.add_argument("--report-every", type=int, default=5000, help="Run the reporter every this many frames, 0 is never (Default is 5000)")
+    argParser.add_argument("--no-index", help="Do not write the packet index", action='store_true')
+    argParser.add_argument("--no-save", help="Do not store the result", action='store_true')
+    argParser.add_argument("-c", "--compare", help="Show the stored results of the scenario and exit", action='store_true')
+    args = argParser.parse_args()
+
+    if args.scenario not in SCENARIOS:
+        print(f"Unknown scenario {args.scenario}")
+        exit()
+    if args.compare:
+        compare(args.scenario)
+        return
+
+    settings = dict(SCENARIOS[args.scenario], seed=args.seed)
+    for name in ("frames", "devices", "mesh_depth", "encrypted_ratio", "detection_rate"):
+        if getattr(args, name) is not None:
+            settings[name] = getattr(args, name)
+    settings["cluster_mix"] = json.loads(args.cluster_mix) if args.cluster_mix else DEFAULT_CLUSTER_MIX
+
+    pcap_directory = tempfile.mkdtemp(prefix="zigsniff_benchmark_pcap_")
+    pcap_path = os.path.join(pcap_directory, f"{args.scenario}.pcap")
+    try:
+        started = time.perf_counter()
+        generate_pcap(pcap_path, **settings)
+        print(f"Generated {settings['frames']} frames in {time.perf_counter() - started:.1f}s")
+        runs = []
+        for number in range(args.repeat):
+            runs.append(run_once(pcap_path, args.report_every, not args.no_index))
+            print(f"Run {number + 1}: {runs[-1]['packets_per_second']} packets/s")
+    finally:
+        shutil.rmtree(pcap_directory, ignore_errors=True)
+
+    result = min(runs, key=lambda run: run["seconds"]["total"])
+    result.update({
+        "scenario": args.scenario,
+        "settings": settings,
+        "report_every": args.report_every,
+        "index": not args.no_index,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%d_%H-%M-%S"),
+    })
+    counts = result["counts"]
+    print(f"{counts['frames']} frames, {counts['fallback']} to the fallback, {counts['detections']} detections")
+    for stage, seconds in sorted(result["seconds"].items(), key=lambda item: -item[1]):
+        print(f"\t{stage}: {seconds:.3f}s")
+    if not args.no_save:
+        os.makedirs(RESULTS, exist_ok=True)
+        result_path = os.path.join(RESULTS, f"{args.scenario}_{result['time']}.json")
+        with open(result_path, 'w') as file:
+            json.dump(result, file, indent=4)
+        print(f"Stored in {result_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+'''
+    Deterministic synthetic Zigbee traffic for the benchmarks. The same settings and seed give the same pcap, byte for byte.
+
+    A coordinator (0x0000) with devices hanging below it up to mesh_depth hops. Every device reports one
+    cluster picked from cluster_mix to the coordinator, a report of a device that is mesh_depth deep shows up
+    as mesh_depth frames (one per hop, same NWK source, different MAC source).
+    encrypted_ratio of the messages have NWK security (random payload, so they go through the fallback).
+    detection_rate is the chance that a report on an on/off, occupancy or IAS zone cluster changes state,
+    the other reports repeat the last state and do not make a detection.
+'''
+import struct
+import random
+
+from misc.zigsniff_pcap import write_pcap_header, write_pcap_record
+
+DEFAULT_CLUSTER_MIX = {"0x0006": 3, "0x0406": 1, "0x0500": 1, "0x0402": 3, "0x0001": 1, "0x0008": 1}
+DETECTION_CLUSTERS = (0x0006, 0x0406, 0x0500)
+PAN_ID = 0x1a62
+
+
+class SyntheticDevice:
+    def __init__(self, short_address: int, mac: bytes, depth: int, parent, cluster: int):
+        self.short_address = short_address
+        self.mac = mac
+        self.depth = depth
+        self.parent = parent
+        self.cluster = cluster
+        self.state = 0
+        self.nwk_seqno = 0
+        self.aps_counter = 0
+        self.zcl_tsn = 0
+
+    def route(self):
+        '''
+        Short addresses from this device up to the coordinator.
+        '''
+        hops = [self.short_address]
+        device = self.parent
+        while device is not None:
+            hops.append(device.short_address)
+            device = device.parent
+        return hops + [0x0000]
+
+
+def build_network(rng: random.Random, devices: int, mesh_depth: int, cluster_mix: dict):
+    clusters = [int(cluster, 16) for cluster in cluster_mix]
+    weights = list(cluster_mix.values())
+    network = []
+    by_depth = {}
+    for number in range(devices):
+        depth = 1 + number % max(mesh_depth, 1)
+        # the parent is one of the devices a level up, they act as routers
+        parent = rng.choice(by_depth[depth - 1]) if depth > 1 and by_depth.get(depth - 1) else None
+        if parent is None:
+            depth = 1
+        device = SyntheticDevice(0x0001 + number, bytes(rng.getrandbits(8) for _ in range(8)), depth, parent, rng.choices(clusters, weights)[0])
+        by_depth.setdefault(depth, []).append(device)
+        network.append(device)
+    return network
+
+
+def zcl_report(device: SyntheticDevice, rng: random.Random, detection_rate: float):
+    '''
+    ZCL payload for the next report of the device.
+    '''
+    device.zcl_tsn = (device.zcl_tsn + 1) % 256
+    if device.cluster in DETECTION_CLUSTERS and rng.random() < detection_rate:
+        device.state ^= 1
+    if device.cluster == 0x0500:
+        # zone status change notification, alarm_1 follows the state
+        return struct.pack("<BBBHBBH", 0x19, device.zcl_tsn, 0x00, device.state, 0, 1, 0)
+    if device.cluster == 0x0006:
+        attribute, data_type, value = 0x0000, struct.pack("<B", 0x10), struct.pack("<B", device.state)
+    elif device.cluster == 0x0406:
+        attribute, data_type, value = 0x0000, struct.pack("<B", 0x18), struct.pack("<B", device.state)
+    elif device.cluster == 0x0402:
+        attribute, data_type, value = 0x0000, struct.pack("<B", 0x29), struct.pack("<h", rng.randint(1500, 2500))
+    elif device.cluster == 0x0001:
+        attribute, data_type, value = 0x0021, struct.pack("<B", 0x20), struct.pack("<B", rng.randint(0, 200))
+    else:
+        attribute, data_type, value = 0x0000, struct.pack("<B", 0x20), struct.pack("<B", rng.randint(0, 254))
+    return struct.pack("<BBBH", 0x18, device.zcl_tsn, 0x0a, attribute) + data_type + value
+
+
+def frames_for_message(device: SyntheticDevice, rng: random.Random, mac_seqno: int, encrypted: bool, detection_rate: float):
+    '''
+    The frames (without FCS) one report makes on its way to the coordinator.
+    '''
+    device.nwk_seqno = (device.nwk_seqno + 1) % 256
+    device.aps_counter = (device.aps_counter + 1) % 256
+    aps = struct.pack("<BBHHBB", 0x00, 1, device.cluster, 0x0104, 1, device.aps_counter) + zcl_report(device, rng, detection_rate)
+    ext_src = rng.random() < 0.7
+    nwk_fcf = 0x0008 | (0x1000 if ext_src else 0) | (0x0200 if encrypted else 0)
+    route = device.route()
+    frames = []
+    for hop in range(len(route) - 1):
+        radius = 30 - hop
+        nwk = struct.pack("<HHHBB", nwk_fcf, 0x0000, device.short_address, radius, device.nwk_seqno)
+        if ext_src:
+            nwk += device.mac
+        if encrypted:
+            # auxiliary header (nwk key, extended nonce), frame counter, source, key sequence, ciphertext and mic
+            nwk += struct.pack("<BI", 0x28, device.nwk_seqno) + device.mac + b"\x00" + bytes(rng.getrandbits(8) for _ in range(len(aps) + 4))
+        else:
+            nwk += aps
+        mac = struct.pack("<HBHHH", 0x8861, (mac_seqno + hop) % 256, PAN_ID, route[hop + 1], route[hop])
+        frames.append(mac + nwk)
+    return frames
+
+
+def generate_pcap(pcap_path: str, frames: int = 20000, devices: int = 100, mesh_depth: int = 3, cluster_mix: dict = None,
+                  encrypted_ratio: float = 0.1, detection_rate: float = 0.05, frames_per_second: float = 50, seed: int = 1,
+                  start_time: int = 1700000000):
+    '''
+    Writes the pcap (linktype 195, with an FCS of zeros like whsniff) and returns how many frames are in it.
+    '''
+    rng = random.Random(seed)
+    network = build_network(rng, devices, mesh_depth, cluster_mix or DEFAULT_CLUSTER_MIX)
+    written = 0
+    with open(pcap_path, 'wb') as pcap:
+        write_pcap_header(pcap)
+        while written < frames:
+            device = rng.choice(network)
+            encrypted = rng.random() < encrypted_ratio
+            for frame in frames_for_message(device, rng, written, encrypted, detection_rate):
+                if written == frames:
+                    break
+                write_pcap_record(pcap, start_time + written / frames_per_second, frame + b"\x00\x00")
+                written += 1
+    return written
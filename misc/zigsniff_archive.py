@@ -0,0 +1,283 @@
+'''
+    Archive pcap as a ring of segments. Everything that used to append to capture_<time>.pcap writes the pcap
+    stream into a PcapArchive instead. It follows the stream record by record and starts a new segment
+    capture_<time>_<n>.pcap (with its own global header) when the current one would get bigger than max_bytes
+    or spans more than max_seconds of capture time. Only max_files segments are kept, the oldest go first.
+    Closed segments can be gzipped in the background.
+
+    capture_<time>_manifest.json lists every segment with its time range and packet count, so reprocessing
+    can pick just the segments it needs.
+
+    The archive also remembers where the last track_positions frames went, locate(number) tells the
+    packet index (misc.zigsniff_index) in which segment and at which byte offset a frame is.
+'''
+import os
+import gzip
+import json
+import shutil
+import struct
+import time
+import threading
+from collections import deque
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_pcap import PCAP_MAGIC_US, PCAP_MAGIC_NS
+
+_settings = {}
+
+
+class PcapArchive:
+    def __init__(self, pcap_path: str, path: str, max_bytes: int = 104857600, max_seconds: int = 3600, max_files: int = 0, compress: bool = False,
+                 track_positions: int = 20000):
+        '''
+        max_bytes or max_seconds 0 turns that limit off, max_files 0 keeps every segment.
+        track_positions is how many of the last frames can be located, so how far (in frames) the parser may
+        run behind.
+        '''
+        self.path = path
+        self.base = pcap_path[:-len(".pcap")] if pcap_path.endswith(".pcap") else pcap_path
+        self.manifest_path = f"{self.base}_manifest.json"
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.max_files = max_files
+        self.compress = compress
+        self.lock = threading.Lock()  # segments is also changed by the compress threads
+        self.segments = []  # manifest entries, the last one is the open segment
+        self.compressing = []
+        self.segment = None
+        self.segment_number = 0
+        # where we are in the pcap stream
+        self.header = bytearray()
+        self.endian = "<"
+        self.divisor = 1000000.0
+        self.pending = bytearray()  # a record that is not complete yet
+        self.frames = 0
+        self.number = 0  # frame number of the last record, 1 is the first one like wireshark counts
+        self.positions = deque(maxlen=track_positions) if track_positions else None  # (number, segment, offset)
+        self.positions_lock = threading.Lock()  # locate runs in the thread that stores, write in the capture thread
+
+    def locate(self, number: int):
+        '''
+        (segment file name, byte offset) of frame number or None when it is not known (anymore).
+        Frames may be asked for in any order, only track_positions pushes old ones out.
+        '''
+        if self.positions is None:
+            return None
+        with self.positions_lock:
+            if not self.positions:
+                return None
+            # numbers follow each other without gaps, so the place in the deque is known
+            index = number - self.positions[0][0]
+            if index < 0 or index >= len(self.positions):
+                return None
+            position = self.positions[index]
+        return position[1], position[2]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def write(self, data):
+        '''
+        Takes any piece of the pcap stream, records do not have to be complete.
+        Returns the number of records that were completed by it.
+        '''
+        view = memoryview(data).cast('B')
+        size = len(view)
+        position = 0
+        frames = 0
+        if len(self.header) < 24:
+            position = min(24 - len(self.header), size)
+            self.header += view[:position]
+            if len(self.header) < 24:
+                return 0
+            self._read_header()
+
+        if self.pending:
+            # finish the record that was split over the last write
+            if len(self.pending) < 16:
+                take = min(16 - len(self.pending), size - position)
+                self.pending += view[position:position + take]
+                position += take
+            if len(self.pending) >= 16:
+                take = min(self._record_size(self.pending, 0) - len(self.pending), size - position)
+                self.pending += view[position:position + take]
+                position += take
+                record_size = self._record_size(self.pending, 0)
+                if len(self.pending) == record_size:
+                    # the same limits as for the records that come in one piece
+                    if self._must_rotate(self.pending, 0, record_size):
+                        self._rotate()
+                    self._add_record(self.pending, 0)
+                    self.segment.write(self.pending)
+                    self.pending.clear()
+                    frames += 1
+            if self.pending:
+                self.frames += frames
+                return frames
+
+        # write runs of complete records in one go
+        start = position
+        while position + 16 <= size:
+            record_size = self._record_size(view, position)
+            if position + record_size > size:
+                break
+            if self._must_rotate(view, position, record_size):
+                if position > start:
+                    self.segment.write(view[start:position])
+                    start = position
+                self._rotate()
+            self._add_record(view, position)
+            position += record_size
+            frames += 1
+        if position > start:
+            self.segment.write(view[start:position])
+        self.pending += view[position:]
+        self.frames += frames
+        return frames
+
+    def _read_header(self):
+        for endian in ("<", ">"):
+            magic = struct.unpack(endian + "I", self.header[:4])[0]
+            if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+                self.endian = endian
+                self.divisor = 1000000.0 if magic == PCAP_MAGIC_US else 1000000000.0
+                return
+        report(f"Archive {self.base}: the capture does not start with a pcap header", self.path)
+
+    def _record_size(self, buffer, position: int):
+        return 16 + struct.unpack_from(self.endian + "I", buffer, position + 8)[0]
+
+    def _timestamp(self, buffer, position: int):
+        ts_sec, ts_frac = struct.unpack_from(self.endian + "II", buffer, position)
+        return ts_sec + ts_frac / self.divisor
+
+    def _must_rotate(self, buffer, position: int, record_size: int):
+        if self.segment is None:
+            return True
+        entry = self.segments[-1]
+        if not entry["packets"]:
+            return False
+        if self.max_bytes and entry["bytes"] + record_size > self.max_bytes:
+            return True
+        return bool(self.max_seconds) and self._timestamp(buffer, position) - entry["first_time"] >= self.max_seconds
+
+    def _add_record(self, buffer, position: int):
+        if self.segment is None:
+            self._rotate()
+        timestamp = self._timestamp(buffer, position)
+        entry = self.segments[-1]
+        if entry["first_time"] is None:
+            entry["first_time"] = timestamp
+        entry["last_time"] = timestamp
+        self.number += 1
+        if self.positions is not None:
+            with self.positions_lock:
+                self.positions.append((self.number, entry["file"], entry["bytes"]))
+        entry["packets"] += 1
+        entry["bytes"] += self._record_size(buffer, position)
+
+    def _rotate(self):
+        '''
+        Closes the open segment (if any), opens the next one and drops the oldest ones beyond max_files.
+        '''
+        self._close_segment()
+        self.segment_number += 1
+        segment_path = f"{self.base}_{self.segment_number:05d}.pcap"
+        self.segment = open(segment_path, 'wb')
+        self.segment.write(self.header)
+        with self.lock:
+            self.segments.append({"file": os.path.basename(segment_path), "first_time": None, "last_time": None, "packets": 0, "bytes": 24, "closed": False})
+            while self.max_files and len(self.segments) > self.max_files:
+                oldest = self.segments.pop(0)
+                self._remove(oldest["file"])
+        self._write_manifest()
+
+    def _close_segment(self):
+        if self.segment is None:
+            return
+        self.segment.close()
+        self.segment = None
+        entry = self.segments[-1]
+        entry["closed"] = True
+        if self.compress and entry["packets"]:
+            thread = threading.Thread(target=self._compress, args=(entry,), name="zigsniff_archive_gzip", daemon=True)
+            thread.start()
+            self.compressing = [running for running in self.compressing if running.is_alive()] + [thread]
+
+    def _compress(self, entry: dict):
+        segment_path = os.path.join(os.path.dirname(self.base), entry["file"])
+        try:
+            with open(segment_path, 'rb') as source, gzip.open(segment_path + ".gz", 'wb') as target:
+                shutil.copyfileobj(source, target)
+        except FileNotFoundError:
+            return  # already pushed out of the ring
+        except Exception as e:
+            report(f"Archive: compressing {segment_path} failed: {e}", self.path)
+            return
+        with self.lock:
+            if any(segment is entry for segment in self.segments):
+                entry["file"] += ".gz"
+                os.remove(segment_path)
+            else:
+                os.remove(segment_path + ".gz")
+        self._write_manifest()
+
+    def _remove(self, name: str):
+        directory = os.path.dirname(self.base)
+        for candidate in (name, name + ".gz", name[:-len(".gz")] if name.endswith(".gz") else None):
+            if candidate is not None and os.path.exists(os.path.join(directory, candidate)):
+                os.remove(os.path.join(directory, candidate))
+
+    def _write_manifest(self):
+        with self.lock:
+            manifest = {"segments": [dict(entry) for entry in self.segments]}
+            temporary = self.manifest_path + ".tmp"
+            try:
+                with open(temporary, 'w') as file:
+                    json.dump(manifest, file, indent=4)
+                os.replace(temporary, self.manifest_path)
+            except OSError as e:
+                report(f"Archive: writing {self.manifest_path} failed: {e}", self.path)
+
+    def flush(self):
+        if self.segment is not None:
+            self.segment.flush()
+
+    def expire(self, now: float = None):
+        '''
+        Closes the open segment when it is older than max_seconds, also when no frames came in to trigger that.
+        The next write opens a new one. Call it from the thread that writes.
+        '''
+        if self.segment is None or not self.max_seconds:
+            return
+        entry = self.segments[-1]
+        now = now if now is not None else time.time()
+        if entry["packets"] and now - entry["first_time"] >= self.max_seconds:
+            self._close_segment()
+            self._write_manifest()
+
+    def close(self):
+        '''
+        Closes the open segment and waits for the compression of the closed ones. A half record at the end is dropped.
+        '''
+        self._close_segment()
+        for thread in self.compressing:
+            thread.join()
+        self.compressing = []
+        if self.segments:
+            self._write_manifest()
+
+
+def configure_archive(path: str, **settings):
+    '''
+    Applies the archive section of zigsniff_config.json (max_bytes, max_seconds, max_files, compress) to
+    every archive opened for the work directory afterwards.
+    '''
+    _settings[path] = settings
+
+
+def open_pcap_archive(pcap_path: str, path: str):
+    return PcapArchive(pcap_path, path, **_settings.get(path, {}))
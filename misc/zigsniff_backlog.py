@@ -0,0 +1,256 @@
+'''
+    Backlog of encrypted frames tshark could not decrypt (no key for them yet), kept in zigsniff_backlog.db in the
+    work directory by PAN and key sequence number. When zigbee_detections finds a transport key, key_added
+    re-dissects only the frames of that PAN (and key sequence number when we know it) in a background thread with
+    the keys file that now has the new key. What decrypts leaves the backlog and waits in a queue until the
+    thread that owns ingest takes it with drain (misc.zigsniff_processing.process_decrypted), from there it goes
+    through process_dissector into the device store and the detections like any other frame. The retry thread
+    never touches the store, the sticky notes or the packet index itself.
+
+    A fallback that is already running (live, or the fallback pass of an offline pcap) keeps the keys it started
+    with, so frames of that PAN that come in after the key keep landing here. Once a key was added for a PAN
+    every flush retries the new rows of that PAN, one retry per PAN at a time.
+
+    Frames are offered where the fallback results meet their pcap records: native_file_capture, the live
+    pipeline and the asyncio engine. Rows are written behind like the packet index, max_frames keeps the newest.
+'''
+import os
+import queue
+import atexit
+import sqlite3
+import threading
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_database import PRAGMAS
+from misc.zigsniff_pcap import write_pcap_header, write_pcap_record
+from misc.zigsniff_fields import FieldsCapture
+from misc.zigsniff_keys import decrypted
+from zigbee_native_dissector import nwk_security
+
+_backlogs = {}
+_backlogs_lock = threading.Lock()
+
+_STOP = object()
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS frames (
+            id integer PRIMARY KEY,
+            pan text NOT NULL,
+            key_sequence integer,
+            number integer,
+            timestamp real,
+            length integer,
+            linktype integer,
+            channel integer,
+            pcap text,
+            data blob NOT NULL
+        );''',
+    '''CREATE INDEX IF NOT EXISTS idx_frames_pan ON frames (pan, key_sequence);''',
+]
+
+class EncryptedBacklog:
+    def __init__(self, path: str, keyfile: str = "zigbee_pc_keys", channel: int = 11, max_frames: int = 100000, flush_interval_ms: int = 1000):
+        '''
+        channel is used for frames that were offered without one (offline pcaps).
+        '''
+        self.path = path
+        self.keyfile = keyfile
+        self.channel = channel
+        self.max_frames = max_frames
+        self.flush_interval = flush_interval_ms / 1000
+        self.sqlite = os.path.join(path, "zigsniff_backlog.db")
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.sqlite, check_same_thread=False, isolation_level=None)
+        for pragma in PRAGMAS:
+            self.connection.execute(pragma)
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.rows = []
+        self.retries = queue.Queue()
+        self.decrypted = queue.SimpleQueue()  # (dissector, channel, pcap) for drain
+        self.added = {}  # PAN (None is every PAN) -> key sequence number (None is any) of a key added this run
+        self.queued = set()  # PANs with a follow-up retry in the queue
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._flusher, name="zigsniff_backlog", daemon=True)
+        self.thread.start()
+        self.retry_thread = threading.Thread(target=self._retrier, name="zigsniff_backlog_retry", daemon=True)
+        self.retry_thread.start()
+        atexit.register(self.close)
+
+    def offer(self, record, dissector, pcap, channel: int = None):
+        '''
+        record is the PcapRecord the fallback dissected into dissector. Kept when it has NWK security that
+        tshark did not get through.
+        '''
+        if not isinstance(dissector, dict) or decrypted(dissector):
+            return
+        security = nwk_security(record)
+        if security is None:
+            return
+        pan, key_sequence = security
+        row = (pan, key_sequence, record.number, record.timestamp, record.length, record.linktype,
+               channel if channel is not None else self.channel, str(pcap), bytes(record.data))
+        with self.lock:
+            self.rows.append(row)
+
+    def flush(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+            if not rows:
+                return
+            try:
+                self.connection.execute("BEGIN;")
+                last_id = self.connection.execute("SELECT coalesce(max(id), 0) FROM frames;").fetchone()[0]
+                self.connection.executemany("INSERT INTO frames (pan, key_sequence, number, timestamp, length, linktype, channel, pcap, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);", rows)
+                if self.max_frames:
+                    self.connection.execute("DELETE FROM frames WHERE id <= (SELECT max(id) FROM frames) - ?;", (self.max_frames,))
+                self.connection.execute("COMMIT;")
+            except sqlite3.Error as e:
+                if self.connection.in_transaction:
+                    self.connection.execute("ROLLBACK;")
+                self.rows = rows + self.rows
+                report(f"Backlog: writing {len(rows)} frames failed: {e}", self.path)
+                return
+            # the fallback does not have the keys that were added after it started
+            for pan in sorted(set(row[0] for row in rows)):
+                if pan in self.added:
+                    key_sequence = self.added[pan]
+                elif None in self.added:
+                    key_sequence = self.added[None]
+                else:
+                    continue
+                if pan not in self.queued:
+                    self.queued.add(pan)
+                    self.retries.put((pan, key_sequence, last_id))
+
+    def _flusher(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def key_added(self, pan: str = None, key_sequence: int = None):
+        '''
+        A new key is in the keys file. Retries the frames of pan (every PAN when None) with key_sequence
+        (every key sequence number when None) in the background, and from now on the new frames of pan too.
+        '''
+        with self.lock:
+            self.added[pan] = key_sequence
+        self.retries.put((pan, key_sequence))
+
+    def _retrier(self):
+        while True:
+            retry = self.retries.get()
+            try:
+                if retry is _STOP:
+                    break
+                if len(retry) > 2:
+                    # rows flushed from now on get a retry of their own
+                    with self.lock:
+                        self.queued.discard(retry[0])
+                self.retry(*retry)
+            except Exception as e:
+                report(f"Backlog: retrying frames failed: {e}", self.path)
+            finally:
+                self.retries.task_done()
+
+    def wait(self):
+        '''
+        Blocks until every retry that was asked for is done, then drain has all their frames.
+        Flushes first, frames offered since the last flush may belong to a PAN whose key was found already.
+        '''
+        if not self.stopped.is_set():
+            self.flush()
+            self.retries.join()
+
+    def drain(self, process):
+        '''
+        Calls process(dissector, channel, pcap) for every frame the retries decrypted so far. Only call it from
+        the thread that stores frames (the one that calls process_dissector). Returns how many there were.
+        '''
+        count = 0
+        while not self.decrypted.empty():
+            process(*self.decrypted.get())
+            count += 1
+        return count
+
+    def retry(self, pan: str = None, key_sequence: int = None, after_id: int = None):
+        '''
+        Re-dissects the frames of pan / key_sequence with the keys file (only the keys the key registry allows for
+        pan) and queues what decrypts now for drain. after_id only takes the rows flushed after that one.
+        Returns the number of frames that were decrypted.
+        '''
+        self.flush()
+        query = "SELECT id, number, timestamp, length, linktype, channel, pcap, data FROM frames"
+        where = []
+        parameters = []
+        if pan is not None:
+            where.append("pan=?")
+            parameters.append(pan)
+        if key_sequence is not None:
+            where.append("key_sequence=?")
+            parameters.append(key_sequence)
+        if after_id is not None:
+            where.append("id>?")
+            parameters.append(after_id)
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY linktype, id;", parameters).fetchall()
+        if not rows:
+            return 0
+
+        done = []
+        # one pcap per linktype, that is what a pcap can hold. in practice it is always whsniff's 195
+        for linktype in sorted(set(row[4] for row in rows)):
+            linktype_rows = [row for row in rows if row[4] == linktype]
+            retry_path = os.path.join(self.path, "zigsniff_backlog_retry.pcap")
+            with open(retry_path, 'wb') as file:
+                write_pcap_header(file, linktype)
+                for row in linktype_rows:
+                    write_pcap_record(file, row[2], row[7], row[3])
+            try:
+                for row, dissector in zip(linktype_rows, FieldsCapture(pcap_path=retry_path, keyfile=self.keyfile, path=self.path, pans=[pan] if pan is not None else None)):
+                    if not isinstance(dissector, dict) or not decrypted(dissector):
+                        continue
+                    # the numbers are those of the original capture, so the detections point to the right frame
+                    dissector["pkt_number"] = row[1]
+                    self.decrypted.put((dissector, row[5], row[6]))
+                    done.append((row[0],))
+            finally:
+                os.remove(retry_path)
+
+        with self.lock:
+            self.connection.executemany("DELETE FROM frames WHERE id=?;", done)
+        if after_id is not None and not done:
+            return 0  # every flush would say so
+        report(f"Backlog: {len(done)} of {len(rows)} frames of PAN {pan if pan is not None else 'any'} decrypted with the new key", self.path)
+        return len(done)
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.thread.join()
+        # before the stop, the retrier still has to take the retries this flush queues
+        self.flush()
+        # a retry that is still running finishes, it may be the only chance for those frames this run
+        self.retries.put(_STOP)
+        self.retry_thread.join()
+        with self.lock:
+            self.connection.close()
+
+
+def open_encrypted_backlog(path: str, keyfile: str = "zigbee_pc_keys", channel: int = 11, **settings):
+    '''
+    Opens the backlog of the work directory, settings are max_frames and flush_interval_ms.
+    '''
+    with _backlogs_lock:
+        if path not in _backlogs:
+            _backlogs[path] = EncryptedBacklog(path, keyfile, channel, **settings)
+        return _backlogs[path]
+
+
+def get_encrypted_backlog(path: str):
+    '''
+    The backlog of the work directory or None when it is off.
+    '''
+    return _backlogs.get(path)
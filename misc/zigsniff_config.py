@@ -7,7 +7,30 @@ class config:
     def __init__(self):
         self.channel = None
         self.report_period = None
+        self.report_mode = None
         self.fifo_file_path = None
+        self.flush_interval = None
+        self.flush_packets = None
+        self.sticky_note_cache = None
+        self.detections = None
+        self.logging = None
+        self.gps = None
+        self.sources = None
+        self.source_queue_size = None
+        self.hopping = None
+        self.capture = None
+        self.archive = None
+        self.index_enabled = None
+        self.index = None
+        self.metrics_enabled = None
+        self.metrics = None
+        self.profile = None
+        self.pipeline_enabled = None
+        self.pipeline = None
+        self.backlog_enabled = None
+        self.backlog = None
+        self.duplicates_enabled = None
+        self.duplicates = None
         self.reload_config()
 
     #@staticmethod
@@ -20,6 +43,49 @@ class config:
         self.fifo_file_path = data['paths']['fifo_path']
         self.channel = data['channel']
         self.report_period = data['report_period']
+        self.report_mode = data.get('report_mode', "devices")
+        # older config files do not have the store settings
+        store = data.get('store', {})
+        self.flush_interval = store.get('flush_interval_ms', 1000)
+        self.flush_packets = store.get('flush_packets', 500)
+        self.sticky_note_cache = store.get('sticky_note_cache', 4096)
+        # settings for misc.zigsniff_sink.DetectionSink
+        self.detections = data.get('detections', {})
+        # settings for misc.zigsniff_logging.configure_logging
+        self.logging = data.get('logging', {})
+        # settings for misc.zigsniff_gps.GpsPoller
+        self.gps = data.get('gps', {})
+        # more than one capture source, see misc.zigsniff_sources.sources_from_config
+        self.sources = data.get('sources', [])
+        self.source_queue_size = data.get('source_queue_size', 1000)
+        # settings for misc.zigsniff_hopping.ChannelHopper
+        self.hopping = data.get('hopping', {})
+        # settings for misc.zigsniff_whsniff.WhsniffReader
+        self.capture = data.get('capture', {})
+        # settings for misc.zigsniff_archive.PcapArchive
+        self.archive = data.get('archive', {})
+        # settings for misc.zigsniff_index.PacketIndex
+        index = data.get('index', {})
+        self.index_enabled = index.get('enabled', True)
+        self.index = {key: value for key, value in index.items() if key != 'enabled'}
+        # settings for misc.zigsniff_metrics.Metrics.serve
+        metrics = data.get('metrics', {})
+        self.metrics_enabled = metrics.get('enabled', True)
+        self.metrics = {key: value for key, value in metrics.items() if key != 'enabled'}
+        # settings for misc.zigsniff_profile.Profiler (used with --profile)
+        self.profile = data.get('profile', {})
+        # settings for misc.zigsniff_pipeline.LivePipeline
+        pipeline = data.get('pipeline', {})
+        self.pipeline_enabled = pipeline.get('enabled', True)
+        self.pipeline = {key: value for key, value in pipeline.items() if key != 'enabled'}
+        # settings for misc.zigsniff_backlog.EncryptedBacklog
+        backlog = data.get('backlog', {})
+        self.backlog_enabled = backlog.get('enabled', True)
+        self.backlog = {key: value for key, value in backlog.items() if key != 'enabled'}
+        # settings for misc.zigsniff_duplicates.DuplicateFilter
+        duplicates = data.get('duplicates', {})
+        self.duplicates_enabled = duplicates.get('enabled', True)
+        self.duplicates = {key: value for key, value in duplicates.items() if key != 'enabled'}
 
     def change_variable(self, variable, change):
         pass
\ No newline at end of file
@@ -0,0 +1,235 @@
+'''
+    One long-lived connection to zigsniff_database.db per process and the schema migrations.
+    The connection is shared between threads (store flusher, reporter) so hold database.lock
+    or use the helpers that do it for you.
+'''
+import os
+import ast
+import atexit
+import sqlite3
+import threading
+
+from misc.zigsniff_utilities import report
+
+CACHED_STATEMENTS = 256
+
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL;",  # readers (reporter) do not block the store flusher
+    "PRAGMA synchronous=NORMAL;",  # with WAL only a checkpoint syncs, a crash can lose the last flush but not corrupt the file
+    "PRAGMA cache_size=-16000;",  # 16 MB
+    "PRAGMA temp_store=MEMORY;",
+]
+
+# Lists that used to be stringified in a devices column: column -> (table, value column, layer)
+CHILD_LISTS = {
+    "talks_with_mac_list": ("device_edges", "peer_mac_address", None),
+    "dst_net_addresses": ("device_dst_addresses", "address", "nwk"),
+    "wpan_dst_net_addresses": ("device_dst_addresses", "address", "wpan"),
+}
+# Dicts that used to be stringified in a devices column: column -> table with (device_id, name, value)
+CHILD_DICTS = {
+    "capabilities": "device_capabilities",
+    "cluster_info": "device_clusters",
+}
+CHILD_COLUMNS = list(CHILD_LISTS) + list(CHILD_DICTS)
+
+
+def child_select_query(column: str, since: bool = False):
+    '''
+    Rows of (device_id, value) or (device_id, name, value) in the order they were added.
+    With since the query takes a last_time_seen parameter like the reporter uses.
+    '''
+    where = []
+    if column in CHILD_LISTS:
+        table, value_column, layer = CHILD_LISTS[column]
+        select = f"SELECT device_id, {value_column} FROM {table}"
+        if layer is not None:
+            where.append(f"layer='{layer}'")
+    else:
+        table = CHILD_DICTS[column]
+        select = f"SELECT device_id, name, value FROM {table}"
+    if since:
+        where.append("device_id IN (SELECT id FROM devices WHERE last_time_seen>?)")
+    if where:
+        select += " WHERE " + " AND ".join(where)
+    return select + " ORDER BY rowid;"
+
+
+def child_upsert_query(column: str):
+    if column in CHILD_LISTS:
+        table, value_column, layer = CHILD_LISTS[column]
+        if layer is None:
+            return f"INSERT INTO {table} (device_id, {value_column}) VALUES (?, ?) ON CONFLICT DO NOTHING;"
+        return f"INSERT INTO {table} (device_id, layer, {value_column}) VALUES (?, '{layer}', ?) ON CONFLICT DO NOTHING;"
+    table = CHILD_DICTS[column]
+    return f"INSERT INTO {table} (device_id, name, value) VALUES (?, ?, ?) ON CONFLICT (device_id, name) DO UPDATE SET value=excluded.value;"
+
+
+def _move_string_columns(connection):
+    '''
+    Migration 2: parses the old stringified lists and dicts into the child tables and clears the columns.
+    '''
+    names = ", ".join(CHILD_COLUMNS)
+    for row in connection.execute(f"SELECT id, {names} FROM devices;").fetchall():
+        device_id = row[0]
+        for column, value in zip(CHILD_COLUMNS, row[1:]):
+            if value is None:
+                continue
+            try:
+                value = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                continue
+            if column in CHILD_LISTS:
+                connection.executemany(child_upsert_query(column), [(device_id, entry) for entry in value])
+            else:
+                connection.executemany(child_upsert_query(column), [(device_id, name, entry) for name, entry in value.items()])
+    connection.execute(f"UPDATE devices SET {', '.join(f'{column}=NULL' for column in CHILD_COLUMNS)};")
+
+
+# (user_version, description, statements). Only add to the end, databases in the field are at any of these versions.
+# a statement is sql or a function that gets the connection.
+MIGRATIONS = [
+    (1, "indexes on src_net_addresses and last_time_seen", [
+        '''CREATE INDEX IF NOT EXISTS idx_devices_src_net_addresses ON devices (src_net_addresses);''',
+        '''CREATE INDEX IF NOT EXISTS idx_devices_last_time_seen ON devices (last_time_seen);''',
+    ]),
+    (2, "address lists, talk partners, capabilities and clusters in their own tables", [
+        '''CREATE TABLE IF NOT EXISTS device_edges (
+                device_id integer NOT NULL REFERENCES devices (id) ON DELETE CASCADE,
+                peer_mac_address text NOT NULL,
+                PRIMARY KEY (device_id, peer_mac_address)
+            );''',
+        '''CREATE TABLE IF NOT EXISTS device_dst_addresses (
+                device_id integer NOT NULL REFERENCES devices (id) ON DELETE CASCADE,
+                layer text NOT NULL,
+                address text NOT NULL,
+                PRIMARY KEY (device_id, layer, address)
+            );''',
+        # value has no type so floats stay floats and strings stay strings
+        '''CREATE TABLE IF NOT EXISTS device_capabilities (
+                device_id integer NOT NULL REFERENCES devices (id) ON DELETE CASCADE,
+                name text NOT NULL,
+                value,
+                PRIMARY KEY (device_id, name)
+            );''',
+        '''CREATE TABLE IF NOT EXISTS device_clusters (
+                device_id integer NOT NULL REFERENCES devices (id) ON DELETE CASCADE,
+                name text NOT NULL,
+                value,
+                PRIMARY KEY (device_id, name)
+            );''',
+        '''CREATE INDEX IF NOT EXISTS idx_device_edges_peer_mac_address ON device_edges (peer_mac_address);''',
+        _move_string_columns,
+    ]),
+]
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+class Database:
+    def __init__(self, path: str):
+        self.path = path
+        self.sqlite = os.path.join(path, "zigsniff_database.db")
+        self.lock = threading.RLock()
+        # isolation_level None: we do our own BEGIN/COMMIT so one flush is exactly one transaction
+        self.connection = sqlite3.connect(self.sqlite, check_same_thread=False, isolation_level=None, cached_statements=CACHED_STATEMENTS)
+        for pragma in PRAGMAS:
+            self.connection.execute(pragma)
+
+    def query(self, query: str, parameters=()):
+        '''
+        Returns (column names, rows)
+        '''
+        with self.lock:
+            cursor = self.connection.execute(query, parameters)
+            rows = cursor.fetchall()
+            return [desc[0] for desc in cursor.description], rows
+
+    def execute(self, query: str, parameters=()):
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def transaction(self, statements):
+        '''
+        Runs a list of (query, parameters) or (query, [parameters, ...]) in one transaction.
+        Rolls back and raises on errors.
+        '''
+        with self.lock:
+            self.connection.execute("BEGIN TRANSACTION;")
+            try:
+                for query, parameters in statements:
+                    if isinstance(parameters, list):
+                        self.connection.executemany(query, parameters)
+                    else:
+                        self.connection.execute(query, parameters)
+                self.connection.execute("COMMIT;")
+            except sqlite3.Error:
+                self.connection.execute("ROLLBACK;")
+                raise
+
+    def migrate(self):
+        '''
+        Brings older database files up to the current schema.
+        '''
+        with self.lock:
+            version = self.connection.execute("PRAGMA user_version;").fetchone()[0]
+            for migration_version, description, statements in MIGRATIONS:
+                if migration_version <= version:
+                    continue
+                self.connection.execute("BEGIN TRANSACTION;")
+                try:
+                    for statement in statements:
+                        if callable(statement):
+                            statement(self.connection)
+                        else:
+                            self.connection.execute(statement)
+                    self.connection.execute(f"PRAGMA user_version={migration_version};")
+                    self.connection.execute("COMMIT;")
+                except sqlite3.Error:
+                    self.connection.execute("ROLLBACK;")
+                    raise
+                report(f"Migrated {self.sqlite} to version {migration_version}: {description}", self.path)
+
+    def child_columns(self, since: float = None):
+        '''
+        Reads the child tables back into {device_id: {column: list or dict}}
+        '''
+        children = {}
+        for column in CHILD_COLUMNS:
+            parameters = () if since is None else (since,)
+            for row in self.execute(child_select_query(column, since is not None), parameters):
+                entries = children.setdefault(row[0], {}).setdefault(column, {})
+                if column in CHILD_LISTS:
+                    entries[row[1]] = None
+                else:
+                    entries[row[1]] = row[2]
+        return children
+
+    def close(self):
+        with self.lock:
+            try:
+                self.connection.execute("PRAGMA optimize;")
+            except sqlite3.Error:
+                pass
+            self.connection.close()
+
+
+def get_database(path: str):
+    '''
+    The connection for the work directory in this process. Worker processes get their own.
+    '''
+    key = (os.getpid(), path)
+    with _databases_lock:
+        if key not in _databases:
+            database = Database(path)
+            _databases[key] = database
+            atexit.register(close_database, path)
+        return _databases[key]
+
+
+def close_database(path: str):
+    with _databases_lock:
+        database = _databases.pop((os.getpid(), path), None)
+    if database is not None:
+        database.close()
@@ -1,5 +1,17 @@
 from misc.zigsniff_utilities import report, write_zigsniff_message, key_management_add_key
-from misc.zigsniff_sqlite import get_sticky_note, change_sticky_note
+from misc.zigsniff_sqlite import sticky_note_changed
+from misc.zigsniff_backlog import get_encrypted_backlog
+
+def retry_backlog(dissector, path):
+    # frames of this PAN that we could not decrypt yet may work with the key that was just added
+    backlog = get_encrypted_backlog(path)
+    if backlog is None:
+        return
+    try:
+        key_sequence = int(dissector["transport_key_sequence"], 0)
+    except (KeyError, ValueError):
+        key_sequence = None
+    backlog.key_added(dissector.get("pan_dst"), key_sequence)
 
 def zigbee_detections(dissector, path):
     try:
@@ -23,6 +35,7 @@ def zigbee_detections(dissector, path):
             write_zigsniff_message(zigbee_message, path)
             # add key to zigbee_pc_keys
             key_management_add_key(dissector["link_key_secret"], path)
+            retry_backlog(dissector, path)
 
         elif "link_key_standard" in dissector:
             # Network key discovered message.
@@ -33,20 +46,16 @@ def zigbee_detections(dissector, path):
             write_zigsniff_message(zigbee_message, path)
             # add key to zigbee_pc_keys
             key_management_add_key(dissector["link_key_standard"], path)
+            retry_backlog(dissector, path)
 
         elif "command_sensing_occupancy_occupied" in dissector:
             # Movement detected
             value = dissector["command_sensing_occupancy"]
-            sticky_note = get_sticky_note(dissector["nwk_addr_src"], path)
+            changed = sticky_note_changed(dissector["nwk_addr_src"], "command_sensing_occupancy_occupied", value, path)
 
-            if sticky_note != "Error":
-                if "command_sensing_occupancy_occupied" in sticky_note:
-                    if sticky_note["command_sensing_occupancy_occupied"] != value:
-                        sticky_note["command_sensing_occupancy_occupied"] = value
-                    else:
-                        return
-                else:
-                    sticky_note["command_sensing_occupancy_occupied"] = value
+            if changed != "Error":
+                if not changed:
+                    return
 
                 if value == "0x00":
                     value = "no"
@@ -61,12 +70,6 @@ def zigbee_detections(dissector, path):
 
                 report(f"zigbee message related to { dissector['nwk_addr_src'] } formed", path)
                 write_zigsniff_message(zigbee_message, path)
-
-                if change_sticky_note(dissector["nwk_addr_src"], sticky_note, path) == 1:
-                    report(sticky_note, path)
-                    report(dissector, path)
-                    report("Error occurred while creating Motion detection notification check at the sticky note update section", path)
-                    exit()
             else:
                 return
 
@@ -74,21 +77,15 @@ def zigbee_detections(dissector, path):
             # Movement detected
 
             value = dissector["command_onoff_attr_onoff"]
-            sticky_note = get_sticky_note(dissector["nwk_addr_src"], path)
+            if "src_endpoint" in dissector:
+                sticky_field = "command_onoff_attr_onoff_" + str(dissector['src_endpoint'])
+            else:
+                sticky_field = "command_onoff_attr_onoff"
+            changed = sticky_note_changed(dissector["nwk_addr_src"], sticky_field, value, path)
 
-            if sticky_note != "Error":
-                if "src_endpoint" in dissector:
-                    sticky_field = "command_onoff_attr_onoff_" + str(dissector['src_endpoint'])
-                else:
-                    sticky_field = "command_onoff_attr_onoff"
-
-                if sticky_field in sticky_note:
-                    if sticky_note[sticky_field] != value:
-                        sticky_note[sticky_field] = value
-                    else:
-                        return
-                else:
-                    sticky_note[sticky_field] = value
+            if changed != "Error":
+                if not changed:
+                    return
 
                 if value == "0x00":
                     value = "Off"
@@ -103,12 +100,6 @@ def zigbee_detections(dissector, path):
 
                 report(f"zigbee message related to { dissector['nwk_addr_src'] } formed", path)
                 write_zigsniff_message(zigbee_message, path)
-
-                if change_sticky_note(dissector["nwk_addr_src"], sticky_note, path) == 1:
-                    report(sticky_note, path)
-                    report(dissector, path)
-                    report("Error occurred while creating an ON OFF command check at the sticky note update section", path)
-                    exit()
             else:
                 return
 
@@ -138,16 +129,11 @@ def zigbee_detections(dissector, path):
         elif "command_zone_alarm_1" in dissector:
             # Movement detected
             value = dissector["command_zone_alarm_1"]
-            sticky_note = get_sticky_note(dissector["nwk_addr_src"], path)
+            changed = sticky_note_changed(dissector["nwk_addr_src"], "command_zone_alarm_1", value, path)
 
-            if sticky_note != "Error":
-                if "command_zone_alarm_1" in sticky_note:
-                    if sticky_note["command_zone_alarm_1"] != value:
-                        sticky_note["command_zone_alarm_1"] = value
-                    else:
-                        return
-                else:
-                    sticky_note["command_zone_alarm_1"] = value
+            if changed != "Error":
+                if not changed:
+                    return
 
                 pkt_cluster = dissector["cluster"]
                 if pkt_cluster == "0x0500":
@@ -170,12 +156,6 @@ def zigbee_detections(dissector, path):
 
                 report(f"zigbee message related to { dissector['nwk_addr_src'] } formed", path)
                 write_zigsniff_message(zigbee_message, path)
-
-                if change_sticky_note(dissector["nwk_addr_src"], sticky_note, path) == 1:
-                    report(sticky_note, path)
-                    report(dissector, path)
-                    report("Error occurred while creating an ON OFF command check at the sticky note update section", path)
-                    exit()
             else:
                 return
 
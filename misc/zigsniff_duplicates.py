@@ -0,0 +1,98 @@
+'''
+    In a mesh the same NWK frame is seen once per hop, and again for every MAC retransmission. All copies have
+    the same PAN, NWK source, NWK sequence number and APS counter. The first copy goes through everything in
+    process_dissector, the copies that follow within window_seconds (capture time) only add their WPAN hop
+    (wpan_add_dev_to_devices, match_wpan_addresses) and skip the NWK device work, parse_the_rest and the detections.
+
+    A copy from a different WPAN source is a relay, from the same one a retransmission. Both are counted in
+    zigsniff_duplicates_total, copies that had a detection also in zigsniff_duplicate_detections_total, and the
+    log gets the numbers every report period. A frame that was still encrypted is not the same as its decrypted
+    copy from the encrypted backlog, so that one goes through.
+'''
+import threading
+from collections import OrderedDict
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_metrics import get_metrics
+from misc.zigsniff_keys import decrypted
+
+_filters = {}
+_filters_lock = threading.Lock()
+
+
+class DuplicateFilter:
+    def __init__(self, path: str, window_seconds: float = 5, max_entries: int = 10000):
+        '''
+        NWK sequence numbers wrap after 256 frames of a source, keep the window short.
+        '''
+        self.path = path
+        self.window = window_seconds
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.metrics = get_metrics(path)
+        self.seen_frames = OrderedDict()  # key -> (capture time, WPAN source) of the first copy, oldest first
+        self.newest = 0
+        self.counts = {"frames": 0, "relay": 0, "retransmission": 0, "detections": 0}
+
+    def seen(self, dissector: dict):
+        '''
+        True when dissector is a copy of a NWK frame we already had.
+        '''
+        if "nwk_seqno" not in dissector or "nwk_addr_src" not in dissector:
+            return False
+        sealed = "key_id" in dissector and not decrypted(dissector)
+        key = (dissector.get("pan_dst"), dissector["nwk_addr_src"], dissector["nwk_seqno"], dissector.get("aps_counter"), sealed)
+        timestamp = dissector["pkt_timestamp"]
+        with self.lock:
+            self.counts["frames"] += 1
+            # the fallback and the backlog hand out frames a little out of order, the window follows the newest
+            if timestamp > self.newest:
+                self.newest = timestamp
+            while self.seen_frames:
+                oldest_key, (oldest, wpan_src) = next(iter(self.seen_frames.items()))
+                if self.newest - oldest <= self.window and len(self.seen_frames) < self.max_entries:
+                    break
+                del self.seen_frames[oldest_key]
+            first = self.seen_frames.get(key)
+            if first is None or timestamp - first[0] > self.window:
+                self.seen_frames[key] = (timestamp, dissector.get("wpan_addr_src"))
+                self.seen_frames.move_to_end(key)
+                return False
+            kind = "retransmission" if first[1] == dissector.get("wpan_addr_src") else "relay"
+            self.counts[kind] += 1
+            if dissector["detection"] == 1:
+                self.counts["detections"] += 1
+        self.metrics.count("zigsniff_duplicates_total", kind=kind)
+        if dissector["detection"] == 1:
+            self.metrics.count("zigsniff_duplicate_detections_total")
+        return True
+
+    def report(self, path: str = None):
+        '''
+        What was suppressed since the last report.
+        '''
+        with self.lock:
+            counts = dict(self.counts)
+            self.counts = {"frames": 0, "relay": 0, "retransmission": 0, "detections": 0}
+        if not counts["frames"]:
+            return
+        report(f"Duplicates: {counts['relay'] + counts['retransmission']} of {counts['frames']} NWK frames suppressed "
+               f"({counts['relay']} relayed, {counts['retransmission']} retransmitted), {counts['detections']} of them had a detection",
+               path if path is not None else self.path)
+
+
+def open_duplicate_filter(path: str, **settings):
+    '''
+    Turns the filter on for the work directory, settings are window_seconds and max_entries.
+    '''
+    with _filters_lock:
+        if path not in _filters:
+            _filters[path] = DuplicateFilter(path, **settings)
+        return _filters[path]
+
+
+def get_duplicate_filter(path: str):
+    '''
+    The filter of the work directory or None when it is off.
+    '''
+    return _filters.get(path)
@@ -0,0 +1,261 @@
+'''
+    asyncio engine for live capture (--engine asyncio). One event loop drives every capture source:
+    - whsniff (or a replay) and the tshark fallback are read through asyncio subprocess streams
+    - frames are dissected natively on the loop, what needs tshark goes through the fields backend
+    - the reporter, store flushes, archive rotation and the counters are timers on the loop, no BackgroundScheduler
+    - all SQLite work (storing frames, store flushes, the reporter) runs on one database thread, so the reporter
+      and the ingest never wait for each other's locks. Archive writes run on one file thread.
+    Frames of a chunk are stored as one batch, the archive has the chunk before its frames are stored so the
+    packet index can always find them.
+'''
+import io
+import time
+import shlex
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_archive import open_pcap_archive
+from misc.zigsniff_index import get_packet_index
+from misc.zigsniff_store import get_device_store
+from misc.zigsniff_metrics import get_metrics
+from misc.zigsniff_backlog import get_encrypted_backlog
+from misc.zigsniff_sources import ChannelCounters
+from misc.zigsniff_fields import FieldsCapture, field_columns, fields_dissector
+from misc.zigsniff_pcap import PcapStreamParser, PcapError, read_pcap, write_pcap_header, write_pcap_record
+from zigbee_native_dissector import zigbee_native_dissector, NATIVE_FALLBACK
+
+
+class _Fallback:
+    '''
+    tshark -T fields for the frames of one source the native dissector can not handle. Started with the first one.
+    '''
+    def __init__(self, engine, source):
+        self.engine = engine
+        self.source = source
+        self.records = deque()  # the frames tshark still has to give back
+        self.process = None
+        self.columns = None
+        self.task = None
+        self.failed = False
+
+    async def start(self, linktype: int):
+        loop = asyncio.get_running_loop()
+        tshark_fields, self.columns = await loop.run_in_executor(None, field_columns, self.engine.path)
+        command = FieldsCapture(pipe=asyncio.subprocess.PIPE, keyfile=self.engine.keyfile, path=self.engine.path, pans=self.source.pans).command(tshark_fields)
+        self.process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        header = io.BytesIO()
+        write_pcap_header(header, linktype)
+        self.process.stdin.write(header.getvalue())
+        self.task = asyncio.create_task(self._read())
+
+    async def write(self, record):
+        if self.failed:
+            return
+        if self.process is None:
+            try:
+                await self.start(record.linktype)
+            except Exception as e:
+                # no tshark, the rest of the frames still count
+                report(f"Source {self.source.name}: the tshark fallback does not start, frames it should dissect are skipped: {e}", self.engine.path)
+                self.failed = True
+                return
+        buffer = io.BytesIO()
+        write_pcap_record(buffer, record.timestamp, record.data, record.length)
+        self.records.append(record)
+        self.process.stdin.write(buffer.getvalue())
+        await self.process.stdin.drain()
+
+    async def _read(self):
+        metrics = get_metrics(self.engine.path)
+        backlog = get_encrypted_backlog(self.engine.path)
+        while True:
+            started = time.perf_counter()
+            line = await self.process.stdout.readline()
+            if not line:
+                break
+            metrics.observe("zigsniff_stage_seconds", time.perf_counter() - started, stage="capture")
+            dissector = fields_dissector(line.decode().rstrip("\n").split("\t"), self.columns)
+            record = self.records.popleft()
+            if isinstance(dissector, dict):
+                # tshark counts its own frames, we want the number in the archive
+                dissector["pkt_number"] = record.number
+            if backlog is not None:
+                backlog.offer(record, dissector, self.source.pcap_path, self.source.channel)
+            await self.engine.store(self.source, [dissector])
+
+    async def close(self):
+        if self.process is None or self.failed:
+            return
+        self.process.stdin.close()
+        try:
+            await self.task
+        finally:
+            await self.process.wait()
+
+
+class AsyncEngine:
+    def __init__(self, path: str, process, keyfile: str = "zigbee_pc_keys", buffer_size: int = 65536, stall_seconds: float = 30):
+        '''
+        process(dissector, channel, pcap) stores one dissector result, it is called on the database thread.
+        '''
+        self.path = path
+        self.process = process
+        self.keyfile = keyfile
+        self.buffer_size = buffer_size
+        self.stall_seconds = stall_seconds
+        self.database = ThreadPoolExecutor(max_workers=1, thread_name_prefix="zigsniff_database")
+        self.files = ThreadPoolExecutor(max_workers=1, thread_name_prefix="zigsniff_files")
+        self.counters = ChannelCounters()
+        self.timers = []
+        self.archives = []
+        self.last_data = {}  # source name -> monotonic time of the last chunk
+
+    def every(self, seconds: float, function, *args, database: bool = False):
+        '''
+        Runs function(*args) every seconds while the engine runs. database puts it on the database thread,
+        otherwise it runs on the loop and should be quick.
+        '''
+        self.timers.append((seconds, function, args, database))
+
+    async def _timer(self, seconds: float, function, args: tuple, database: bool):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(seconds)
+            try:
+                if database:
+                    await loop.run_in_executor(self.database, function, *args)
+                else:
+                    function(*args)
+            except Exception as e:
+                report(f"Engine: {getattr(function, '__name__', function)} failed: {e}", self.path)
+
+    def _store(self, source, dissectors: list):
+        # on the database thread
+        store = get_device_store(self.path)
+        for dissector in dissectors:
+            if isinstance(dissector, str):
+                self.counters.count(source.channel, "errors")
+            elif dissector is not None:
+                self.counters.count(source.channel, "dissected")
+            self.process(dissector, source.channel, source.pcap_path)
+            if dissector is not None and not isinstance(dissector, str):
+                self.counters.count(source.channel, "stored")
+        # we are the flusher of the store here
+        store.flush_if_due()
+
+    async def store(self, source, dissectors: list):
+        await asyncio.get_running_loop().run_in_executor(self.database, self._store, source, dissectors)
+
+    async def _whsniff_chunks(self, source):
+        command = shlex.split((source.command or "whsniff -c {channel}").format(channel=source.channel))
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        try:
+            while True:
+                chunk = await process.stdout.read(self.buffer_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            if process.returncode is None:
+                process.terminate()
+            report(f"Whsniff on channel {source.channel} stopped: {await process.wait()}", self.path)
+
+    async def _replay_chunks(self, source):
+        '''
+        The replay pcap with the timestamps moved to now, like misc.zigsniff_sources.run_replay.
+        '''
+        report(f"Replaying {source.replay} on channel {source.channel}", self.path)
+        header_written = False
+        first = None
+        started = time.time()
+        for record in read_pcap(source.replay):
+            buffer = io.BytesIO()
+            if not header_written:
+                write_pcap_header(buffer, record.linktype)
+                header_written = True
+            if first is None:
+                first = record.timestamp
+            if source.replay_speed > 0:
+                delay = (record.timestamp - first) / source.replay_speed - (time.time() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            write_pcap_record(buffer, time.time(), record.data, record.length)
+            yield buffer.getvalue()
+        report(f"Replay of {source.replay} on channel {source.channel} done", self.path)
+
+    async def _run_source(self, source):
+        loop = asyncio.get_running_loop()
+        archive = open_pcap_archive(source.pcap_path, self.path)
+        self.archives.append(archive)
+        index = get_packet_index(self.path)
+        if index is not None:
+            index.register(source.pcap_path, archive.locate)
+        parser = PcapStreamParser()
+        fallback = _Fallback(self, source)
+        metrics = get_metrics(self.path)
+        chunks = self._replay_chunks(source) if source.replay is not None else self._whsniff_chunks(source)
+        report(f"Source {source.name} started on channel {source.channel}", self.path)
+        try:
+            async for chunk in chunks:
+                self.last_data[source.name] = time.monotonic()
+                archived = loop.run_in_executor(self.files, archive.write, chunk)
+                batch = []
+                fallback_records = []
+                for record in parser.feed(chunk):
+                    self.counters.count(source.channel, "frames")
+                    started = time.perf_counter()
+                    dissector = zigbee_native_dissector(record)
+                    metrics.observe("zigsniff_stage_seconds", time.perf_counter() - started, stage="dissect")
+                    if dissector is NATIVE_FALLBACK:
+                        fallback_records.append(record)
+                    else:
+                        batch.append(dissector)
+                await archived
+                # only now, or tshark can be quicker than the archive and the packet index misses the frame
+                for record in fallback_records:
+                    await fallback.write(record)
+                if batch:
+                    await self.store(source, batch)
+        except PcapError as e:
+            report(f"Source {source.name}: {e}", self.path)
+        finally:
+            await fallback.close()
+            await loop.run_in_executor(self.files, archive.close)
+            report(f"Source {source.name} on channel {source.channel} is done", self.path)
+
+    def _report_sources(self):
+        self.counters.report(self.path)
+        now = time.monotonic()
+        for name, last_data in self.last_data.items():
+            if self.stall_seconds and now - last_data >= self.stall_seconds:
+                report(f"Source {name} sent nothing for {now - last_data:.0f} seconds", self.path, logging.WARNING)
+
+    def _expire_archives(self):
+        now = time.time()
+        for archive in self.archives:
+            archive.expire(now)
+
+    async def run(self, sources: list, report_period: float = 60):
+        '''
+        Runs until every source is done.
+        '''
+        loop = asyncio.get_running_loop()
+        store = get_device_store(self.path)
+        self.every(store.flush_interval, store.flush, database=True)
+        self.every(report_period, self._report_sources)
+        # a quiet channel still gets its segments closed (and gzipped) in time
+        self.every(min(report_period, 60), lambda: self.files.submit(self._expire_archives))
+        timers = [asyncio.create_task(self._timer(*timer)) for timer in self.timers]
+        report(f"Engine: asyncio with {len(sources)} sources and {len(timers)} timers", self.path)
+        try:
+            await asyncio.gather(*(self._run_source(source) for source in sources))
+        finally:
+            for timer in timers:
+                timer.cancel()
+            await loop.run_in_executor(self.database, store.flush)
+            self.counters.report(self.path)
+            self.database.shutdown()
+            self.files.shutdown()
@@ -0,0 +1,151 @@
+'''
+    Ingest backend that runs tshark with -T fields and only asks for the fields in ZIGBEE_FIELDS.
+    tshark does not have to build PDML for every layer and we do not have to parse it with lxml.
+    Every output line is turned into the same dict zigbee_packet_dissector returns.
+'''
+import subprocess
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_keys import tshark_key_options
+from zigbee_packet_dissector import ZIGBEE_FIELDS, COMPILED_FIELDS, pyshark_field_name
+
+
+FRAME_FIELDS = ["frame.number", "frame.time_epoch", "frame.len", "frame.protocols"]
+# needed to find out which layer the shared zbee.sec.* fields belong to
+SECURITY_FIELDS = ["zbee_nwk.security"]
+
+_available_fields = None
+
+
+def available_tshark_fields():
+    '''
+    Asks tshark which fields it knows. tshark refuses to start when a single -e field does not exist
+    and field names change between wireshark versions.
+    '''
+    global _available_fields
+    if _available_fields is None:
+        process = subprocess.run(["tshark", "-G", "fields"], capture_output=True, text=True, check=True)
+        _available_fields = set()
+        for line in process.stdout.splitlines():
+            columns = line.split("\t")
+            if len(columns) > 2 and columns[0] == "F":
+                _available_fields.add(columns[2])
+    return _available_fields
+
+
+def field_columns(path: str):
+    '''
+    Builds the -e list from ZIGBEE_FIELDS.
+    Returns (tshark fields, columns) where columns is a list of (column index, layer, shared, spec) in the order
+    zigbee_packet_dissector would apply them (layer order of the table, then sorted pyshark field names).
+    '''
+    available = available_tshark_fields()
+    tshark_fields = FRAME_FIELDS + SECURITY_FIELDS
+    columns = []
+    for layer, fields in ZIGBEE_FIELDS.items():
+        layer_columns = []
+        for field in fields:
+            if field not in available:
+                report(f"tshark does not know field {field}, it will be skipped", path)
+                continue
+            if field not in tshark_fields:
+                tshark_fields.append(field)
+            name = pyshark_field_name(layer, field)
+            shared = field.startswith("zbee.sec.")
+            layer_columns.append((name, tshark_fields.index(field), layer.lower(), shared, COMPILED_FIELDS[layer.lower()][name]))
+        layer_columns.sort(key=lambda column: column[0])
+        columns += [(index, layer_name, shared, spec) for _, index, layer_name, shared, spec in layer_columns]
+    return tshark_fields, columns
+
+
+def fields_dissector(values: list, columns: list):
+    '''
+    Same return values as zigbee_packet_dissector but for one line of tshark -T fields output.
+    '''
+    try:
+        if "_ws.malformed" in values[3]:
+            return
+
+        dissector_results = {}
+        dissector_results["device_type"] = "unknown"
+        dissector_results["detection"] = 0
+        dissector_results["pkt_number"] = int(values[0])
+        dissector_results["pkt_timestamp"] = int(values[1].split(".", 1)[0])
+        dissector_results["pkt_length"] = int(values[2])
+
+        # zbee.sec.* shows up once per secured layer. the NWK layer comes first when it is secured.
+        nwk_secured = values[len(FRAME_FIELDS)] in ("1", "True")
+        for index, layer, shared, spec in columns:
+            value = values[index]
+            if value == "":
+                continue
+            occurrences = value.split(",")
+            if shared:
+                if layer == "zbee_nwk":
+                    if not nwk_secured:
+                        continue
+                    value = occurrences[0]
+                else:
+                    occurrence = 1 if nwk_secured else 0
+                    if len(occurrences) <= occurrence:
+                        continue
+                    value = occurrences[occurrence]
+            else:
+                # like pyshark the first occurrence wins
+                value = occurrences[0]
+
+            key, converter, device_type, device_type_by_value, detection = spec
+            dissector_results[key] = converter(value)
+            if device_type is not None:
+                dissector_results["device_type"] = device_type
+            if device_type_by_value is not None and value in device_type_by_value:
+                dissector_results["device_type"] = device_type_by_value[value]
+            if detection is not None:
+                dissector_results["detection"] = detection
+
+        if len(dissector_results) > 5:
+            return dissector_results
+
+    except (IndexError, ValueError) as e:
+        return f"Fields dissector error: {e} in {values}"
+
+
+class FieldsCapture:
+    '''
+    Iterate over it like a pyshark capture, but you get zigbee_packet_dissector results instead of packets.
+    Give it a pcap path or a pipe (file object) with a pcap stream, like the whsniff fifo.
+    With pans tshark only gets the keys the key registry has for those PANs (see misc.zigsniff_keys).
+    '''
+    def __init__(self, pcap_path: str = None, pipe=None, keyfile: str = "zigbee_pc_keys", path: str = ".", pans: list = None):
+        self.pcap_path = pcap_path
+        self.pipe = pipe
+        self.keyfile = keyfile
+        self.pans = pans
+        self.path = path
+        self.process = None
+
+    def command(self, tshark_fields: list):
+        command = ["tshark", "-n", "-T", "fields", "-E", "separator=/t", "-E", "occurrence=a", "-E", "aggregator=,"]
+        command += tshark_key_options(self.keyfile, self.pans, self.path)
+        if self.pipe is not None:
+            command += ["-l", "-r", "-"]
+        else:
+            command += ["-r", self.pcap_path]
+        for field in tshark_fields:
+            command += ["-e", field]
+        return command
+
+    def __iter__(self):
+        tshark_fields, columns = field_columns(self.path)
+        stdin = self.pipe if self.pipe is not None else subprocess.DEVNULL
+        self.process = subprocess.Popen(self.command(tshark_fields), stdin=stdin, stdout=subprocess.PIPE, text=True)
+        try:
+            for line in self.process.stdout:
+                yield fields_dissector(line.rstrip("\n").split("\t"), columns)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
@@ -0,0 +1,159 @@
+'''
+    GPS poller. A thread asks gpsd for the current fix every poll interval and keeps the latest one,
+    packets read it with location() without touching a socket.
+    A fix older than max_age_seconds or less accurate than max_accuracy_m (when gpsd tells us) is not handed out.
+    Fixes are also written to zigsniff_gps_track.csv (time,lon,lat,accuracy) but only when we moved
+    track_min_distance_m or track_max_interval_seconds passed, so standing still costs one line a minute.
+
+    FakeGpsSource stands in for gpsd: a fixed "lon,lat" or a track csv in the same format that is replayed.
+'''
+import os
+import csv
+import math
+import time
+import atexit
+import threading
+from collections import namedtuple
+
+from misc.zigsniff_utilities import report
+
+GpsFix = namedtuple("GpsFix", ["position", "time", "accuracy", "received"])
+
+
+class GpsdSource:
+    def __init__(self, host: str = "127.0.0.1", port: int = 2947):
+        import gpsd  # only needed when we really talk to gpsd
+        self.gpsd = gpsd
+        self.host = host
+        self.port = port
+        self.connected = False
+
+    def fix(self):
+        '''
+        (lon, lat, accuracy in meters or None) or None without a 2D fix
+        '''
+        if not self.connected:
+            self.gpsd.connect(host=self.host, port=self.port)
+            self.connected = True
+        try:
+            location = self.gpsd.get_current()
+        except Exception:
+            self.connected = False
+            raise
+        if location.mode < 2 or (location.lat == 0.0 and location.lon == 0.0):
+            return None
+        accuracy = None
+        if location.error and "x" in location.error and "y" in location.error:
+            accuracy = max(location.error["x"], location.error["y"])
+        return location.lon, location.lat, accuracy
+
+
+class FakeGpsSource:
+    def __init__(self, fake: str):
+        '''
+        fake is "lon,lat" or the path of a track csv (time,lon,lat,accuracy) that is replayed at its own speed.
+        '''
+        self.track = []
+        if os.path.isfile(fake):
+            with open(fake, 'r', newline='') as file:
+                for row in csv.reader(file):
+                    if len(row) >= 3 and row[0] != "time":
+                        accuracy = float(row[3]) if len(row) > 3 and row[3] else None
+                        self.track.append((float(row[0]), float(row[1]), float(row[2]), accuracy))
+        else:
+            lon, lat = fake.split(",")
+            self.track.append((0.0, float(lon), float(lat), None))
+        self.started = time.monotonic()
+
+    def fix(self):
+        if not self.track:
+            return None
+        elapsed = time.monotonic() - self.started
+        start = self.track[0][0]
+        point = self.track[0]
+        for entry in self.track:
+            if entry[0] - start > elapsed:
+                break
+            point = entry
+        return point[1], point[2], point[3]
+
+
+def distance_m(a, b):
+    # equirectangular is plenty for a few meters
+    lon_1, lat_1 = map(math.radians, a)
+    lon_2, lat_2 = map(math.radians, b)
+    x = (lon_2 - lon_1) * math.cos((lat_1 + lat_2) / 2)
+    y = lat_2 - lat_1
+    return math.sqrt(x * x + y * y) * 6371000
+
+
+class GpsPoller:
+    def __init__(self, path: str, source=None, poll_interval_ms: int = 1000, max_age_seconds: float = 5, max_accuracy_m: float = 50,
+                 track_min_distance_m: float = 5, track_max_interval_seconds: float = 60, host: str = "127.0.0.1", port: int = 2947):
+        self.path = path
+        self.source = source if source is not None else GpsdSource(host, port)
+        self.poll_interval = poll_interval_ms / 1000
+        self.max_age = max_age_seconds
+        self.max_accuracy = max_accuracy_m  # 0 takes any fix
+        self.track_min_distance = track_min_distance_m
+        self.track_max_interval = track_max_interval_seconds
+        self.latest = None  # GpsFix, replaced as a whole so readers never see half a fix
+        self.last_track = None
+        self.track_path = os.path.join(path, "zigsniff_gps_track.csv")
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._poll, name="zigsniff_gps", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        '''
+        Stops polling, a track line that is being written is finished first.
+        '''
+        self.stopped.set()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def location(self):
+        '''
+        (lon, lat) of the latest fix or None when there is none, it is stale or not accurate enough. Never blocks.
+        '''
+        fix = self.latest
+        if fix is None or time.monotonic() - fix.received > self.max_age:
+            return None
+        if self.max_accuracy and fix.accuracy is not None and fix.accuracy > self.max_accuracy:
+            return None
+        return fix.position
+
+    def _record(self, fix):
+        if self.last_track is not None:
+            moved = distance_m(self.last_track.position, fix.position)
+            if moved < self.track_min_distance and fix.time - self.last_track.time < self.track_max_interval:
+                return
+        new_file = not os.path.isfile(self.track_path)
+        with open(self.track_path, 'a', newline='') as file:
+            writer = csv.writer(file)
+            if new_file:
+                writer.writerow(["time", "lon", "lat", "accuracy"])
+            accuracy = "" if fix.accuracy is None else f"{fix.accuracy:.1f}"
+            writer.writerow([int(fix.time), f"{fix.position[0]:.7f}", f"{fix.position[1]:.7f}", accuracy])
+        self.last_track = fix
+
+    def _poll(self):
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                current = self.source.fix()
+                failures = 0
+                if current is not None:
+                    lon, lat, accuracy = current
+                    self.latest = GpsFix((lon, lat), time.time(), accuracy, time.monotonic())
+                    self._record(self.latest)
+            except Exception as e:
+                failures += 1
+                if failures == 1:
+                    report(f"GPS: no fix from gpsd: {e}", self.path)
+            # back off a bit while gpsd is not there
+            self.stopped.wait(self.poll_interval * min(failures + 1, 10))
@@ -0,0 +1,150 @@
+'''
+    Channel hopping with one dongle. A thread runs whsniff on one channel at a time and copies its frames into
+    the fifo as one continuous pcap stream, so the reader on the other side never sees the restarts.
+    The frames also go to the archive pcap.
+
+    Every channel is visited in turn. Channels with more traffic or more devices we had not seen yet get a longer
+    dwell time, quiet channels get min_dwell_seconds. Every window remembers the number of the first frame it wrote,
+    so channel_for_frame tells for each frame on which channel it was really captured.
+'''
+import time
+import shlex
+import bisect
+import threading
+import subprocess
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_whsniff import fifo_available
+from misc.zigsniff_archive import open_pcap_archive
+from misc.zigsniff_pcap import read_pcap_stream, write_pcap_header, write_pcap_record
+
+
+class ChannelHopper:
+    def __init__(self, fifo_path: str, pcap_path: str, path: str, channels: list = None, min_dwell_seconds: float = 2,
+                 max_dwell_seconds: float = 30, new_device_weight: float = 10, smoothing: float = 0.5, command: str = "whsniff -c {channel}"):
+        self.fifo_path = fifo_path
+        self.pcap_path = pcap_path
+        self.path = path
+        self.channels = channels if channels else list(range(11, 27))
+        self.min_dwell = min_dwell_seconds
+        self.max_dwell = max_dwell_seconds
+        self.new_device_weight = new_device_weight
+        self.smoothing = smoothing
+        self.command = command
+        self.archive = open_pcap_archive(pcap_path, path)
+        self.lock = threading.Lock()
+        self.window_frames = []  # frames written before every window started
+        self.window_channels = []  # channel of every window
+        self.frames = 0  # frames written to the fifo
+        self.scores = {channel: None for channel in self.channels}  # smoothed frames + weighted new devices per second
+        self.new_devices = {channel: 0 for channel in self.channels}  # since the last window on that channel
+        self.seen = set()
+        self.current = None
+        self.process = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="zigsniff_hopper", daemon=True)
+
+    def start(self):
+        if fifo_available(self.fifo_path, self.path) == 1:
+            exit()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.terminate()
+
+    def channel_for_frame(self, number: int):
+        '''
+        Channel of the window that frame number (1 is the first frame in the fifo) was captured in.
+        '''
+        with self.lock:
+            index = bisect.bisect_right(self.window_frames, number - 1) - 1
+            if index < 0:
+                return self.current
+            return self.window_channels[index]
+
+    def observe(self, channel: int, dissector: dict):
+        '''
+        Call with every dissected frame and its channel. Devices we have not seen before make the channel more interesting.
+        '''
+        for key in ("wpan_mac_src", "nwk_mac_src", "wpan_addr_src", "nwk_addr_src"):
+            if key in dissector:
+                device = (channel, dissector.get("pan_dst"), dissector[key])
+                with self.lock:
+                    if device not in self.seen and channel in self.new_devices:
+                        self.seen.add(device)
+                        self.new_devices[channel] += 1
+                break
+
+    def dwell(self, channel: int):
+        '''
+        Channels we never visited get the middle between min and max dwell once so they get a fair chance.
+        '''
+        score = self.scores[channel]
+        if score is None:
+            return (self.min_dwell + self.max_dwell) / 2
+        scores = [value for value in self.scores.values() if value]
+        if not scores or not score:
+            return self.min_dwell
+        return self.min_dwell + (self.max_dwell - self.min_dwell) * score / max(scores)
+
+    def _capture_window(self, channel: int, dwell: float, fifo, archive, header_written: bool):
+        command = shlex.split(self.command.format(channel=channel))
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        timer = threading.Timer(dwell, self.process.terminate)
+        timer.start()
+        frames = 0
+        try:
+            for record in read_pcap_stream(self.process.stdout):
+                if not header_written:
+                    write_pcap_header(archive, record.linktype)
+                    write_pcap_header(fifo, record.linktype)
+                    header_written = True
+                # archive first, the packet index looks the frame up there once the parser has it
+                write_pcap_record(archive, record.timestamp, record.data, record.length)
+                write_pcap_record(fifo, record.timestamp, record.data, record.length)
+                fifo.flush()
+                frames += 1
+                with self.lock:
+                    self.frames += 1
+        except Exception as e:
+            # a terminated whsniff can leave half a record or no header at all
+            if not self.stopped.is_set() and self.process.poll() is None:
+                report(f"Channel hopper: reading whsniff on channel {channel} failed: {e}", self.path)
+        finally:
+            timer.cancel()
+            if self.process.poll() is None:
+                self.process.terminate()
+            self.process.wait()
+        return frames, header_written
+
+    def _run(self):
+        try:
+            with open(self.fifo_path, 'wb') as fifo, self.archive as archive:
+                header_written = False
+                while not self.stopped.is_set():
+                    for channel in self.channels:
+                        if self.stopped.is_set():
+                            break
+                        dwell = self.dwell(channel)
+                        with self.lock:
+                            self.current = channel
+                            self.window_frames.append(self.frames)
+                            self.window_channels.append(channel)
+                        started = time.monotonic()
+                        frames, header_written = self._capture_window(channel, dwell, fifo, archive, header_written)
+                        elapsed = max(time.monotonic() - started, 0.001)
+                        with self.lock:
+                            # the dissector runs behind, new devices it finds late count for the next visit
+                            score = (frames + self.new_device_weight * self.new_devices[channel]) / elapsed
+                            self.new_devices[channel] = 0
+                            previous = self.scores[channel]
+                            self.scores[channel] = score if previous is None else self.smoothing * score + (1 - self.smoothing) * previous
+                        report(f"Channel hopper: channel {channel} {dwell:.1f}s, {frames} frames, score {self.scores[channel]:.2f}", self.path)
+        except BrokenPipeError:
+            report("Channel hopper: the reader closed the fifo", self.path)
+        except Exception as e:
+            report(f"Channel hopper error occurred: {e}", self.path)
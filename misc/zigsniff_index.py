@@ -0,0 +1,162 @@
+'''
+    Packet index. While ingesting, every dissected frame gets a row in zigsniff_index.db (next to the database)
+    with the pcap file and byte offset it is in, its timestamp and the device it came from: 64 bit address,
+    short address, PAN and cluster. zigsniff_extract.py uses it to seek straight to the frames of one device
+    or time range instead of running tshark over whole captures.
+
+    Where a frame is comes from a locator per capture: PcapLocator for an offline pcap, the archive of a live
+    capture (PcapArchive.locate) for live. Frames a locator does not know are not indexed.
+    Rows are written behind in one transaction every flush_interval_ms like the device store.
+'''
+import os
+import atexit
+import sqlite3
+import threading
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_database import PRAGMAS
+from misc.zigsniff_pcap import record_offsets
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS files (
+            id integer PRIMARY KEY,
+            name text NOT NULL UNIQUE
+        );''',
+    '''CREATE TABLE IF NOT EXISTS frames (
+            file_id integer NOT NULL REFERENCES files (id),
+            offset integer NOT NULL,
+            number integer,
+            timestamp integer,
+            pan text,
+            mac text,
+            nwk_src text,
+            wpan_src text,
+            cluster text
+        );''',
+    '''CREATE INDEX IF NOT EXISTS idx_frames_mac ON frames (mac, timestamp);''',
+    '''CREATE INDEX IF NOT EXISTS idx_frames_nwk_src ON frames (nwk_src, pan, timestamp);''',
+    '''CREATE INDEX IF NOT EXISTS idx_frames_wpan_src ON frames (wpan_src, pan, timestamp);''',
+    '''CREATE INDEX IF NOT EXISTS idx_frames_cluster ON frames (cluster, timestamp);''',
+    '''CREATE INDEX IF NOT EXISTS idx_frames_timestamp ON frames (timestamp);''',
+]
+
+
+class PcapLocator:
+    '''
+    Locator for a pcap on disk. Walks the record offsets once, frames have to be asked for in order.
+    '''
+    def __init__(self, pcap_path: str):
+        self.file = os.path.abspath(pcap_path)
+        self.offsets = enumerate(record_offsets(pcap_path), start=1)
+        self.current = (0, None)
+
+    def locate(self, number: int):
+        while self.current[0] < number:
+            self.current = next(self.offsets, (float("inf"), None))
+        if self.current[0] != number:
+            return None
+        return self.file, self.current[1]
+
+
+class PacketIndex:
+    def __init__(self, path: str, flush_interval_ms: int = 1000):
+        self.path = path
+        self.sqlite = os.path.join(path, "zigsniff_index.db")
+        self.flush_interval = flush_interval_ms / 1000
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.sqlite, check_same_thread=False, isolation_level=None)
+        for pragma in PRAGMAS:
+            self.connection.execute(pragma)
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.files = dict(self.connection.execute("SELECT name, id FROM files;").fetchall())
+        self.locators = {}  # pcap name given to process_dissector -> locate function
+        self.rows = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._flusher, name="zigsniff_index", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def register(self, pcap, locate):
+        '''
+        Frames that process_dissector gets with this pcap are located with locate(number) -> (file, offset) or None.
+        '''
+        self.locators[str(pcap)] = locate
+
+    def _file_id(self, name: str):
+        file_id = self.files.get(name)
+        if file_id is None:
+            with self.lock:
+                self.connection.execute("INSERT OR IGNORE INTO files (name) VALUES (?);", (name,))
+                file_id = self.connection.execute("SELECT id FROM files WHERE name=?;", (name,)).fetchone()[0]
+            self.files[name] = file_id
+        return file_id
+
+    def add(self, dissector: dict, pcap, store=None):
+        locate = self.locators.get(str(pcap))
+        if locate is None or "pkt_number" not in dissector:
+            return
+        position = locate(dissector["pkt_number"])
+        if position is None:
+            return
+        name, offset = position
+        mac = dissector.get("nwk_mac_src") or dissector.get("wpan_mac_src")
+        nwk_src = dissector.get("nwk_addr_src")
+        wpan_src = dissector.get("wpan_addr_src")
+        if mac is None and store is not None:
+            # frames with only a short address still belong to a device we know
+            device = store.get_by_src_net_address(str(nwk_src or wpan_src))
+            if device is not None:
+                mac = device["device_mac_address"]
+        row = (self._file_id(name), offset, dissector["pkt_number"], dissector.get("pkt_timestamp"), dissector.get("pan_dst"),
+               mac, nwk_src, wpan_src, dissector.get("cluster"))
+        with self.lock:
+            self.rows.append(row)
+
+    def flush(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+            if not rows:
+                return
+            try:
+                self.connection.execute("BEGIN;")
+                self.connection.executemany("INSERT INTO frames (file_id, offset, number, timestamp, pan, mac, nwk_src, wpan_src, cluster) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);", rows)
+                self.connection.execute("COMMIT;")
+            except sqlite3.Error as e:
+                if self.connection.in_transaction:
+                    self.connection.execute("ROLLBACK;")
+                self.rows = rows + self.rows
+                report(f"Packet index: writing {len(rows)} frames failed: {e}", self.path)
+
+    def _flusher(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        with self.lock:
+            self.connection.close()
+
+
+def open_packet_index(path: str, **settings):
+    '''
+    Opens the index of the work directory, settings are the arguments of PacketIndex.
+    '''
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = PacketIndex(path, **settings)
+        return _indexes[path]
+
+
+def get_packet_index(path: str):
+    '''
+    The index of the work directory or None when indexing is off.
+    '''
+    return _indexes.get(path)
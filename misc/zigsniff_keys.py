@@ -0,0 +1,213 @@
+'''
+    The zigbee_pc_keys file and the key registry.
+
+    tshark tries every key of the keys file on every secured frame, so a keys file that collected keys of many
+    sites makes every frame slower. The registry remembers which network key worked for which PAN (and key
+    sequence number) and which extended PAN a PAN belongs to, in <keyfile>_registry.json next to the keys file.
+    tshark_key_options with pans hands tshark only the keys of those PANs first and the keys we have not seen
+    working anywhere yet, keys that belong to other PANs are left out. Delete the registry file to start over.
+
+    Every frame with NWK security counts as a hit for the key that decrypted it or a miss for the key the
+    registry has for its PAN ("none" when there is none), in the log and zigsniff_key_decrypts_total.
+'''
+import csv
+import os
+import json
+import binascii
+import threading
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_metrics import get_metrics
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+# any of these means tshark got through the NWK encryption
+DECRYPTED_KEYS = ("packet_profile", "cluster", "zdp_cluster", "cmd_id", "link_key_standard", "link_key_secret")
+
+
+def decrypted(dissector: dict):
+    return any(key in dissector for key in DECRYPTED_KEYS)
+
+
+def normalize_key(key: str):
+    '''
+    tshark, the keys file and the detections do not agree on the notation, 5A:69:.. and 5a69.. are the same key.
+    '''
+    return key.replace(":", "").replace(" ", "").replace('"', "").lower()
+
+
+def key_label(key: str):
+    # same name key_management_add_key always gave new keys
+    return str(binascii.crc32(bytes.fromhex(normalize_key(key))))
+
+
+def read_key_file(keyfile: str):
+    '''
+    Reads a wireshark zigbee_pc_keys file.
+    Returns a list of (key, byte order, label)
+    '''
+    keys = []
+    if not os.path.isfile(keyfile):
+        return keys
+    with open(keyfile, 'r', newline='') as file:
+        for row in csv.reader(line for line in file if line.strip() and not line.startswith("#")):
+            if len(row) >= 3:
+                keys.append((row[0].strip(), row[1].strip(), row[2].strip()))
+    return keys
+
+
+def tshark_key_options(keyfile: str, pans: list = None, path: str = "."):
+    '''
+    Turns the keys in the zigbee_pc_keys file into tshark -o options so tshark does not depend on the
+    keys in the wireshark profile of the user that runs zigsniff.
+    With pans only the keys the key registry of path has for those PANs and the keys that are not known for any PAN.
+    '''
+    keys = read_key_file(keyfile)
+    if pans:
+        selected = get_key_registry(path, keyfile).select(keys, pans)
+        report(f"Keys: {len(selected)} of {len(keys)} keys for PAN {', '.join(sorted(set(pans)))}", path)
+        keys = selected
+    options = []
+    for key, byte_order, label in keys:
+        options += ["-o", f'uat:zigbee_pc_keys:"{key}","{byte_order}","{label}"']
+    return options
+
+
+class KeyRegistry:
+    def __init__(self, path: str, keyfile: str = "zigbee_pc_keys"):
+        self.path = path
+        self.keyfile = keyfile
+        self.registry_path = keyfile + "_registry.json"
+        self.lock = threading.Lock()
+        self.metrics = get_metrics(path)
+        self.pans = {}  # PAN -> {"ext_pan": .., "keys": {key sequence number or "any": normalized key}}
+        self.labels = {}  # normalized key -> label in the keys file
+        self.keyfile_mtime = None
+        self.counts = {}  # (label, "hit"/"miss") -> frames since the last report
+        try:
+            with open(self.registry_path, 'r') as file:
+                self.pans = json.load(file).get("pans", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            report(f"Keys: can not read {self.registry_path}, starting with an empty registry: {e}", path)
+        self._read_keyfile()
+
+    def _read_keyfile(self):
+        # only when somebody changed it, key_management_add_key used to scan the whole file for every key
+        try:
+            mtime = os.stat(self.keyfile).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.keyfile_mtime:
+            return
+        self.keyfile_mtime = mtime
+        self.labels = {normalize_key(key): label for key, byte_order, label in read_key_file(self.keyfile)}
+
+    def _save(self):
+        try:
+            with open(self.registry_path + ".tmp", 'w') as file:
+                json.dump({"pans": self.pans}, file, indent=4, sort_keys=True)
+            os.replace(self.registry_path + ".tmp", self.registry_path)
+        except OSError as e:
+            report(f"Keys: writing {self.registry_path} failed: {e}", self.path)
+
+    def label(self, key: str):
+        return self.labels.get(normalize_key(key)) or key_label(key)
+
+    def add_key(self, key: str):
+        '''
+        Appends key to the keys file when it is not in there yet. True when it was added.
+        '''
+        with self.lock:
+            self._read_keyfile()
+            normalized = normalize_key(key)
+            if normalized in self.labels:
+                return False
+            label = key_label(key)
+            with open(self.keyfile, 'a') as file:
+                file.write(f'"{key}","Normal","{label}"\n')
+            self.labels[normalized] = label
+            self.keyfile_mtime = os.stat(self.keyfile).st_mtime_ns
+            return True
+
+    def select(self, keys: list, pans: list):
+        '''
+        keys as read_key_file returns them. The keys registered for pans (or PANs with the same extended PAN)
+        come first, then the keys that are not registered for any PAN.
+        '''
+        with self.lock:
+            wanted = set(pans)
+            ext_pans = {self.pans[pan].get("ext_pan") for pan in wanted if pan in self.pans} - {None}
+            wanted |= {pan for pan, entry in self.pans.items() if entry.get("ext_pan") in ext_pans}
+            registered = {}
+            for pan, entry in self.pans.items():
+                for key in entry["keys"].values():
+                    registered.setdefault(key, set()).add(pan)
+        first = [row for row in keys if registered.get(normalize_key(row[0]), set()) & wanted]
+        rest = [row for row in keys if normalize_key(row[0]) not in registered]
+        return first + rest
+
+    def observe(self, dissector: dict):
+        '''
+        Learns from a dissected frame: the extended PAN from beacons, the network key of a frame tshark decrypted.
+        '''
+        if "ext_pan_id" in dissector and "pan_src" in dissector:
+            with self.lock:
+                entry = self.pans.setdefault(dissector["pan_src"], {"ext_pan": None, "keys": {}})
+                if entry["ext_pan"] != dissector["ext_pan_id"]:
+                    entry["ext_pan"] = dissector["ext_pan_id"]
+                    self._save()
+        if "key_id" not in dissector or "pan_dst" not in dissector:
+            return  # no NWK security
+        pan = dissector["pan_dst"]
+        sequence = dissector.get("key_sequence", "any")
+        with self.lock:
+            entry = self.pans.get(pan)
+            if decrypted(dissector) and "network_key" in dissector:
+                key = normalize_key(dissector["network_key"])
+                if entry is None:
+                    entry = self.pans[pan] = {"ext_pan": None, "keys": {}}
+                if entry["keys"].get(sequence) != key:
+                    entry["keys"][sequence] = key
+                    report(f"Keys: key {self.label(key)} decrypts PAN {pan} (key sequence {sequence})", self.path)
+                    self._save()
+                label, result = self.label(key), "hit"
+            else:
+                key = entry["keys"].get(sequence, entry["keys"].get("any")) if entry is not None else None
+                label, result = (self.label(key) if key is not None else "none"), "miss"
+            self.counts[(label, result)] = self.counts.get((label, result), 0) + 1
+        self.metrics.count("zigsniff_key_decrypts_total", key=label, result=result)
+
+    def report(self, path: str = None):
+        '''
+        Hits and misses per key since the last report.
+        '''
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        if not counts:
+            return
+        labels = sorted(set(label for label, result in counts))
+        report("Keys: " + ", ".join(f"{label} {counts.get((label, 'hit'), 0)} hits {counts.get((label, 'miss'), 0)} misses" for label in labels),
+               path if path is not None else self.path)
+
+
+def open_key_registry(path: str, keyfile: str = "zigbee_pc_keys"):
+    '''
+    Opens the key registry of the keys file for the work directory.
+    '''
+    with _registries_lock:
+        if path not in _registries:
+            _registries[path] = KeyRegistry(path, keyfile)
+        return _registries[path]
+
+
+def get_key_registry(path: str, keyfile: str = "zigbee_pc_keys"):
+    '''
+    The key registry of the work directory, opened with keyfile when nobody opened it yet (like the shard workers).
+    '''
+    registry = _registries.get(path)
+    if registry is None:
+        registry = open_key_registry(path, keyfile)
+    return registry
@@ -0,0 +1,130 @@
+'''
+    Logging behind report(). The packet thread only puts a record on a queue, a QueueListener thread prints it
+    and writes it to zigsniff_logging.log in the work directory. The log rotates on size.
+    The same message repeated within coalesce_seconds is written once with a count.
+'''
+import os
+import sys
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+import multiprocessing.util
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+class CoalesceFilter(logging.Filter):
+    '''
+    Lets the first of a run of identical messages through and drops the repeats for coalesce_seconds.
+    The first message after the window tells how many were dropped.
+    report() is called from the packet, flush and worker threads, so seen is only touched under the lock.
+    '''
+    def __init__(self, coalesce_seconds: float = 10):
+        super().__init__()
+        self.coalesce_seconds = coalesce_seconds
+        self.seen = {}  # (level, message) -> [first time, repeats]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.coalesce_seconds <= 0:
+            return True
+        key = (record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            seen = self.seen.get(key)
+            if seen is not None and now - seen[0] < self.coalesce_seconds:
+                seen[1] += 1
+                return False
+            if seen is not None and seen[1]:
+                record.msg = f"{record.msg} (repeated {seen[1]} times)"
+            self.seen[key] = [now, 0]
+            if len(self.seen) > 10000:
+                # forget the old ones so messages with addresses in them do not grow this forever
+                self.seen = {key: value for key, value in self.seen.items() if now - value[0] < self.coalesce_seconds}
+        return True
+
+    def pending(self):
+        '''
+        Returns the (level, message, repeats) that were dropped and not counted yet, and forgets them.
+        '''
+        with self.lock:
+            pending = [(level, msg, seen[1]) for (level, msg), seen in self.seen.items() if seen[1]]
+            self.seen = {}
+        return pending
+
+
+class ZigsniffLogger:
+    def __init__(self, path: str, level: str = "INFO", max_bytes: int = 10485760, backup_count: int = 5, coalesce_seconds: float = 10):
+        self.logger = logging.getLogger(f"zigsniff.{os.path.abspath(path)}")
+        self.logger.propagate = False
+        # a forked process (whsniff, replay) inherits the handler of the parent but not its writer thread
+        self.logger.handlers.clear()
+
+        # no logfile means kill the program, do that now and not in the writer thread
+        log_path = os.path.join(path, "zigsniff_logging.log")
+        try:
+            self.file_handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count)
+        except OSError:
+            print(f"Error: Writing to sensor system log file {log_path}")
+            exit()
+        self.file_handler.setFormatter(logging.Formatter("%(asctime)s\t-\t%(message)s", "%Y-%m-%d_%H-%M-%S"))
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter("%(message)s"))
+
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = logging.handlers.QueueHandler(self.queue)
+        self.coalesce_filter = CoalesceFilter(coalesce_seconds)
+        self.queue_handler.addFilter(self.coalesce_filter)
+        self.logger.addHandler(self.queue_handler)
+        self.listener = logging.handlers.QueueListener(self.queue, console_handler, self.file_handler)
+        self.listener.start()
+        # a forked child inherits this object, the writer thread and the repeats belong to the parent
+        self.started = True
+        self.pid = os.getpid()
+        self.configure(level, max_bytes, backup_count, coalesce_seconds)
+        atexit.register(self.close)
+        # multiprocessing children skip atexit but do run these
+        multiprocessing.util.Finalize(None, self.close, exitpriority=0)
+
+    def configure(self, level: str = "INFO", max_bytes: int = 10485760, backup_count: int = 5, coalesce_seconds: float = 10):
+        self.logger.setLevel(level)
+        self.file_handler.maxBytes = max_bytes
+        self.file_handler.backupCount = backup_count
+        self.coalesce_filter.coalesce_seconds = coalesce_seconds
+
+    def close(self):
+        '''
+        Writes what is still queued, with the counts of repeats that no later message reported.
+        '''
+        if not self.started or self.pid != os.getpid():
+            return
+        self.started = False
+        for level, msg, repeats in self.coalesce_filter.pending():
+            record = self.logger.makeRecord(self.logger.name, level, __file__, 0, f"{msg} (repeated {repeats} times)", None, None)
+            # emit and not handle, the filter would hold this back as a repeat
+            self.queue_handler.emit(record)
+        self.listener.stop()
+        self.file_handler.close()
+
+
+def get_logger(path: str):
+    key = (os.getpid(), path)
+    logger = _loggers.get(key)
+    if logger is None:
+        with _loggers_lock:
+            if key not in _loggers:
+                _loggers[key] = ZigsniffLogger(path)
+            logger = _loggers[key]
+    return logger.logger
+
+
+def configure_logging(path: str, **settings):
+    '''
+    Applies the logging section of zigsniff_config.json (level, max_bytes, backup_count, coalesce_seconds).
+    '''
+    get_logger(path)
+    _loggers[(os.getpid(), path)].configure(**settings)
@@ -0,0 +1,221 @@
+'''
+    Counters and latency histograms for every stage of the packet loop, in the Prometheus text format.
+    get_metrics(path) always collects (a dict update under a lock), open_metrics also serves them on
+    http://host:port/metrics and rewrites zigsniff_stats.prom in the work directory every stats_interval_seconds
+    (node_exporter can pick that file up with its textfile collector).
+'''
+import os
+import time
+import atexit
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from misc.zigsniff_utilities import report
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+SECONDS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+LAG_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300)
+
+# name: (type, help, buckets for histograms)
+METRICS = {
+    "zigsniff_frames_total": ("counter", "Frames handed to process_dissector", None),
+    "zigsniff_dissector_errors_total": ("counter", "Frames the dissector returned an error for", None),
+    "zigsniff_dissector_empty_total": ("counter", "Frames the dissector returned None for", None),
+    "zigsniff_detections_total": ("counter", "Detections written to the detection sink", None),
+    "zigsniff_db_flushes_total": ("counter", "Write-behind flushes of the device store", None),
+    "zigsniff_db_devices_written_total": ("counter", "Device rows written by the store flushes", None),
+    "zigsniff_db_flush_errors_total": ("counter", "Store flushes that failed and were retried", None),
+    "zigsniff_stage_seconds": ("histogram", "Time spent per frame in a stage of the packet loop", SECONDS_BUCKETS),
+    "zigsniff_db_flush_seconds": ("histogram", "Time a store flush (one transaction) takes", SECONDS_BUCKETS),
+    "zigsniff_reporter_seconds": ("histogram", "Time a reporter run takes", SECONDS_BUCKETS),
+    "zigsniff_capture_to_store_lag_seconds": ("histogram", "Capture timestamp of a live frame until it is in the store", LAG_BUCKETS),
+    "zigsniff_queue_depth": ("gauge", "Items waiting in a queue of the live pipeline", None),
+    "zigsniff_queue_capacity": ("gauge", "Size of a queue of the live pipeline", None),
+    "zigsniff_queue_dropped_total": ("counter", "Frames the live pipeline dropped because a queue was full", None),
+    "zigsniff_key_decrypts_total": ("counter", "Frames with NWK security per key and result (hit or miss)", None),
+    "zigsniff_duplicates_total": ("counter", "Copies of a NWK frame (relay or retransmission) that skipped the NWK store work and detections", None),
+    "zigsniff_duplicate_detections_total": ("counter", "Suppressed copies that had a detection", None),
+}
+
+
+def _labels(labels: tuple, extra: str = None):
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra is not None:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _le(bound):
+    return f'le="{bound}"'
+
+
+def _number(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., sum, count], above the last bucket is only in count
+        self.gauges = {}  # (name, labels) -> function that returns the value when we are scraped
+        self.server = None
+        self.stats_interval = 0
+        self.stopped = threading.Event()
+        self.stats_thread = None
+
+    def count(self, name: str, amount: int = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(buckets) + [0.0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def gauge(self, name: str, function, **labels):
+        '''
+        function() is called for the value every time the metrics are read, so a queue size is never stale.
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = function
+
+    def timed(self, iterable, stage: str):
+        '''
+        Yields from iterable and observes how long every next() took as stage.
+        '''
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe("zigsniff_stage_seconds", time.perf_counter() - started, stage=stage)
+            yield item
+
+    def text(self):
+        '''
+        Everything in the Prometheus text exposition format.
+        '''
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+            gauges = dict(self.gauges)
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                series = sorted((labels, value) for (metric, labels), value in counters.items() if metric == name)
+                if not series:
+                    lines.append(f"{name} 0")
+                for labels, value in series:
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+            elif kind == "gauge":
+                for (metric, labels), function in sorted(gauges.items(), key=lambda item: item[0]):
+                    if metric == name:
+                        lines.append(f"{name}{_labels(labels)} {_number(function())}")
+            else:
+                for (metric, labels), histogram in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, amount in zip(buckets, histogram):
+                        cumulative += amount
+                        lines.append(f"{name}_bucket{_labels(labels, _le(bound))} {cumulative}")
+                    lines.append(f"{name}_bucket{_labels(labels, _le('+Inf'))} {histogram[-1]}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_number(histogram[-2])}")
+                    lines.append(f"{name}_count{_labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def write_stats(self):
+        stats_path = os.path.join(self.path, "zigsniff_stats.prom")
+        try:
+            with open(stats_path + ".tmp", 'w') as file:
+                file.write(self.text())
+            os.replace(stats_path + ".tmp", stats_path)
+        except OSError as e:
+            report(f"Metrics: writing {stats_path} failed: {e}", self.path)
+
+    def _stats_writer(self):
+        while not self.stopped.wait(self.stats_interval):
+            self.write_stats()
+
+    def serve(self, host: str = "127.0.0.1", port: int = 9469, stats_interval_seconds: float = 60):
+        '''
+        Starts the http endpoint (port 0 is none) and the stats file writer (interval 0 is none).
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # no line in our log for every scrape
+
+        if port:
+            try:
+                self.server = ThreadingHTTPServer((host, port), Handler)
+            except OSError as e:
+                report(f"Metrics: can not listen on {host}:{port}: {e}", self.path)
+            else:
+                self.server.daemon_threads = True
+                threading.Thread(target=self.server.serve_forever, name="zigsniff_metrics", daemon=True).start()
+                report(f"Metrics on http://{host}:{port}/metrics", self.path)
+        if stats_interval_seconds:
+            self.stats_interval = stats_interval_seconds
+            self.stats_thread = threading.Thread(target=self._stats_writer, name="zigsniff_stats", daemon=True)
+            self.stats_thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+        if self.stats_thread is not None:
+            self.write_stats()
+            self.stats_thread = None
+
+
+def get_metrics(path: str):
+    metrics = _metrics.get(path)
+    if metrics is None:
+        with _metrics_lock:
+            if path not in _metrics:
+                _metrics[path] = Metrics(path)
+            metrics = _metrics[path]
+    return metrics
+
+
+def open_metrics(path: str, **settings):
+    '''
+    Applies the metrics section of zigsniff_config.json (host, port, stats_interval_seconds).
+    '''
+    metrics = get_metrics(path)
+    metrics.serve(**settings)
+    return metrics
@@ -0,0 +1,135 @@
+import os
+import pickle
+import multiprocessing
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_pcap import read_pcap, write_pcap_header, write_pcap_record, pcap_shard_offsets
+from zigbee_native_dissector import zigbee_native_dissector, nwk_security, NATIVE_FALLBACK
+from zigbee_packet_dissector import zigbee_packet_dissector
+from misc.zigsniff_fields import FieldsCapture
+from misc.zigsniff_backlog import get_encrypted_backlog
+from misc.zigsniff_keys import decrypted, tshark_key_options
+
+
+def native_file_capture(pcap_path: str, path: str, start: int = None, end: int = None, first_number: int = 1, native: bool = True, name: str = "zigsniff_fallback", fallback: str = "pyshark", keyfile: str = "zigbee_pc_keys", offer=None):
+    '''
+    Generator that yields zigbee_packet_dissector results for every frame in the pcap, in frame order.
+
+    First pass dissects everything natively and copies the frames we can not handle (encrypted, unknown layers)
+    into a small fallback pcap. Second pass dissects again and takes the fallback frames from pyshark
+    (or the tshark fields backend when fallback is "fields") in lockstep.
+    Dissecting twice is cheap compared to sending every frame through tshark.
+    Both only get the keys of the PANs that have secured frames in the fallback pcap.
+
+    start, end and first_number limit it to a part of the pcap (see pcap_shard_offsets).
+    With native False every frame goes through the fallback.
+    offer(record, dissector) gets every fallback result with its record, by default the encrypted backlog does.
+    '''
+    fallback_path = os.path.join(path, f"{name}.pcap")
+    fallback_count = 0
+    total_count = 0
+    pans = set()
+
+    with open(fallback_path, 'wb') as fallback_file:
+        for record in read_pcap(pcap_path, start, end, first_number):
+            total_count += 1
+            if not native or zigbee_native_dissector(record) is NATIVE_FALLBACK:
+                if fallback_count == 0:
+                    write_pcap_header(fallback_file, record.linktype)
+                write_pcap_record(fallback_file, record.timestamp, record.data, record.length)
+                fallback_count += 1
+                security = nwk_security(record)
+                if security is not None:
+                    pans.add(security[0])
+
+    report(f"Native dissector handles {total_count - fallback_count} of {total_count} frames, {fallback_count} go through {fallback}", path)
+
+    fallback_capture = None
+    fallback_packets = None
+    if fallback_count:
+        if fallback == "fields":
+            fallback_capture = FieldsCapture(pcap_path=fallback_path, keyfile=keyfile, path=path, pans=sorted(pans))
+        else:
+            import pyshark  # only needed when there is something to fall back to
+            fallback_capture = pyshark.FileCapture(fallback_path, custom_parameters=tshark_key_options(keyfile, sorted(pans), path))
+        fallback_packets = iter(fallback_capture)
+
+    if offer is None:
+        backlog = get_encrypted_backlog(path)
+        if backlog is not None:
+            offer = lambda record, dissector: backlog.offer(record, dissector, pcap_path)
+    try:
+        for record in read_pcap(pcap_path, start, end, first_number):
+            if native:
+                dissector = zigbee_native_dissector(record)
+            else:
+                dissector = NATIVE_FALLBACK
+            if dissector is NATIVE_FALLBACK:
+                if fallback == "fields":
+                    dissector = next(fallback_packets)
+                else:
+                    dissector = zigbee_packet_dissector(next(fallback_packets))
+                if isinstance(dissector, dict):
+                    # the fallback pcap has its own frame numbers
+                    dissector["pkt_number"] = record.number
+                if offer is not None:
+                    offer(record, dissector)
+            yield dissector
+    finally:
+        if fallback_capture is not None:
+            fallback_capture.close()
+        os.remove(fallback_path)
+
+
+def _dissect_shard(shard):
+    '''
+    Runs in a worker process. Dissects one part of the pcap and spools the results to a file for the main process.
+    The encrypted backlog lives in the main process, so fallback frames that did not decrypt are spooled with
+    their record and offered there. Entries are (dissector, record or None).
+    '''
+    pcap_path, path, shard_number, start, end, first_number, native, fallback, keyfile = shard
+    spool_path = os.path.join(path, f"zigsniff_shard_{shard_number}.spool")
+    candidates = []
+
+    def offer(record, dissector):
+        if isinstance(dissector, dict) and not decrypted(dissector):
+            candidates.append(record)
+
+    with open(spool_path, 'wb') as spool:
+        for dissector in native_file_capture(pcap_path, path, start, end, first_number, native, f"zigsniff_fallback_{shard_number}", fallback, keyfile, offer):
+            # offer is called right before the result it belongs to comes out
+            record = candidates.pop() if candidates else None
+            if dissector is not None:
+                pickle.dump((dissector, record), spool, pickle.HIGHEST_PROTOCOL)
+    return spool_path
+
+
+def sharded_file_capture(pcap_path: str, path: str, workers: int, native: bool = True, fallback: str = "pyshark", keyfile: str = "zigbee_pc_keys"):
+    '''
+    Same results as native_file_capture but the pcap is split on record boundaries and the shards are
+    dissected by a pool of worker processes.
+
+    The results are handed back shard by shard in frame order and the main process does all database work.
+    That way the database ends up exactly the same as with a serial run (device rows are created by the first
+    frame that carries the 64 bit address which may very well be in an earlier shard).
+    '''
+    backlog = get_encrypted_backlog(path)
+    shards = pcap_shard_offsets(pcap_path, workers)
+    report(f"Split {pcap_path} in {len(shards)} shards for {workers} workers", path)
+    jobs = [(pcap_path, path, shard_number, start, end, first_number, native, fallback, keyfile) for shard_number, (start, end, first_number) in enumerate(shards)]
+
+    with multiprocessing.Pool(workers) as pool:
+        # imap keeps the shard order. we can already store shard 0 while the others are still being dissected
+        for spool_path in pool.imap(_dissect_shard, jobs):
+            try:
+                with open(spool_path, 'rb') as spool:
+                    while True:
+                        try:
+                            dissector, record = pickle.load(spool)
+                        except EOFError:
+                            break
+                        if record is not None and backlog is not None:
+                            backlog.offer(record, dissector, pcap_path)
+                        yield dissector
+            finally:
+                os.remove(spool_path)
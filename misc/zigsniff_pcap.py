@@ -0,0 +1,349 @@
+'''
+    Small pcap / pcapng reader and writer so we do not need tshark just to walk through a capture.
+    Only the parts of the formats that whsniff and wireshark actually write are supported.
+'''
+import io
+import os
+import gzip
+import struct
+from collections import namedtuple
+
+
+LINKTYPE_IEEE802_15_4_WITHFCS = 195  # whsniff writes this one
+LINKTYPE_IEEE802_15_4_NOFCS = 230
+
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+# number is the frame number like wireshark counts them (starting at 1)
+# offset is the byte offset of the record header in the file
+PcapRecord = namedtuple("PcapRecord", ["number", "timestamp", "length", "linktype", "data", "offset"])
+
+
+class PcapError(Exception):
+    pass
+
+
+def pcap_format(pcap_path: str):
+    '''
+    Returns "pcap" or "pcapng" or None when the file is neither.
+    '''
+    with open(pcap_path, 'rb') as file:
+        header = file.read(4)
+    if len(header) < 4:
+        return None
+    if struct.unpack("<I", header)[0] in (PCAP_MAGIC_US, PCAP_MAGIC_NS) or struct.unpack(">I", header)[0] in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+        return "pcap"
+    if struct.unpack("<I", header)[0] == PCAPNG_SHB:
+        return "pcapng"
+    return None
+
+
+def read_pcap_header(handle):
+    '''
+    Reads the 24 byte pcap global header from handle.
+    Returns (endian, time divisor, linktype)
+    '''
+    header = handle.read(24)
+    if len(header) < 24:
+        raise PcapError("Pcap global header is truncated")
+
+    for endian in ("<", ">"):
+        magic = struct.unpack(endian + "I", header[:4])[0]
+        if magic == PCAP_MAGIC_US:
+            divisor = 1000000.0
+            break
+        elif magic == PCAP_MAGIC_NS:
+            divisor = 1000000000.0
+            break
+    else:
+        raise PcapError("Not a pcap file (bad magic)")
+
+    linktype = struct.unpack(endian + "I", header[20:24])[0] & 0xffff
+    return endian, divisor, linktype
+
+
+def _read_pcap_records(handle, endian, divisor, linktype, offset, end, number):
+    record_header = struct.Struct(endian + "IIII")
+    while end is None or offset < end:
+        header = handle.read(16)
+        if len(header) < 16:
+            return
+        ts_sec, ts_frac, incl_len, orig_len = record_header.unpack(header)
+        data = handle.read(incl_len)
+        if len(data) < incl_len:
+            return  # truncated last record, wireshark would also drop it
+        yield PcapRecord(number, ts_sec + ts_frac / divisor, orig_len, linktype, data, offset)
+        offset += 16 + incl_len
+        number += 1
+
+
+def _pcapng_tsresol(options: bytes, endian: str):
+    # walk the idb options looking for if_tsresol (code 9)
+    position = 0
+    while position + 4 <= len(options):
+        code, length = struct.unpack(endian + "HH", options[position:position + 4])
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = options[position + 4]
+            if value & 0x80:
+                return float(2 ** (value & 0x7f))
+            return float(10 ** value)
+        position += 4 + ((length + 3) & ~3)
+    return 1000000.0
+
+
+def _read_pcapng_blocks(handle, offset, end, number, interfaces, endian):
+    '''
+    Walks pcapng blocks and yields packet records. interfaces is a list of (linktype, divisor, snaplen)
+    which is filled when interface blocks are found.
+    '''
+    while end is None or offset < end:
+        header = handle.read(8)
+        if len(header) < 8:
+            return
+        block_type = struct.unpack("<I", header[:4])[0]
+        if block_type == PCAPNG_SHB:
+            # byte order can change per section
+            body_start = handle.read(4)
+            if len(body_start) < 4:
+                return
+            if struct.unpack("<I", body_start)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+                endian = "<"
+            else:
+                endian = ">"
+            block_length = struct.unpack(endian + "I", header[4:8])[0]
+            handle.read(block_length - 12)
+            interfaces.clear()
+            offset += block_length
+            continue
+
+        block_length = struct.unpack(endian + "I", header[4:8])[0]
+        if block_length < 12:
+            raise PcapError(f"Invalid pcapng block length at offset {offset}")
+        body = handle.read(block_length - 8)
+        if len(body) < block_length - 8:
+            return
+        body = body[:-4]  # trailing block length
+
+        if block_type == PCAPNG_IDB:
+            linktype, _, snaplen = struct.unpack(endian + "HHI", body[:8])
+            interfaces.append((linktype, _pcapng_tsresol(body[8:], endian), snaplen))
+        elif block_type == PCAPNG_EPB:
+            interface_id, ts_high, ts_low, cap_len, orig_len = struct.unpack(endian + "IIIII", body[:20])
+            linktype, divisor, _ = interfaces[interface_id]
+            yield PcapRecord(number, ((ts_high << 32) | ts_low) / divisor, orig_len, linktype, body[20:20 + cap_len], offset)
+            number += 1
+        elif block_type == PCAPNG_SPB:
+            orig_len = struct.unpack(endian + "I", body[:4])[0]
+            linktype, _, snaplen = interfaces[0]
+            cap_len = min(orig_len, snaplen) if snaplen else orig_len
+            # simple packet blocks carry no timestamp
+            yield PcapRecord(number, 0.0, orig_len, linktype, body[4:4 + cap_len], offset)
+            number += 1
+        offset += block_length
+
+
+def read_pcap(pcap_path: str, start: int = None, end: int = None, first_number: int = 1):
+    '''
+    Generator that yields a PcapRecord for every packet in a pcap or pcapng file.
+    start and end are byte offsets of record boundaries and first_number
+    is the frame number of the record at start. Leave them empty to read the whole file.
+    '''
+    file_format = pcap_format(pcap_path)
+    with open(pcap_path, 'rb') as handle:
+        if file_format == "pcap":
+            endian, divisor, linktype = read_pcap_header(handle)
+            offset = 24
+            if start is not None:
+                handle.seek(start)
+                offset = start
+            yield from _read_pcap_records(handle, endian, divisor, linktype, offset, end, first_number)
+
+        elif file_format == "pcapng":
+            if start is not None:
+                # the section and interface blocks are in front of the first packet, we need them for the linktypes
+                endian, interfaces = _read_pcapng_preamble(handle)
+                handle.seek(start)
+                yield from _read_pcapng_blocks(handle, start, end, first_number, interfaces, endian)
+            else:
+                yield from _read_pcapng_blocks(handle, 0, end, first_number, [], "<")
+        else:
+            raise PcapError(f"{pcap_path} is not a pcap or pcapng file")
+
+
+def _read_pcapng_preamble(handle):
+    '''
+    Reads the section header and interface blocks at the start of a pcapng file.
+    Returns (endian, interfaces)
+    '''
+    handle.seek(8)
+    if struct.unpack("<I", handle.read(4))[0] == PCAPNG_BYTE_ORDER_MAGIC:
+        endian = "<"
+    else:
+        endian = ">"
+    handle.seek(4)
+    offset = struct.unpack(endian + "I", handle.read(4))[0]
+    interfaces = []
+    while True:
+        handle.seek(offset)
+        header = handle.read(8)
+        if len(header) < 8:
+            break
+        block_type, block_length = struct.unpack(endian + "II", header)
+        if block_type != PCAPNG_IDB:
+            break
+        body = handle.read(block_length - 12)
+        linktype, _, snaplen = struct.unpack(endian + "HHI", body[:8])
+        interfaces.append((linktype, _pcapng_tsresol(body[8:], endian), snaplen))
+        offset += block_length
+    return endian, interfaces
+
+
+def read_pcap_stream(handle, first_number: int = 1):
+    '''
+    Same as read_pcap but for a pipe or fifo (classic pcap only, that is what whsniff writes).
+    Blocks while waiting for data and stops when the writer closes the stream.
+    '''
+    endian, divisor, linktype = read_pcap_header(handle)
+    yield from _read_pcap_records(handle, endian, divisor, linktype, 24, None, first_number)
+
+
+class PcapStreamParser:
+    '''
+    Same as read_pcap_stream for a stream that is handed to us in pieces of any size (asyncio reads).
+    feed returns the records that are complete now, the rest waits for the next piece.
+    '''
+    def __init__(self, first_number: int = 1):
+        self.buffer = bytearray()
+        self.header = None  # (endian, divisor, linktype)
+        self.record_header = None
+        self.number = first_number
+        self.offset = 24
+
+    def feed(self, data):
+        self.buffer += data
+        records = []
+        position = 0
+        if self.header is None:
+            if len(self.buffer) < 24:
+                return records
+            self.header = read_pcap_header(io.BytesIO(self.buffer[:24]))
+            self.record_header = struct.Struct(self.header[0] + "IIII")
+            position = 24
+        _, divisor, linktype = self.header
+        size = len(self.buffer)
+        while position + 16 <= size:
+            ts_sec, ts_frac, incl_len, orig_len = self.record_header.unpack_from(self.buffer, position)
+            if position + 16 + incl_len > size:
+                break
+            records.append(PcapRecord(self.number, ts_sec + ts_frac / divisor, orig_len, linktype, bytes(self.buffer[position + 16:position + 16 + incl_len]), self.offset))
+            position += 16 + incl_len
+            self.offset += 16 + incl_len
+            self.number += 1
+        del self.buffer[:position]
+        return records
+
+
+def read_pcap_at(pcap_path: str, offsets):
+    '''
+    Yields the PcapRecord at every byte offset (as in PcapRecord.offset) without walking the rest of the file.
+    A gzipped capture works too, give offsets in increasing order for those. number is 0, we do not know it here.
+    '''
+    opener = gzip.open if pcap_path.endswith(".gz") else open
+    with opener(pcap_path, 'rb') as handle:
+        magic = struct.unpack("<I", handle.read(4))[0]
+        handle.seek(0)
+        if magic == PCAPNG_SHB:
+            endian, interfaces = _read_pcapng_preamble(handle)
+            for offset in offsets:
+                handle.seek(offset)
+                yield from _read_pcapng_blocks(handle, offset, offset + 1, 0, interfaces, endian)
+        else:
+            endian, divisor, linktype = read_pcap_header(handle)
+            for offset in offsets:
+                handle.seek(offset)
+                yield from _read_pcap_records(handle, endian, divisor, linktype, offset, offset + 1, 0)
+
+
+def write_pcap_header(handle, linktype: int = LINKTYPE_IEEE802_15_4_WITHFCS, snaplen: int = 65535):
+    handle.write(struct.pack("<IHHiIII", PCAP_MAGIC_US, 2, 4, 0, 0, snaplen, linktype))
+
+
+def write_pcap_record(handle, timestamp: float, data: bytes, length: int = None):
+    if length is None:
+        length = len(data)
+    ts_sec = int(timestamp)
+    ts_usec = int(round((timestamp - ts_sec) * 1000000))
+    if ts_usec >= 1000000:
+        ts_sec += 1
+        ts_usec -= 1000000
+    handle.write(struct.pack("<IIII", ts_sec, ts_usec, len(data), length))
+    handle.write(data)
+
+
+def record_offsets(pcap_path: str):
+    '''
+    Yields the byte offset of every packet record without reading the packet data.
+    '''
+    file_format = pcap_format(pcap_path)
+    with open(pcap_path, 'rb') as handle:
+        if file_format == "pcap":
+            endian, _, _ = read_pcap_header(handle)
+            offset = 24
+            while True:
+                header = handle.read(16)
+                if len(header) < 16:
+                    return
+                incl_len = struct.unpack(endian + "I", header[8:12])[0]
+                yield offset
+                offset += 16 + incl_len
+                handle.seek(offset)
+        elif file_format == "pcapng":
+            endian, _ = _read_pcapng_preamble(handle)
+            handle.seek(0)
+            offset = 0
+            while True:
+                header = handle.read(8)
+                if len(header) < 8:
+                    return
+                block_type, block_length = struct.unpack(endian + "II", header)
+                if block_length < 12:
+                    return
+                if block_type in (PCAPNG_EPB, PCAPNG_SPB):
+                    yield offset
+                offset += block_length
+                handle.seek(offset)
+        else:
+            raise PcapError(f"{pcap_path} is not a pcap or pcapng file")
+
+
+def pcap_shard_offsets(pcap_path: str, shards: int):
+    '''
+    Splits a capture in roughly equal parts on record boundaries.
+    Returns a list of (start, end, first_number) to feed to read_pcap. end is None for the last shard.
+    '''
+    file_size = os.path.getsize(pcap_path)
+    boundaries = []
+    target = 0
+    for number, offset in enumerate(record_offsets(pcap_path), start=1):
+        if offset >= target:
+            boundaries.append((offset, number))
+            target = file_size * len(boundaries) // shards
+            if len(boundaries) == shards:
+                break
+
+    result = []
+    for index, (start, first_number) in enumerate(boundaries):
+        if index + 1 < len(boundaries):
+            end = boundaries[index + 1][0]
+        else:
+            end = None
+        result.append((start, end, first_number))
+    return result
@@ -0,0 +1,242 @@
+'''
+    Staged live pipeline, so a slow store flush or disk never holds up reading the capture:
+
+        whsniff -> WhsniffReader -> reader thread -> frame queue -> dissector workers -> result queue -> store writer
+                                                                 \-> fallback (tshark) /
+
+    The reader thread splits the pcap stream into records and puts them in the bounded frame queue. When that
+    queue is full the policy decides:
+    - "block": wait for the workers. The pipe to WhsniffReader fills up and in the end whsniff itself waits.
+    - "drop_oldest": throw away the oldest waiting frame, the newest ones are the interesting ones on a live sensor.
+    - "shed": from shed_watermark of the queue on frames of a shed_kinds kind (beacons, acks) are dropped right
+      away, everything else still waits.
+    Dissector workers run the native dissector. What it can not handle (encrypted frames and so on) is written to
+    a pipe that the fallback capture (pyshark or tshark fields) reads in its own thread.
+    The results queue is bounded too and always blocks. Whoever iterates the pipeline is the store writer and the
+    only one that touches the store, in zigsniff.py that is the main thread.
+
+    Frames come out in capture order with one worker, frames from the fallback come out a little later than
+    their neighbours. Every frame keeps the number it has in the archive and the archive locates frames in any
+    order (as long as they are within its track_positions), so the packet index gets the fallback frames too.
+'''
+import io
+import os
+import time
+import queue
+import threading
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_metrics import get_metrics
+from misc.zigsniff_backlog import get_encrypted_backlog
+from misc.zigsniff_pcap import read_pcap_stream, write_pcap_header, write_pcap_record, LINKTYPE_IEEE802_15_4_WITHFCS, LINKTYPE_IEEE802_15_4_NOFCS
+from zigbee_native_dissector import zigbee_native_dissector, NATIVE_FALLBACK
+
+POLICIES = ("block", "drop_oldest", "shed")
+
+# 802.15.4 frame type, the lowest 3 bits of the frame control field
+FRAME_KINDS = {0: "beacon", 1: "data", 2: "ack", 3: "command"}
+
+_DONE = object()
+
+
+def frame_kind(record):
+    '''
+    "beacon", "data", "ack", "command" or None when we can not tell (other linktype, reserved frame type).
+    '''
+    if record.linktype not in (LINKTYPE_IEEE802_15_4_WITHFCS, LINKTYPE_IEEE802_15_4_NOFCS) or not record.data:
+        return None
+    return FRAME_KINDS.get(record.data[0] & 0x07)
+
+
+class LivePipeline:
+    def __init__(self, pipe, path: str, fallback_capture, queue_size: int = 2000, result_queue_size: int = 2000, policy: str = "block",
+                 shed_kinds: list = ("beacon", "ack"), shed_watermark: float = 0.8, workers: int = 1, channel: int = None, pcap_path: str = None):
+        '''
+        pipe is the read end of the capture (WhsniffReader.pipe). fallback_capture(pipe) returns an iterator of
+        zigbee_packet_dissector results for the frames written to pipe, like live_capture in zigsniff.py.
+        channel and pcap_path are only needed for the encrypted backlog (misc.zigsniff_backlog).
+        '''
+        if policy not in POLICIES:
+            report(f"Unknown pipeline policy {policy}, using block", path)
+            policy = "block"
+        self.pipe = pipe
+        self.path = path
+        self.fallback_capture = fallback_capture
+        self.channel = channel
+        self.pcap_path = pcap_path
+        self.policy = policy
+        self.shed_kinds = set(shed_kinds)
+        self.shed_depth = max(int(queue_size * shed_watermark), 1)
+        self.workers = max(int(workers), 1)
+        self.frames = queue.Queue(queue_size)
+        self.results = queue.Queue(result_queue_size)
+        self.metrics = get_metrics(path)
+        self.lock = threading.Lock()
+        self.dropped = {"oldest": 0, "shed": 0, "fallback": 0}
+        self.high_water = {"frames": 0, "results": 0}
+        # the fallback only starts when the first frame needs it
+        self.fallback_lock = threading.Lock()
+        self.fallback_fd = None
+        self.fallback_records = None
+        self.fallback_started = False
+        self.workers_running = self.workers
+        self.threads = []
+
+        for name, pipeline_queue in (("frames", self.frames), ("results", self.results)):
+            self.metrics.gauge("zigsniff_queue_depth", pipeline_queue.qsize, queue=name)
+            self.metrics.gauge("zigsniff_queue_capacity", lambda size=pipeline_queue.maxsize: size, queue=name)
+
+    def start(self):
+        self.threads.append(threading.Thread(target=self._reader, name="zigsniff_pipeline_reader", daemon=True))
+        for number in range(self.workers):
+            self.threads.append(threading.Thread(target=self._dissector_worker, name=f"zigsniff_pipeline_worker_{number}", daemon=True))
+        for thread in self.threads:
+            thread.start()
+        report(f"Live pipeline: {self.workers} dissector workers, frame queue of {self.frames.maxsize} ({self.policy}), result queue of {self.results.maxsize}", self.path)
+        return self
+
+    def _drop(self, reason: str):
+        with self.lock:
+            self.dropped[reason] += 1
+        self.metrics.count("zigsniff_queue_dropped_total", reason=reason)
+
+    def _put_frame(self, record):
+        depth = self.frames.qsize()
+        if depth > self.high_water["frames"]:
+            self.high_water["frames"] = depth
+        if self.policy == "shed" and depth >= self.shed_depth and frame_kind(record) in self.shed_kinds:
+            self._drop("shed")
+            return
+        if self.policy == "drop_oldest":
+            # we are the only one putting frames, so once there is room it stays there until our put
+            while True:
+                try:
+                    self.frames.put_nowait(record)
+                    return
+                except queue.Full:
+                    try:
+                        self.frames.get_nowait()
+                        self._drop("oldest")
+                    except queue.Empty:
+                        pass
+        self.frames.put(record)
+
+    def _put_result(self, dissector):
+        depth = self.results.qsize()
+        if depth > self.high_water["results"]:
+            self.high_water["results"] = depth
+        self.results.put(dissector)
+
+    def _reader(self):
+        try:
+            for record in read_pcap_stream(self.pipe):
+                self._put_frame(record)
+        except Exception as e:
+            report(f"Live pipeline: reading the capture stopped: {e}", self.path)
+        finally:
+            for _ in range(self.workers):
+                self.frames.put(_DONE)
+
+    def _dissector_worker(self):
+        try:
+            while True:
+                record = self.frames.get()
+                if record is _DONE:
+                    break
+                started = time.perf_counter()
+                dissector = zigbee_native_dissector(record)
+                self.metrics.observe("zigsniff_stage_seconds", time.perf_counter() - started, stage="dissect")
+                if dissector is NATIVE_FALLBACK:
+                    self._to_fallback(record)
+                else:
+                    self._put_result(dissector)
+        except Exception as e:
+            report(f"Live pipeline: dissector worker stopped: {e}", self.path)
+        finally:
+            with self.fallback_lock:
+                self.workers_running -= 1
+                if self.workers_running == 0 and self.fallback_fd is not None:
+                    os.close(self.fallback_fd)  # the fallback capture sees the end and finishes
+                    self.fallback_fd = None
+            self._put_result(_DONE)
+
+    def _to_fallback(self, record):
+        with self.fallback_lock:
+            if not self.fallback_started:
+                self._start_fallback(record.linktype)
+            if self.fallback_fd is None:
+                self._drop("fallback")
+                return
+            buffer = io.BytesIO()
+            write_pcap_record(buffer, record.timestamp, record.data, record.length)
+            self.fallback_records.put(record)
+            try:
+                self._write_fallback(buffer.getvalue())
+            except OSError as e:
+                # the fallback capture is gone, from now on these frames are lost
+                report(f"Live pipeline: can not hand frames to the fallback anymore: {e}", self.path)
+                os.close(self.fallback_fd)
+                self.fallback_fd = None
+                self._drop("fallback")
+
+    def _write_fallback(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fallback_fd, view)
+            view = view[written:]
+
+    def _start_fallback(self, linktype: int):
+        read_fd, self.fallback_fd = os.pipe()
+        self.fallback_records = queue.SimpleQueue()
+        self.fallback_started = True
+        buffer = io.BytesIO()
+        write_pcap_header(buffer, linktype)
+        self._write_fallback(buffer.getvalue())
+        thread = threading.Thread(target=self._fallback, args=(os.fdopen(read_fd, 'rb'),), name="zigsniff_pipeline_fallback", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _fallback(self, pipe):
+        backlog = get_encrypted_backlog(self.path)
+        try:
+            with pipe:
+                for dissector in self.metrics.timed(self.fallback_capture(pipe), "capture"):
+                    # the fallback counts its own frames, we want the number in the archive
+                    record = self.fallback_records.get()
+                    if isinstance(dissector, dict):
+                        dissector["pkt_number"] = record.number
+                    if backlog is not None:
+                        backlog.offer(record, dissector, self.pcap_path, self.channel)
+                    self._put_result(dissector)
+        except Exception as e:
+            report(f"Live pipeline: fallback stopped: {e}", self.path)
+        finally:
+            self._put_result(_DONE)
+
+    def __iter__(self):
+        '''
+        Yields dissector results until the capture ended and everything in the queues is handed out.
+        '''
+        finished = 0
+        while True:
+            dissector = self.results.get()
+            if dissector is not _DONE:
+                yield dissector
+                continue
+            finished += 1
+            # a worker starts the fallback before it is done, so after the last worker we know if there is one
+            if finished >= self.workers + (1 if self.fallback_started else 0):
+                return
+
+    def report(self, path: str = None):
+        '''
+        Queue depths, the highest depth since the last report and what was dropped.
+        '''
+        path = path if path is not None else self.path
+        with self.lock:
+            dropped = dict(self.dropped)
+        high_water = dict(self.high_water)
+        self.high_water = {"frames": 0, "results": 0}
+        report(f"Live pipeline: frames {self.frames.qsize()}/{self.frames.maxsize} (max {high_water['frames']}), "
+               f"results {self.results.qsize()}/{self.results.maxsize} (max {high_water['results']}), "
+               f"dropped {dropped['oldest']} oldest, {dropped['shed']} shed and {dropped['fallback']} for the fallback", path)
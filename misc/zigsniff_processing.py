@@ -0,0 +1,98 @@
+import time
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_sqlite import nwk_add_dev_to_devices, match_nwk_addresses, wpan_add_dev_to_devices, match_wpan_addresses, parse_the_rest
+from misc.zigsniff_detections import zigbee_detections
+from misc.zigsniff_store import get_device_store
+from misc.zigsniff_index import get_packet_index
+from misc.zigsniff_metrics import get_metrics
+from misc.zigsniff_keys import get_key_registry
+from misc.zigsniff_duplicates import get_duplicate_filter
+from misc.zigsniff_backlog import get_encrypted_backlog
+
+
+def process_dissector(dissector, channel: int, pcap: str, output: str):
+    '''
+    Takes the result of zigbee_packet_dissector and puts it in the database and through the detections.
+    Same for live capture and offline pcaps so keep it that way.
+    '''
+    metrics = get_metrics(output)
+    metrics.count("zigsniff_frames_total")
+    if dissector is not None and not isinstance(dissector, str):
+        started = time.perf_counter()
+        dissector['channel'] = int(channel)  # We have a packet and we add a channel to the output.
+
+        # secured frames and beacons tell the key registry which key belongs to which PAN
+        if "key_id" in dissector or "ext_pan_id" in dissector:
+            get_key_registry(output).observe(dissector)
+
+        # a copy of a NWK frame we already had (relayed or retransmitted) only adds its WPAN hop
+        duplicates = get_duplicate_filter(output)
+        duplicate = duplicates is not None and duplicates.seen(dissector)
+
+        # First we need to make sure the device exists in the database. so we add it
+        if not duplicate and ("nwk_mac_src" in dissector or "nwk_sec_src" in dissector):
+            if "nwk_mac_src" not in dissector:
+                dissector["nwk_mac_src"] = dissector["nwk_sec_src"]
+            nwk_add_dev_to_devices(dissector, output)
+            try:
+                # then we add all logical addresses to the database   ????
+                match_nwk_addresses(dissector["nwk_mac_src"], dissector["nwk_addr_src"], dissector["pan_dst"], dissector["nwk_addr_dst"], output)
+            except KeyError as e:
+                report(f"Added record to database error: {e}", output)
+
+        # if a device on logical level does not exist we can still add it from the wpan layer. but will have less details at start.
+        if "wpan_mac_src" in dissector:
+            wpan_add_dev_to_devices(dissector, output)
+
+        # adding all wpan destination addresses to a device entry so we see on wpan layer to what devices a device is communicating with.
+        if "wpan_addr_src" in dissector and "pan_dst" in dissector and "wpan_addr_dst" in dissector:
+            try:
+                match_wpan_addresses(dissector["wpan_addr_src"], dissector["pan_dst"], dissector["wpan_addr_dst"], output)
+            except KeyError as e:
+                report("Error in main wpan adding to database: " + str(e), output)
+
+        # Here we feed it to a module that adds small details to the database to make more sense of a device's capabilities
+        # May also help identify its purpose and functionality
+        if not duplicate and "nwk_addr_src" in dissector:
+            parse_the_rest(dissector, output)
+        stored = time.perf_counter()
+        metrics.observe("zigsniff_stage_seconds", stored - started, stage="store")
+
+        # If a specific packet is discovered we want to generate a message (might).
+        # these packets are flagged with detection = 1. this indicates it has important information to create a .zmessage file.
+        if dissector["detection"] == 1 and not duplicate:
+            dissector["pcap"] = str(pcap)  # add pcap name
+            zigbee_detections(dissector, output)
+        detected = time.perf_counter()
+        metrics.observe("zigsniff_stage_seconds", detected - stored, stage="detections")
+
+        # remember where this frame is so zigsniff_extract.py can find it again
+        index = get_packet_index(output)
+        if index is not None:
+            index.add(dissector, pcap, get_device_store(output))
+            metrics.observe("zigsniff_stage_seconds", time.perf_counter() - detected, stage="index")
+
+        # lets the write-behind flusher know another packet went into the store
+        get_device_store(output).packet_done()
+
+    elif isinstance(dissector, str):
+        metrics.count("zigsniff_dissector_errors_total")
+        # if it is an error please write it to file
+        # one message, so lines from other threads can not end up between the banners
+        report(f"-Error in Zigbee dissector----------------------------------------------------------------\n"
+               f"{dissector}\n"
+               f"-End of error in Zigbee dissector---------------------------------------------------------", output)
+    else:
+        metrics.count("zigsniff_dissector_empty_total")
+
+
+def process_decrypted(output: str):
+    '''
+    Stores the frames the encrypted backlog decrypted in its retry thread. Called by whoever calls
+    process_dissector, so all of it stays on the thread that owns ingest. Returns how many frames there were.
+    '''
+    backlog = get_encrypted_backlog(output)
+    if backlog is None:
+        return 0
+    return backlog.drain(lambda dissector, channel, pcap: process_dissector(dissector, channel, pcap, output))
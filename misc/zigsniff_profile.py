@@ -0,0 +1,164 @@
+'''
+    --profile. A sampler thread looks at the stacks of all threads every interval_ms and counts them, that costs
+    next to nothing so it also runs on live sensors. Offline runs additionally get cProfile (deterministic) on
+    the main thread.
+
+    Every sample is put under the stage it was taken in (dissect, store, detections, index, db_flush, report,
+    sink, capture, other, idle for threads that wait) so the output can be cut per stage. Written to the output directory on exit and on
+    SIGUSR1 (the run keeps going):
+    - zigsniff_profile_<time>.collapsed: "stage;thread;function;function... samples", ready for flamegraph.pl or speedscope
+    - zigsniff_profile_<time>_top.txt: time per stage and the top functions by own and total samples (and cProfile's top offline)
+    - zigsniff_profile_<time>.pstats: the raw cProfile data (offline only), snakeviz or flameprof read it
+'''
+import io
+import os
+import sys
+import time
+import atexit
+import pstats
+import signal
+import cProfile
+import threading
+
+from misc.zigsniff_utilities import report
+
+# (function name, file name) or function name -> stage. The innermost match of a stack wins.
+STAGE_FUNCTIONS = {
+    "zigbee_packet_dissector": "dissect",
+    "zigbee_native_dissector": "dissect",
+    "fields_dissector": "dissect",
+    "nwk_add_dev_to_devices": "store",
+    "match_nwk_addresses": "store",
+    "wpan_add_dev_to_devices": "store",
+    "match_wpan_addresses": "store",
+    "parse_the_rest": "store",
+    ("seen", "zigsniff_duplicates.py"): "store",
+    "zigbee_detections": "detections",
+    ("add", "zigsniff_index.py"): "index",
+    ("flush", "zigsniff_index.py"): "index",
+    ("flush", "zigsniff_store.py"): "db_flush",
+    "zigsniff_reporter": "report",
+    ("_writer", "zigsniff_sink.py"): "sink",
+    ("run", "zigsniff_whsniff.py"): "capture",
+    ("_reader", "zigsniff_pipeline.py"): "capture",
+    ("_fallback", "zigsniff_pipeline.py"): "dissect",
+}
+# a thread that sits in one of these is waiting, not working
+IDLE_FUNCTIONS = {("wait", "threading.py"), ("get", "queue.py"), ("select", "selectors.py"), ("dequeue", "handlers.py")}
+
+
+def _stage(stack):
+    '''
+    stack is a list of code objects from the root to the leaf.
+    '''
+    if stack and (stack[-1].co_name, os.path.basename(stack[-1].co_filename)) in IDLE_FUNCTIONS:
+        return "idle"
+    for code in reversed(stack):
+        stage = STAGE_FUNCTIONS.get((code.co_name, os.path.basename(code.co_filename)))
+        if stage is None:
+            stage = STAGE_FUNCTIONS.get(code.co_name)
+        if stage is not None:
+            return stage
+        if "pyshark" in code.co_filename:
+            return "capture"
+    return "other"
+
+
+def _name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profiler:
+    def __init__(self, path: str, deterministic: bool = False, interval_ms: int = 10, top: int = 30):
+        self.path = path
+        self.interval = interval_ms / 1000
+        self.top = top
+        self.lock = threading.Lock()
+        self.samples = {}  # (stage, thread name, code objects from root to leaf) -> samples
+        self.started = time.strftime('%Y-%m-%d_%H-%M-%S')
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, name="zigsniff_profiler", daemon=True)
+        self.cprofile = cProfile.Profile() if deterministic else None
+
+    def start(self):
+        self.thread.start()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+        atexit.register(self.stop)
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.write())
+        report(f"Profiling every {self.interval * 1000:.0f} ms{' with cProfile' if self.cprofile is not None else ''}, kill -USR1 {os.getpid()} writes the profile", self.path)
+        return self
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                key = (_stage(stack), names.get(ident, str(ident)), tuple(stack))
+                with self.lock:
+                    self.samples[key] = self.samples.get(key, 0) + 1
+
+    def _top_text(self, samples: dict):
+        total = sum(samples.values()) or 1
+        stages = {}
+        own = {}
+        inclusive = {}
+        for (stage, thread, stack), count in samples.items():
+            stages[stage] = stages.get(stage, 0) + count
+            if stack:
+                own[stack[-1]] = own.get(stack[-1], 0) + count
+            for code in set(stack):
+                inclusive[code] = inclusive.get(code, 0) + count
+
+        lines = [f"zigsniff profile {self.started} - {time.strftime('%Y-%m-%d_%H-%M-%S')}, {total} samples every {self.interval * 1000:.0f} ms (all threads)", "", "Samples per stage:"]
+        lines += [f"\t{stage:<12}{count:>10}{count * 100 / total:>8.1f}%" for stage, count in sorted(stages.items(), key=lambda item: -item[1])]
+        lines += ["", f"Top {self.top} functions by own samples:"]
+        lines += [f"\t{count:>10}{count * 100 / total:>8.1f}%  {_name(code)}" for code, count in sorted(own.items(), key=lambda item: -item[1])[:self.top]]
+        lines += ["", f"Top {self.top} functions by total samples:"]
+        lines += [f"\t{count:>10}{count * 100 / total:>8.1f}%  {_name(code)}" for code, count in sorted(inclusive.items(), key=lambda item: -item[1])[:self.top]]
+        if self.cprofile is not None:
+            stream = io.StringIO()
+            stats = pstats.Stats(self.cprofile, stream=stream)
+            stats.sort_stats("tottime").print_stats(self.top)
+            stats.sort_stats("cumulative").print_stats(self.top)
+            lines += ["", "cProfile (main thread):", stream.getvalue()]
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        '''
+        Writes the profile so far. Called on exit and on SIGUSR1.
+        '''
+        with self.lock:
+            samples = dict(self.samples)
+        base = os.path.join(self.path, f"zigsniff_profile_{self.started}")
+        if self.cprofile is not None:
+            self.cprofile.disable()  # cProfile only hands out its stats while it is off
+        try:
+            with open(base + ".collapsed", 'w') as file:
+                for (stage, thread, stack), count in sorted(samples.items(), key=lambda item: -item[1]):
+                    frames = ";".join(_name(code).replace(";", ":") for code in stack)
+                    file.write(f"{stage};{thread};{frames} {count}\n")
+            with open(base + "_top.txt", 'w') as file:
+                file.write(self._top_text(samples))
+            if self.cprofile is not None:
+                self.cprofile.dump_stats(base + ".pstats")
+            report(f"Profile written to {base}*", self.path)
+        except OSError as e:
+            report(f"Profile: writing {base} failed: {e}", self.path)
+        if self.cprofile is not None and not self.stopped.is_set():
+            self.cprofile.enable()
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.write()
@@ -0,0 +1,146 @@
+'''
+    Detection sink. write_zigsniff_message hands the detections to a background writer thread that appends
+    them as one json line each to zigsniff_detections_<time>_<n>.ndjson segments in the work directory.
+    A segment is closed when it gets bigger than segment_max_bytes or older than segment_max_seconds
+    and closed segments can be gzipped.
+
+    mode "files" keeps writing one zigsniff_<md5>.zmessage per detection like before, also from the writer thread.
+'''
+import os
+import gzip
+import json
+import time
+import queue
+import atexit
+import shutil
+import hashlib
+import threading
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+_STOP = object()
+
+
+class DetectionSink:
+    def __init__(self, path: str, mode: str = "ndjson", segment_max_bytes: int = 10485760, segment_max_seconds: int = 3600,
+                 flush_interval_ms: int = 1000, fsync: bool = False, compress: bool = True):
+        '''
+        flush_interval_ms 0 flushes after every detection. fsync also syncs the segment to disk on every flush.
+        '''
+        self.path = path
+        self.mode = mode
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_seconds = segment_max_seconds
+        self.flush_interval = flush_interval_ms / 1000
+        self.fsync = fsync
+        self.compress = compress
+        self.queue = queue.Queue()
+        self.segment = None
+        self.segment_path = None
+        self.segment_started = 0
+        self.segment_number = 0
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+        self.thread = threading.Thread(target=self._writer, name="zigsniff_detection_sink", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, message: dict):
+        self.queue.put(message)
+
+    def _open_segment(self):
+        self.segment_number += 1
+        name = f"zigsniff_detections_{time.strftime('%Y-%m-%d_%H-%M-%S')}_{self.segment_number}.ndjson"
+        self.segment_path = os.path.join(self.path, name)
+        self.segment = open(self.segment_path, "a")
+        self.segment_started = time.monotonic()
+
+    def _close_segment(self):
+        if self.segment is None:
+            return
+        self._flush()
+        self.segment.close()
+        self.segment = None
+        if self.compress and os.path.getsize(self.segment_path) > 0:
+            with open(self.segment_path, 'rb') as source, gzip.open(self.segment_path + ".gz", 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.remove(self.segment_path)
+
+    def _flush(self):
+        if self.segment is not None and self.unflushed:
+            self.segment.flush()
+            if self.fsync:
+                os.fsync(self.segment.fileno())
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def _write_file(self, message: dict):
+        # the old one file per detection
+        md5_hash = hashlib.md5()
+        md5_hash.update(str(message).encode('utf-8'))
+        message_path = os.path.join(self.path, f"zigsniff_{md5_hash.hexdigest()}.zmessage")
+        with open(message_path, "a") as file_handle:
+            file_handle.write(json.dumps(message))
+
+    def _write_segment(self, message: dict):
+        if self.segment is not None:
+            if self.segment.tell() >= self.segment_max_bytes or time.monotonic() - self.segment_started >= self.segment_max_seconds:
+                self._close_segment()
+        if self.segment is None:
+            self._open_segment()
+        self.segment.write(json.dumps(message) + "\n")
+        self.unflushed += 1
+        if self.flush_interval == 0:
+            self._flush()
+
+    def _writer(self):
+        from misc.zigsniff_utilities import report  # zigsniff_utilities imports this module
+
+        while True:
+            timeout = None
+            if self.unflushed:
+                timeout = max(0, self.flush_interval - (time.monotonic() - self.last_flush))
+            try:
+                message = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush()
+                continue
+            if message is _STOP:
+                break
+            try:
+                if self.mode == "files":
+                    self._write_file(message)
+                else:
+                    self._write_segment(message)
+            except Exception as e:
+                report(f"Error: Writing a zmessage: {e}", self.path)
+        try:
+            self._close_segment()
+        except Exception as e:
+            report(f"Error: Closing detection segment {self.segment_path}: {e}", self.path)
+
+    def close(self):
+        '''
+        Writes what is still queued and closes the segment.
+        '''
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+
+
+def open_detection_sink(path: str, **settings):
+    '''
+    Opens the sink for the work directory, settings are the arguments of DetectionSink.
+    '''
+    with _sinks_lock:
+        if path not in _sinks:
+            _sinks[path] = DetectionSink(path, **settings)
+        return _sinks[path]
+
+
+def get_detection_sink(path: str):
+    sink = _sinks.get(path)
+    if sink is None:
+        sink = open_detection_sink(path)
+    return sink
@@ -0,0 +1,195 @@
+'''
+    Several capture sources in one zigsniff. Every source has its own channel, fifo and archive pcap and is
+    read and dissected by its own thread. The results go into a queue per source and the main thread takes
+    them round robin and puts them through the one store/detection pipeline.
+
+    A source with "replay" is fake: instead of whsniff a process replays that pcap into the fifo with the
+    timestamps moved to now, so everything can be tried without a dongle.
+'''
+import os
+import time
+import queue
+import atexit
+import threading
+import multiprocessing
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_whsniff import fifo_available, terminate_whsniff_process, WhsniffReader
+from misc.zigsniff_archive import open_pcap_archive
+from misc.zigsniff_pcap import read_pcap, write_pcap_header, write_pcap_record
+
+_SOURCE_DONE = object()
+
+
+class CaptureSource:
+    def __init__(self, channel: int, fifo_path: str, pcap_path: str, command: str = None, replay: str = None, replay_speed: float = 1.0, name: str = None, pans: list = None):
+        self.channel = int(channel)
+        self.pans = pans  # PANs on this source, the tshark fields backend only gets their keys
+        self.fifo_path = fifo_path
+        self.pcap_path = pcap_path
+        self.command = command
+        self.replay = replay
+        self.replay_speed = replay_speed
+        self.name = name if name is not None else f"channel_{self.channel}"
+        self.process = None
+        self.reader = None
+
+    def start(self, path: str):
+        if self.replay is not None:
+            self.process = start_replay_process(self.channel, self.fifo_path, self.pcap_path, self.replay, self.replay_speed, path)
+        else:
+            # whsniff is read by a thread in this process, so its archive can tell the packet index where frames are
+            self.reader = WhsniffReader(self.channel, self.pcap_path, path, self.command, self.fifo_path).start()
+
+    def locate(self, number: int):
+        '''
+        Where frame number of this source is archived, see PcapArchive.locate. Replays are not tracked.
+        '''
+        if self.reader is None:
+            return None
+        return self.reader.archive.locate(number)
+
+
+def sources_from_config(sources: list, output: str):
+    '''
+    Builds the CaptureSources of the "sources" list in zigsniff_config.json.
+    '''
+    capture_sources = []
+    start = time.time()
+    for source in sources:
+        channel = int(source["channel"])
+        fifo_path = source.get("fifo_path", f"/tmp/zigsniff_{channel}")
+        pcap_path = os.path.join(output, f"capture_{start}_{channel}.pcap")
+        capture_sources.append(CaptureSource(channel, fifo_path, pcap_path, source.get("command"), source.get("replay"), source.get("replay_speed", 1.0), source.get("name"), source.get("pans")))
+    return capture_sources
+
+
+def run_replay(channel: int, fifo_path: str, pcap_path: str, replay: str, speed: float, path: str):
+    '''
+    Fake capture source. Writes the frames of the replay pcap into the fifo (and the archive pcap) like whsniff would.
+    speed 1.0 keeps the original timing, 0 goes as fast as the reader takes it.
+    '''
+    if fifo_available(fifo_path, path) == 1:
+        exit()
+    report(f"Replaying {replay} on channel {channel} into {fifo_path}", path)
+    try:
+        with open(fifo_path, 'wb') as fifo, open_pcap_archive(pcap_path, path) as archive:
+            header_written = False
+            first = None
+            started = time.time()
+            for record in read_pcap(replay):
+                if not header_written:
+                    write_pcap_header(fifo, record.linktype)
+                    write_pcap_header(archive, record.linktype)
+                    header_written = True
+                if first is None:
+                    first = record.timestamp
+                if speed > 0:
+                    delay = (record.timestamp - first) / speed - (time.time() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                now = time.time()
+                write_pcap_record(fifo, now, record.data, record.length)
+                write_pcap_record(archive, now, record.data, record.length)
+                fifo.flush()
+    except BrokenPipeError:
+        pass
+    report(f"Replay of {replay} on channel {channel} done", path)
+
+
+def start_replay_process(channel: int, fifo_path: str, pcap_path: str, replay: str, speed: float, path: str) -> multiprocessing.Process:
+    process = multiprocessing.Process(target=run_replay, args=(channel, fifo_path, pcap_path, replay, speed, path))
+    process.start()
+    atexit.register(lambda: terminate_whsniff_process(process))
+    return process
+
+
+class ChannelCounters:
+    '''
+    Frames per channel: read from the source, dissected into something useful and handed to the store.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.last_report = time.monotonic()
+        self.last_counters = {}
+
+    def count(self, channel: int, counter: str, amount: int = 1):
+        with self.lock:
+            counters = self.counters.setdefault(channel, {"frames": 0, "dissected": 0, "errors": 0, "stored": 0})
+            counters[counter] += amount
+
+    def snapshot(self):
+        with self.lock:
+            return {channel: dict(counters) for channel, counters in self.counters.items()}
+
+    def report(self, path: str):
+        '''
+        Reports the totals and the frames per second since the last report for every channel.
+        '''
+        now = time.monotonic()
+        elapsed = max(now - self.last_report, 0.001)
+        snapshot = self.snapshot()
+        for channel, counters in sorted(snapshot.items()):
+            previous = self.last_counters.get(channel, {}).get("frames", 0)
+            rate = (counters["frames"] - previous) / elapsed
+            report(f"channel {channel}: {counters['frames']} frames ({rate:.1f}/s), {counters['dissected']} dissected, {counters['errors']} errors, {counters['stored']} stored", path)
+        self.last_report = now
+        self.last_counters = snapshot
+
+
+def _read_source(source: CaptureSource, capture_factory, source_queue: queue.Queue, available: threading.Semaphore, counters: ChannelCounters, path: str):
+    '''
+    Reader thread of one source. capture_factory(fifo, pans) returns an iterator of zigbee_packet_dissector results.
+    '''
+    try:
+        with open(source.fifo_path, 'rb') as fifo:
+            for dissector in capture_factory(fifo, source.pans):
+                counters.count(source.channel, "frames")
+                if isinstance(dissector, str):
+                    counters.count(source.channel, "errors")
+                elif dissector is not None:
+                    counters.count(source.channel, "dissected")
+                source_queue.put(dissector)
+                available.release()
+    except Exception as e:
+        report(f"Source {source.name} stopped: {e}", path)
+    finally:
+        source_queue.put(_SOURCE_DONE)
+        available.release()
+
+
+def multi_source_capture(sources: list, capture_factory, counters: ChannelCounters, path: str, queue_size: int = 1000):
+    '''
+    Starts every source and its reader thread and yields (source, dissector) round robin over the per source queues
+    until all sources are done. A full queue blocks only the reader of that source.
+    '''
+    queues = [queue.Queue(queue_size) for _ in sources]
+    available = threading.Semaphore(0)
+
+    for source, source_queue in zip(sources, queues):
+        if not os.path.exists(source.fifo_path):
+            fifo_available(source.fifo_path, path)
+        source.start(path)
+        thread = threading.Thread(target=_read_source, args=(source, capture_factory, source_queue, available, counters, path), name=f"zigsniff_{source.name}", daemon=True)
+        thread.start()
+        report(f"Source {source.name} started on channel {source.channel} ({source.fifo_path})", path)
+
+    running = len(sources)
+    index = 0
+    while running:
+        available.acquire()
+        # there is at least one item, take it from the next queue that has something
+        for _ in range(len(queues)):
+            source, source_queue = sources[index], queues[index]
+            index = (index + 1) % len(queues)
+            try:
+                dissector = source_queue.get_nowait()
+            except queue.Empty:
+                continue
+            if dissector is _SOURCE_DONE:
+                running -= 1
+                report(f"Source {source.name} on channel {source.channel} is done", path)
+            else:
+                yield source, dissector
+            break
@@ -0,0 +1,90 @@
+'''
+    Last known state per device (the sticky_note column) so the detections can tell in O(1) if a state changed.
+    Chatty sensors repeat the same state many times a minute and only a change should make a .zmessage.
+
+    The cache keeps the parsed notes of the most recently used devices. A change is written through to the
+    device in the store as a string, so the store flusher persists it like any other column.
+'''
+import ast
+import threading
+from collections import OrderedDict
+
+from misc.zigsniff_store import get_device_store
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def parse_sticky_note(value):
+    if value is None:
+        return None
+    if value == "empty":
+        return {}
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return None
+
+
+class StickyNoteCache:
+    def __init__(self, store, size: int = 4096):
+        self.store = store
+        self.size = size
+        self.notes = OrderedDict()  # device_mac_address -> parsed sticky note, least recently used first
+        self.warm()
+
+    def warm(self):
+        '''
+        Fills the cache with the devices that were seen last.
+        '''
+        with self.store.lock:
+            devices = sorted(self.store.devices.values(), key=lambda device: device["last_time_seen"] or 0, reverse=True)
+            for device in reversed(devices[:self.size]):
+                self.note(device)
+
+    def note(self, device):
+        '''
+        The parsed sticky note of a device or None when it can not be parsed. Hold the store lock.
+        '''
+        mac = device["device_mac_address"]
+        note = self.notes.get(mac)
+        if note is not None:
+            self.notes.move_to_end(mac)
+            return note
+        note = parse_sticky_note(device["sticky_note"])
+        if note is not None:
+            self.notes[mac] = note
+            if len(self.notes) > self.size:
+                self.notes.popitem(last=False)
+        return note
+
+    def changed(self, device, field, value):
+        '''
+        Remembers value for field and returns True when it differs from what we had. None when the note is broken.
+        '''
+        with self.store.lock:
+            note = self.note(device)
+            if note is None:
+                return None
+            if field in note and note[field] == value:
+                return False
+            note[field] = value
+            self.store.update(device, sticky_note=str(note))
+            return True
+
+
+def open_sticky_note_cache(path: str, size: int = 4096):
+    '''
+    Opens the cache for the work directory. Call it after open_device_store.
+    '''
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = StickyNoteCache(get_device_store(path), size)
+        return _caches[path]
+
+
+def get_sticky_note_cache(path: str):
+    cache = _caches.get(path)
+    if cache is None:
+        cache = open_sticky_note_cache(path)
+    return cache
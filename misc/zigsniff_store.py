@@ -0,0 +1,287 @@
+'''
+    In memory copy of the devices table. The zigsniff_sqlite functions update the devices in here and a
+    write-behind flusher writes the changed devices to zigsniff_database.db in one transaction
+    every flush_interval ms or every flush_packets packets, whatever comes first.
+    The database is only read once when the store is opened.
+
+    Address lists, talk partners, capabilities and clusters live in child tables. In memory they are dicts,
+    for the lists the keys are the entries (an ordered set) so checking for a known peer is O(1).
+    Only new or changed entries are written.
+'''
+import time
+import atexit
+import sqlite3
+import threading
+
+from misc.zigsniff_utilities import report
+from misc.zigsniff_database import get_database, child_upsert_query, CHILD_LISTS, CHILD_COLUMNS
+from misc.zigsniff_metrics import get_metrics
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class DeviceStore:
+    '''
+    Devices are plain dicts with the column names of the devices table as keys.
+    Change columns with update, the child table columns with add_to_list and update_dict.
+    Hold the lock while reading or changing a device, the flusher runs in its own thread.
+    '''
+    def __init__(self, path: str, flush_interval: int = 1000, flush_packets: int = 500):
+        self.path = path
+        self.database = get_database(path)
+        self.sqlite = self.database.sqlite
+        self.flush_interval = flush_interval / 1000
+        self.flush_packets = flush_packets
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.devices = {}  # device_mac_address -> device
+        self.by_src_net_address = {}  # first device (lowest id) that uses a src net address
+        self.dirty = set()  # device_mac_address of the devices that changed since the last flush
+        self.report_dirty = {}  # device_mac_address -> columns that changed since the last report_changes
+        self.columns = []
+        self.row_columns = []  # the columns that are still written to the devices table
+        self.pending = {column: {} for column in CHILD_COLUMNS}  # child rows that still have to be written
+        self.next_id = 1
+        self.packets = 0
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.load()
+
+    def load(self):
+        self.columns, rows = self.database.query('''SELECT * FROM devices ORDER BY id;''')
+        self.row_columns = [column for column in self.columns if column not in CHILD_COLUMNS]
+        children = self.database.child_columns()
+        for row in rows:
+            device = dict(zip(self.columns, row))
+            for column in CHILD_COLUMNS:
+                device[column] = children.get(device["id"], {}).get(column, {})
+            self._index(device)
+            self.next_id = max(self.next_id, device["id"] + 1)
+        sequence = self.database.execute('''SELECT seq FROM sqlite_sequence WHERE name='devices';''')
+        if sequence:
+            self.next_id = max(self.next_id, sequence[0][0] + 1)
+        # built once so the connection keeps it in its statement cache
+        names = ", ".join(self.row_columns)
+        values = ", ".join("?" for _ in self.row_columns)
+        updates = ", ".join(f"{column}=excluded.{column}" for column in self.row_columns if column != "id")
+        self.query_upsert_device = f'''INSERT INTO devices ({names}) VALUES({values})
+                                       ON CONFLICT(id) DO UPDATE SET {updates};'''
+        report(f"Loaded {len(self.devices)} devices from {self.sqlite}", self.path)
+
+    def _index(self, device):
+        self.devices[device["device_mac_address"]] = device
+        if device["src_net_addresses"] is not None:
+            self.by_src_net_address.setdefault(device["src_net_addresses"], device)
+
+    def get(self, mac):
+        return self.devices.get(mac)
+
+    def get_by_src_net_address(self, src_net_address):
+        return self.by_src_net_address.get(src_net_address)
+
+    def add(self, mac, **columns):
+        '''
+        Adds a device with the defaults of the devices table. Returns the new device.
+        '''
+        with self.lock:
+            device = {column: None for column in self.columns}
+            device["id"] = self.next_id
+            device["device_mac_address"] = mac
+            device["gps"] = "0, 0"
+            for column in CHILD_COLUMNS:
+                device[column] = {}
+            device.update(columns)
+            self.next_id += 1
+            self._index(device)
+            self.dirty.add(mac)
+            self.report_dirty[mac] = set(self.columns)
+            return device
+
+    def update(self, device, **columns):
+        with self.lock:
+            if "src_net_addresses" in columns and columns["src_net_addresses"] is not None:
+                self.by_src_net_address.setdefault(columns["src_net_addresses"], device)
+            changed = [column for column, value in columns.items() if device.get(column) != value]
+            device.update(columns)
+            self.dirty.add(device["device_mac_address"])
+            if changed:
+                self.report_dirty.setdefault(device["device_mac_address"], set()).update(changed)
+
+    def add_to_list(self, device, column, value):
+        '''
+        Adds value to one of the list columns (talks_with_mac_list, dst_net_addresses, wpan_dst_net_addresses).
+        Returns True when it was not in there yet.
+        '''
+        with self.lock:
+            if value in device[column]:
+                return False
+            device[column][value] = None
+            self.pending[column][(device["id"], value)] = None
+            self.report_dirty.setdefault(device["device_mac_address"], set()).add(column)
+            return True
+
+    def update_dict(self, device, column, values: dict):
+        '''
+        Updates one of the dict columns (capabilities, cluster_info). Returns True when something changed.
+        '''
+        with self.lock:
+            changed = False
+            for name, value in values.items():
+                if name in device[column] and device[column][name] == value:
+                    continue
+                device[column][name] = value
+                self.pending[column][(device["id"], name)] = value
+                changed = True
+            if changed:
+                self.report_dirty.setdefault(device["device_mac_address"], set()).add(column)
+            return changed
+
+    def legacy_row(self, device):
+        '''
+        The device the way it looked in the devices table before the child tables, lists and dicts as strings.
+        '''
+        row = {column: device[column] for column in self.columns}
+        for column in CHILD_COLUMNS:
+            if not device[column]:
+                row[column] = None
+            elif column in CHILD_LISTS:
+                row[column] = str(list(device[column]))
+            else:
+                row[column] = str(device[column])
+        return row
+
+    def report_changes(self):
+        '''
+        (legacy_row, changed columns) of every device that changed since the last call.
+        Give them to report_failed when they did not make it into a report.
+        '''
+        with self.lock:
+            changes = [(self.legacy_row(self.devices[mac]), columns) for mac, columns in self.report_dirty.items()]
+            self.report_dirty = {}
+        return sorted(changes, key=lambda change: change[0]["id"])
+
+    def report_failed(self, changes: list):
+        '''
+        The changes report_changes handed out are reported again next time.
+        '''
+        with self.lock:
+            for row, columns in changes:
+                self.report_dirty.setdefault(row["device_mac_address"], set()).update(columns)
+
+    def packet_done(self):
+        '''
+        Call once per processed packet. Wakes up the flusher every flush_packets packets.
+        '''
+        with self.lock:
+            self.packets += 1
+            if self.packets >= self.flush_packets:
+                self.packets = 0
+                self.wakeup.set()
+
+    def flush(self):
+        '''
+        Writes all dirty devices and new child rows in one transaction. What fails to write stays dirty.
+        '''
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty and not any(self.pending.values()):
+                    return 0
+                dirty = self.dirty
+                pending = self.pending
+                self.dirty = set()
+                self.pending = {column: {} for column in CHILD_COLUMNS}
+                rows = [tuple(self.devices[mac][column] for column in self.row_columns) for mac in dirty]
+
+            # devices first, the child rows point to them
+            statements = [(self.query_upsert_device, rows)]
+            for column, entries in pending.items():
+                if column in CHILD_LISTS:
+                    statements.append((child_upsert_query(column), list(entries)))
+                else:
+                    statements.append((child_upsert_query(column), [(device_id, name, value) for (device_id, name), value in entries.items()]))
+
+            metrics = get_metrics(self.path)
+            started = time.perf_counter()
+            try:
+                self.database.transaction(statements)
+            except sqlite3.Error as e:
+                metrics.count("zigsniff_db_flush_errors_total")
+                report(f"Failed to write {len(rows)} devices to {self.sqlite}: {e}", self.path)
+                with self.lock:
+                    self.dirty |= dirty
+                    for column, entries in pending.items():
+                        # newer values win
+                        entries.update(self.pending[column])
+                        self.pending[column] = entries
+                return 1
+            metrics.observe("zigsniff_db_flush_seconds", time.perf_counter() - started)
+            metrics.count("zigsniff_db_flushes_total")
+            metrics.count("zigsniff_db_devices_written_total", len(rows))
+            return 0
+
+    def flush_if_due(self):
+        '''
+        For an owner without the flusher thread (misc.zigsniff_engine): flushes when flush_packets packets came
+        in since the last time. Returns like flush, None when it was not due.
+        '''
+        if not self.wakeup.is_set():
+            return None
+        self.wakeup.clear()
+        return self.flush()
+
+    def _flusher(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._flusher, name="zigsniff_store_flusher", daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        '''
+        Stops the flusher and writes what is left.
+        '''
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
+
+
+def open_device_store(path: str, flush_interval: int = 1000, flush_packets: int = 500, flusher: bool = True):
+    '''
+    Opens the device store for the work directory. Call it after create_db.
+    Without the flusher thread whoever owns the store calls flush, see misc.zigsniff_engine.
+    '''
+    with _stores_lock:
+        if path not in _stores:
+            store = DeviceStore(path, flush_interval, flush_packets)
+            if flusher:
+                store.start()
+            else:
+                atexit.register(store.close)
+            _stores[path] = store
+        return _stores[path]
+
+
+def get_device_store(path: str):
+    '''
+    The store for the work directory, opened with the default flush settings if nobody opened it yet.
+    '''
+    store = _stores.get(path)
+    if store is None:
+        store = open_device_store(path)
+    return store
+
+
+def close_device_store(path: str):
+    with _stores_lock:
+        store = _stores.pop(path, None)
+    if store is not None:
+        store.close()
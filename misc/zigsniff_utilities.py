@@ -1,30 +1,21 @@
-import binascii
 import os
-import time
-import json
-import hashlib
-import gpsd
+import logging
 
-def report(text: str, path: str):
-    try:
-        path = os.path.join(path, "zigsniff_logging.log")
-        print(text)
-        file_handle = open(path, "a")
-        file_handle.write(f"{time.strftime('%Y-%m-%d_%H-%M-%S')}\t-\t{text}\n")
-        file_handle.close()
-    except:
-        print(f"Error: Writing to sensor system log file {path}")
-        exit() # no logfile means kill the program!
+from misc.zigsniff_sink import get_detection_sink
+from misc.zigsniff_logging import get_logger
+
+def report(text: str, path: str, level: int = logging.INFO):
+    # printed and written to zigsniff_logging.log by the logging thread. see misc/zigsniff_logging.py
+    logger = get_logger(path)
+    if logger.isEnabledFor(level):
+        logger.log(level, str(text))
 
 def write_zigsniff_message(dict, path):
+    from misc.zigsniff_metrics import get_metrics  # zigsniff_metrics imports this module
+    # the detection sink writes it from its own thread
     try:
-        md5_hash = hashlib.md5()
-        md5_hash.update(str(dict).encode('utf-8'))
-        message_file_name = f"zigsniff_{md5_hash.hexdigest()}.zmessage"
-        message_path = os.path.join(path, message_file_name)
-        file_handle = open(message_path, "a")
-        file_handle.write(json.dumps(dict))
-        file_handle.close()
+        get_detection_sink(path).write(dict)
+        get_metrics(path).count("zigsniff_detections_total")
     except Exception as e:
         report(f"Error: Writing a zmessage: {e}", path)
         exit()
@@ -47,23 +38,11 @@ def create_work_directory(path: str):
             exit()
 
 def key_management_add_key(key, path):
-    #this whole thing needs to be tested!
-    found = False
-    with open("zigbee_pc_keys", 'r') as file:
-        for line in file:
-            if key in line:
-                found = True
-                break
-
-    if not found:
-
-        key_bytes = bytes.fromhex(key.replace(":", ""))
-        key_crc = binascii.crc32(key_bytes)
-        key_name = str(key_crc)
-
-        with open("zigbee_pc_keys", 'a') as file:
-            file.write(f'"{key}","Normal","{key_name}"\n')
-            report(f'The string "{key}" has been added to persistent file.', path)
+    from misc.zigsniff_keys import get_key_registry  # zigsniff_keys imports this module
+    # the registry knows the keys of the keys file, it only reads the file again when it changed
+    registry = get_key_registry(path)
+    if registry.add_key(key):
+        report(f'The string "{key}" has been added to persistent file {registry.keyfile}.', path)
 
         # with open("~/.config/wireshark/zigbee_pc_keys", 'a') as file:
         #     file.write(f'"{key}","Normal","{key_name}"\n')
@@ -74,17 +53,3 @@ def key_management_add_key(key, path):
 
 def mac_vendor_lookup(mac_64bit: str):
     pass
-
-def get_gps_loc():
-    try:
-        gpsd.connect(host="127.0.0.1", port=2947)
-        location = gpsd.get_current()
-        lati = location.lat
-        longi = location.lon
-        if lati != 0.0 and longi != 0.0:
-            current = (longi, lati)
-            return current
-        else:
-            return None
-    except Exception as e:
-        return None
@@ -1,9 +1,13 @@
 import subprocess
-import multiprocessing
+import threading
+import logging
 import atexit
+import shlex
+import time
 import os
 
 from misc.zigsniff_utilities import report
+from misc.zigsniff_archive import open_pcap_archive
 
 def fifo_available(fifo_path: str, path: str):
 
@@ -19,28 +23,113 @@ def fifo_available(fifo_path: str, path: str):
             report("\tFailed to create capture point:\n" + str(e), path)
             return 1
 
-def run_whsniff(channel: int, fifo_path: str, pcap_path: str, path: str):
-    try:
-        # check for fifo file or create one
-        if fifo_available(fifo_path, path) == 1:
-            exit()
+class WhsniffReader:
+    '''
+    Runs whsniff and reads its stdout ourselves, no shell and no tee. Every chunk is read into one reusable buffer
+    and written from there to the archive pcap and to the parser: a named fifo when parser_path is given,
+    otherwise an os.pipe of which the read end is self.pipe.
+    The archive is a ring of pcap segments, see misc.zigsniff_archive.
+    Counts bytes and frames and remembers when data last came in, so a stalled dongle shows up in the log.
+    '''
+    def __init__(self, channel: int, pcap_path: str, path: str, command: str = None, parser_path: str = None,
+                 buffer_size: int = 65536, stall_seconds: float = 30):
+        self.channel = channel
+        self.pcap_path = pcap_path
+        self.path = path
+        # a source can bring its own capture command, for example to pick a dongle. {channel} is filled in
+        self.command = command if command is not None else "whsniff -c {channel}"
+        self.parser_path = parser_path
+        self.archive = open_pcap_archive(pcap_path, path)
+        self.buffer = bytearray(buffer_size)
+        self.stall_seconds = stall_seconds
+        self.process = None
+        self.pipe = None
+        self.parser_fd = None
+        self.returncode = None
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.frames = 0
+        self.last_data = time.monotonic()
+        self.last_report = time.monotonic()
+        self.last_counters = (0, 0)
+        self.thread = None
 
-        command = f"whsniff -c {channel} | tee {fifo_path} >> {pcap_path}"  # Command that is used to capture zigbee data. its run into a fifo file so pyshark can capture and a pcap for record keeping
-        process = subprocess.run(command, capture_output=True, text=True, check=True, shell=True)
-        report(f"Whsniff started: {process.returncode}", path)
+    def start(self):
+        '''
+        Starts whsniff and the reader thread in this process. Without parser_path read the capture from self.pipe.
+        '''
+        if self.parser_path is None:
+            read_fd, self.parser_fd = os.pipe()
+            self.pipe = os.fdopen(read_fd, 'rb')
+        self.thread = threading.Thread(target=self.run, name=f"zigsniff_whsniff_{self.channel}", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        return self
 
-    except Exception as e:
-        report(f"Whsniff error occurred: {e}", path)
-        exit()
+    def stop(self):
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.terminate()
 
-# Function to start the process
-def start_whsniff_process(channel: int, fifo_path: str, pcap_path: str, path: str) -> multiprocessing.Process:
-    process = multiprocessing.Process(target=run_whsniff, args=(channel, fifo_path, pcap_path, path))
-    process.start()
+    def counters(self):
+        with self.lock:
+            return {"bytes": self.bytes, "frames": self.frames, "idle_seconds": time.monotonic() - self.last_data}
+
+    def report(self, path: str = None):
+        '''
+        Reports bytes and frames per second since the last report, and a stall when whsniff has been quiet too long.
+        '''
+        path = path if path is not None else self.path
+        counters = self.counters()
+        now = time.monotonic()
+        elapsed = max(now - self.last_report, 0.001)
+        byte_rate = (counters["bytes"] - self.last_counters[0]) / elapsed
+        frame_rate = (counters["frames"] - self.last_counters[1]) / elapsed
+        report(f"whsniff channel {self.channel}: {counters['frames']} frames ({frame_rate:.1f}/s), {counters['bytes']} bytes ({byte_rate:.0f}/s)", path)
+        if self.stall_seconds and counters["idle_seconds"] >= self.stall_seconds:
+            report(f"Whsniff on channel {self.channel} sent nothing for {counters['idle_seconds']:.0f} seconds", path, logging.WARNING)
+        self.last_report = now
+        self.last_counters = (counters["bytes"], counters["frames"])
+
+    def _write_parser(self, chunk: memoryview):
+        while chunk:
+            written = os.write(self.parser_fd, chunk)
+            chunk = chunk[written:]
+
+    def run(self):
+        '''
+        The copy loop, start() runs it in the reader thread.
+        '''
+        try:
+            command = shlex.split(self.command.format(channel=self.channel))
+            self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+            if self.parser_fd is None:
+                self.parser_fd = os.open(self.parser_path, os.O_WRONLY)  # waits for the parser to open the fifo
+            view = memoryview(self.buffer)
+            with self.archive as archive:
+                while True:
+                    size = self.process.stdout.readinto(self.buffer)
+                    if not size:
+                        break
+                    chunk = view[:size]
+                    frames = archive.write(chunk)  # the archive follows the records anyway, it counts them for us
+                    self._write_parser(chunk)
+                    with self.lock:
+                        self.bytes += size
+                        self.frames += frames
+                        self.last_data = time.monotonic()
+        except BrokenPipeError:
+            report(f"Whsniff channel {self.channel}: the parser closed the capture", self.path)
+        except Exception as e:
+            report(f"Whsniff error occurred: {e}", self.path)
+        finally:
+            if self.process is not None:
+                self.stop()
+                self.returncode = self.process.wait()
+                report(f"Whsniff stopped: {self.returncode}", self.path)
+            if self.parser_fd is not None:
+                os.close(self.parser_fd)  # the parser sees the end of the capture
 
-    # Register the process termination when the program exits
-    atexit.register(lambda: terminate_whsniff_process(process))
-    return process
 
 # Function to terminate the process
 def terminate_whsniff_process(process) -> None:
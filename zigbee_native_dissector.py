@@ -0,0 +1,522 @@
+'''
+    Pure python dissector for the 802.15.4 MAC, Zigbee NWK, APS and ZCL layers.
+    Used as a fast path for offline pcaps so we do not pay a tshark round trip for every frame.
+
+    It does not produce results itself. It builds a small packet object that looks like a pyshark packet
+    (layers, field names and field values formatted the way tshark shows them) and hands that to
+    zigbee_packet_dissector. That way both paths fill the exact same dissector_results keys.
+
+    Anything we can not handle here returns NATIVE_FALLBACK and has to go through pyshark:
+    - secured frames (NWK, APS or MAC security, tshark does the decryption with the zigbee_pc_keys file)
+    - NWK and APS commands, ZDP, fragmented APS frames, manufacturer specific ZCL
+    - unknown profiles, clusters or commands and malformed/truncated frames
+    So when adding a field to ZIGBEE_FIELDS that lives in a layer handled here, add it here too!
+'''
+import struct
+
+from misc.zigsniff_pcap import LINKTYPE_IEEE802_15_4_WITHFCS, LINKTYPE_IEEE802_15_4_NOFCS
+from zigbee_packet_dissector import zigbee_packet_dissector
+
+NATIVE_FALLBACK = object()
+
+ZCL_PROFILES = (0x0104, 0x0109, 0xc05e)  # Home automation, Smart energy, Zigbee light link
+
+# ZCL data type id: size in bytes. Strings are handled separately.
+ZCL_TYPE_SIZES = {
+    0x08: 1, 0x09: 2, 0x0a: 3, 0x0b: 4, 0x0c: 5, 0x0d: 6, 0x0e: 7, 0x0f: 8,
+    0x10: 1,
+    0x18: 1, 0x19: 2, 0x1a: 3, 0x1b: 4, 0x1c: 5, 0x1d: 6, 0x1e: 7, 0x1f: 8,
+    0x20: 1, 0x21: 2, 0x22: 3, 0x23: 4, 0x24: 5, 0x25: 6, 0x26: 7, 0x27: 8,
+    0x28: 1, 0x29: 2, 0x2a: 3, 0x2b: 4, 0x2c: 5, 0x2d: 6, 0x2e: 7, 0x2f: 8,
+    0x30: 1, 0x31: 2,
+    0x38: 2, 0x39: 4, 0x3a: 8,
+    0xe0: 4, 0xe1: 4, 0xe2: 4, 0xe8: 2, 0xe9: 2, 0xea: 4, 0xf0: 8, 0xf1: 16,
+}
+ZCL_SIGNED_TYPES = range(0x28, 0x30)
+ZCL_STRING_TYPES = {0x41: 1, 0x42: 1, 0x43: 2, 0x44: 2}  # type: size of the length prefix
+
+# cluster: (prefix of the tshark field names, {attribute id: (field name, formatter)})
+# the attribute id field is called <prefix>_attr_id
+ZCL_CLUSTERS = {
+    0x0000: ("zbee_zcl_general_basic", {}),
+    0x0001: ("zbee_zcl_general_power_config", {
+        0x0020: ("zbee_zcl_general_power_config_attr_batt_voltage", "dec"),
+        0x0021: ("zbee_zcl_general_power_config_attr_batt_percentage", "dec"),
+    }),
+    0x0006: ("zbee_zcl_general_onoff", {
+        0x0000: ("zbee_zcl_general_onoff_attr_onoff", "hex"),
+    }),
+    0x0008: ("zbee_zcl_general_level_control", {
+        0x0000: ("zbee_zcl_general_level_control_attr_current_level", "dec"),
+    }),
+    0x0300: ("zbee_zcl_lighting_color_control", {
+        0x0000: ("zbee_zcl_lighting_color_control_attr_current_hue", "dec"),
+        0x0003: ("zbee_zcl_lighting_color_control_attr_color_x", "dec"),
+        0x0004: ("zbee_zcl_lighting_color_control_attr_color_y", "dec"),
+        0x0007: ("zbee_zcl_lighting_color_control_attr_color_temperature", "dec"),
+    }),
+    0x0400: ("zbee_zcl_meas_sensing_illummeas", {
+        0x0000: ("zbee_zcl_meas_sensing_illummeas_attr_value", "dec"),
+    }),
+    0x0402: ("zbee_zcl_meas_sensing_tempmeas", {
+        0x0000: ("zbee_zcl_meas_sensing_tempmeas_attr_value", "dec"),
+    }),
+    0x0403: ("zbee_zcl_meas_sensing_pressmeas", {
+        0x0000: ("zbee_zcl_meas_sensing_pressmeas_attr_value", "dec"),
+        0x0014: ("zbee_zcl_meas_sensing_pressmeas_attr_scaled_value", "dec"),
+    }),
+    0x0405: ("zbee_zcl_meas_sensing_relhummeas", {
+        0x0000: ("zbee_zcl_meas_sensing_relhummeas_attr_value", "dec"),
+    }),
+    0x0406: ("zbee_zcl_meas_sensing_occsen", {
+        0x0000: ("zbee_zcl_meas_sensing_occsen_attr_occupancy", "occupancy"),
+    }),
+    0x0500: ("zbee_zcl_ias_zone", {
+        0x0002: ("zbee_zcl_ias_zone_status", "zone_status"),
+    }),
+    0x0b04: ("zbee_zcl_meas_sensing_elecmes", {}),
+}
+# clusters where we know the client to server commands well enough (we only need the command id)
+ZCL_SRV_RX_COMMANDS = {
+    0x0006: (0x00, 0x01, 0x02, 0x40, 0x41, 0x42),
+    0x0008: (0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07),
+    0x0300: tuple(range(0x00, 0x0b)) + (0x40, 0x41, 0x42, 0x43, 0x44, 0x47, 0x4b, 0x4c),
+}
+IAS_ZONE_STATUS_BITS = ("alarm_1", "alarm_2", "tamper", "battery", "supervision_reports", "restore_reports",
+                        "trouble", "ac_mains", "test", "battery_defect")
+
+
+class _NativeFallback(Exception):
+    pass
+
+
+class NativeLayer:
+    '''
+    Stand-in for a pyshark layer. field_names (and dir()) list the field names and the fields are attributes.
+    Like pyshark the first occurrence of a field wins.
+    '''
+    def __init__(self, layer_name: str):
+        self.layer_name = layer_name
+        self._fields = {}
+
+    def add(self, field: str, value: str):
+        if field not in self._fields:
+            self._fields[field] = value
+
+    @property
+    def field_names(self):
+        return list(self._fields)
+
+    def __dir__(self):
+        return sorted(self._fields)
+
+    def __getattr__(self, item):
+        try:
+            return self.__dict__["_fields"][item]
+        except KeyError:
+            raise AttributeError(item)
+
+    def __repr__(self):
+        return f"<{self.layer_name.upper()} Layer>"
+
+
+class NativePacket:
+    '''
+    Stand-in for a pyshark packet. Only the parts zigbee_packet_dissector uses.
+    '''
+    def __init__(self, number: int, timestamp: float, length: int):
+        self.number = str(number)
+        self.sniff_timestamp = f"{timestamp:.9f}"
+        self.length = str(length)
+        self.layers = []
+
+    def add_layer(self, layer_name: str) -> NativeLayer:
+        layer = NativeLayer(layer_name)
+        self.layers.append(layer)
+        return layer
+
+    def __getitem__(self, item):
+        for layer in self.layers:
+            if layer.layer_name == item.lower():
+                return layer
+        raise KeyError(item)
+
+    def __getattr__(self, item):
+        try:
+            return self[item]
+        except KeyError:
+            raise AttributeError(item)
+
+
+def _eui64(data: bytes):
+    # over the air little endian, shown big endian with colons
+    return ":".join(f"{byte:02x}" for byte in reversed(data))
+
+
+def _bool(value):
+    return "1" if value else "0"
+
+
+def _dissect_wpan(pkt: NativePacket, frame: bytes):
+    '''
+    802.15.4 MAC header. Returns (frame type, payload)
+    '''
+    wpan = pkt.add_layer("wpan")
+    fcf = struct.unpack_from("<H", frame, 0)[0]
+    frame_type = fcf & 0x7
+    security = (fcf >> 3) & 0x1
+    pan_id_compression = (fcf >> 6) & 0x1
+    dst_mode = (fcf >> 10) & 0x3
+    version = (fcf >> 12) & 0x3
+    src_mode = (fcf >> 14) & 0x3
+
+    if version > 1 or security or frame_type > 3:
+        raise _NativeFallback()  # 2015 frames and MAC security are for tshark
+
+    wpan.add("frame_type", f"0x{frame_type:x}")
+    wpan.add("seq_no", str(frame[2]))
+    offset = 3
+
+    if dst_mode:
+        dst_pan = struct.unpack_from("<H", frame, offset)[0]
+        wpan.add("dst_pan", f"0x{dst_pan:04x}")
+        offset += 2
+        if dst_mode == 2:
+            wpan.add("dst16", f"0x{struct.unpack_from('<H', frame, offset)[0]:04x}")
+            offset += 2
+        elif dst_mode == 3:
+            wpan.add("dst64", _eui64(frame[offset:offset + 8]))
+            offset += 8
+        else:
+            raise _NativeFallback()
+
+    if src_mode:
+        if not pan_id_compression:
+            src_pan = struct.unpack_from("<H", frame, offset)[0]
+            wpan.add("src_pan", f"0x{src_pan:04x}")
+            offset += 2
+        if src_mode == 2:
+            wpan.add("src16", f"0x{struct.unpack_from('<H', frame, offset)[0]:04x}")
+            offset += 2
+        elif src_mode == 3:
+            wpan.add("src64", _eui64(frame[offset:offset + 8]))
+            offset += 8
+        else:
+            raise _NativeFallback()
+
+    if offset > len(frame):
+        raise _NativeFallback()  # truncated, tshark marks it as malformed
+
+    if frame_type == 3:
+        wpan.add("cmd", f"0x{frame[offset]:02x}")
+
+    return frame_type, frame[offset:]
+
+
+def _dissect_beacon(pkt: NativePacket, payload: bytes):
+    # superframe spec, gts and pending addresses come first
+    offset = 2
+    gts_spec = payload[offset]
+    offset += 1
+    gts_count = gts_spec & 0x7
+    if gts_count:
+        offset += 1 + gts_count * 3
+    pending = payload[offset]
+    offset += 1
+    offset += (pending & 0x7) * 2 + ((pending >> 4) & 0x7) * 8
+
+    beacon_payload = payload[offset:]
+    if not beacon_payload:
+        return
+    if beacon_payload[0] != 0x00 or len(beacon_payload) < 15:
+        raise _NativeFallback()  # not a zigbee beacon
+
+    beacon = pkt.add_layer("zbee_beacon")
+    flags = struct.unpack_from("<H", beacon_payload, 1)[0]
+    beacon.add("protocol", "0")
+    beacon.add("profile", f"0x{flags & 0xf:02x}")
+    beacon.add("version", str((flags >> 4) & 0xf))
+    beacon.add("router", _bool(flags & 0x0400))
+    beacon.add("depth", str((flags >> 11) & 0xf))
+    beacon.add("end_dev", _bool(flags & 0x8000))
+    beacon.add("ext_panid", _eui64(beacon_payload[3:11]))
+
+
+def _dissect_nwk(pkt: NativePacket, payload: bytes):
+    '''
+    Zigbee network header. Returns the NWK payload for the APS layer.
+    '''
+    fcf = struct.unpack_from("<H", payload, 0)[0]
+    frame_type = fcf & 0x3
+    version = (fcf >> 2) & 0xf
+    multicast = (fcf >> 8) & 0x1
+    security = (fcf >> 9) & 0x1
+    source_route = (fcf >> 10) & 0x1
+    ext_dst = (fcf >> 11) & 0x1
+    ext_src = (fcf >> 12) & 0x1
+    end_device_initiator = (fcf >> 13) & 0x1
+
+    if version not in (1, 2):
+        raise _NativeFallback()  # not zigbee (or green power)
+    if frame_type != 0 or security:
+        raise _NativeFallback()  # commands and encrypted frames are for tshark
+
+    nwk = pkt.add_layer("zbee_nwk")
+    nwk.add("frame_type", f"0x{frame_type:x}")
+    nwk.add("proto_version", str(version))
+    if version == 2:
+        nwk.add("end_device_initiator", _bool(end_device_initiator))
+
+    dst, src, radius, seqno = struct.unpack_from("<HHBB", payload, 2)
+    nwk.add("dst", f"0x{dst:04x}")
+    nwk.add("addr", f"0x{dst:04x}")
+    nwk.add("src", f"0x{src:04x}")
+    nwk.add("radius", str(radius))
+    nwk.add("seqno", str(seqno))
+    offset = 8
+
+    if ext_dst:
+        nwk.add("dst64", _eui64(payload[offset:offset + 8]))
+        nwk.add("addr64", _eui64(payload[offset:offset + 8]))
+        offset += 8
+    if ext_src:
+        nwk.add("src64", _eui64(payload[offset:offset + 8]))
+        nwk.add("addr64", _eui64(payload[offset:offset + 8]))
+        offset += 8
+    if multicast:
+        offset += 1
+    if source_route:
+        relay_count = payload[offset]
+        offset += 2 + relay_count * 2
+
+    if offset > len(payload):
+        raise _NativeFallback()
+    return payload[offset:]
+
+
+def _dissect_aps(pkt: NativePacket, payload: bytes):
+    '''
+    Zigbee APS header. Returns (dst endpoint, cluster, profile, payload) for data frames
+    and None for acknowledgements.
+    '''
+    fcf = payload[0]
+    frame_type = fcf & 0x3
+    delivery = (fcf >> 2) & 0x3
+    ack_format = (fcf >> 4) & 0x1
+    security = (fcf >> 5) & 0x1
+    ext_header = (fcf >> 7) & 0x1
+
+    if frame_type not in (0, 2) or security or ext_header:
+        raise _NativeFallback()  # commands, inter-pan, encrypted and fragmented frames
+
+    aps = pkt.add_layer("zbee_aps")
+    aps.add("type", f"0x{frame_type:x}")
+    aps.add("delivery", f"0x{delivery:x}")
+    offset = 1
+
+    if frame_type == 2 and ack_format:
+        aps.add("counter", str(payload[offset]))
+        return None
+
+    dst_endpoint = None
+    if delivery in (0, 2):
+        dst_endpoint = payload[offset]
+        aps.add("dst", str(dst_endpoint))
+        offset += 1
+    elif delivery == 3:
+        aps.add("group", f"0x{struct.unpack_from('<H', payload, offset)[0]:04x}")
+        offset += 2
+    else:
+        raise _NativeFallback()
+
+    cluster, profile = struct.unpack_from("<HH", payload, offset)
+    offset += 4
+    if dst_endpoint == 0:
+        aps.add("zdp_cluster", f"0x{cluster:04x}")
+    else:
+        aps.add("cluster", f"0x{cluster:04x}")
+    aps.add("profile", f"0x{profile:04x}")
+    aps.add("src", str(payload[offset]))
+    aps.add("counter", str(payload[offset + 1]))
+    offset += 2
+
+    if offset > len(payload):
+        raise _NativeFallback()
+    if frame_type == 2:
+        return None
+    return dst_endpoint, cluster, profile, payload[offset:]
+
+
+def _zcl_value(payload: bytes, offset: int, data_type: int):
+    '''
+    Returns (int value or None, new offset)
+    '''
+    if data_type in ZCL_STRING_TYPES:
+        prefix = ZCL_STRING_TYPES[data_type]
+        length = int.from_bytes(payload[offset:offset + prefix], "little")
+        return None, offset + prefix + length
+    if data_type not in ZCL_TYPE_SIZES:
+        raise _NativeFallback()  # arrays, structs and friends
+    size = ZCL_TYPE_SIZES[data_type]
+    if offset + size > len(payload):
+        raise _NativeFallback()
+    value = int.from_bytes(payload[offset:offset + size], "little", signed=data_type in ZCL_SIGNED_TYPES)
+    return value, offset + size
+
+
+def _zcl_attribute_value(zcl: NativeLayer, attributes: dict, attribute_id: int, value):
+    if attribute_id not in attributes or value is None:
+        return
+    field, formatter = attributes[attribute_id]
+    if formatter == "dec":
+        zcl.add(field, str(value))
+    elif formatter == "hex":
+        zcl.add(field, f"0x{value:02x}")
+    elif formatter == "occupancy":
+        zcl.add(field, f"0x{value:02x}")
+        zcl.add(field + "_occupied", _bool(value & 0x01))
+    elif formatter == "zone_status":
+        _zcl_zone_status(zcl, value)
+
+
+def _zcl_zone_status(zcl: NativeLayer, value: int):
+    zcl.add("zbee_zcl_ias_zone_status", f"0x{value:04x}")
+    for bit, name in enumerate(IAS_ZONE_STATUS_BITS):
+        zcl.add("zbee_zcl_ias_zone_status_" + name, _bool(value & (1 << bit)))
+
+
+def _dissect_zcl(pkt: NativePacket, cluster: int, payload: bytes):
+    fcf = payload[0]
+    frame_type = fcf & 0x3
+    manufacturer_specific = (fcf >> 2) & 0x1
+    direction = (fcf >> 3) & 0x1
+
+    if manufacturer_specific or frame_type > 1 or cluster not in ZCL_CLUSTERS:
+        raise _NativeFallback()
+
+    zcl = pkt.add_layer("zbee_zcl")
+    zcl.add("type", f"0x{frame_type:02x}")
+    zcl.add("cmd_tsn", str(payload[1]))
+    command = payload[2]
+    offset = 3
+    prefix, attributes = ZCL_CLUSTERS[cluster]
+
+    if frame_type == 1:
+        # cluster specific commands
+        if direction == 0 and command in ZCL_SRV_RX_COMMANDS.get(cluster, ()):
+            zcl.add(prefix + "_cmd_srv_rx_id", f"0x{command:02x}")
+        elif direction == 1 and cluster == 0x0500 and command == 0x00:
+            # zone status change notification
+            _zcl_zone_status(zcl, struct.unpack_from("<H", payload, offset)[0])
+        else:
+            raise _NativeFallback()
+        return
+
+    zcl.add("cmd_id", f"0x{command:02x}")
+    if command == 0x00:
+        # read attributes
+        while offset + 2 <= len(payload):
+            zcl.add(prefix + "_attr_id", f"0x{struct.unpack_from('<H', payload, offset)[0]:04x}")
+            offset += 2
+    elif command == 0x01:
+        # read attributes response
+        while offset + 3 <= len(payload):
+            attribute_id, status = struct.unpack_from("<HB", payload, offset)
+            zcl.add(prefix + "_attr_id", f"0x{attribute_id:04x}")
+            offset += 3
+            if status == 0:
+                value, offset = _zcl_value(payload, offset + 1, payload[offset])
+                _zcl_attribute_value(zcl, attributes, attribute_id, value)
+    elif command in (0x02, 0x03, 0x05, 0x0a):
+        # write attributes (undivided / no response) and report attributes
+        while offset + 3 <= len(payload):
+            attribute_id, data_type = struct.unpack_from("<HB", payload, offset)
+            zcl.add(prefix + "_attr_id", f"0x{attribute_id:04x}")
+            value, offset = _zcl_value(payload, offset + 3, data_type)
+            _zcl_attribute_value(zcl, attributes, attribute_id, value)
+    elif command == 0x0b:
+        # default response
+        zcl.add("cmd_id_rsp", f"0x{payload[offset]:02x}")
+        zcl.add("status", f"0x{payload[offset + 1]:02x}")
+    else:
+        raise _NativeFallback()
+
+    if offset > len(payload):
+        raise _NativeFallback()
+
+
+def native_packet(record):
+    '''
+    Turns a PcapRecord into a NativePacket. Returns NATIVE_FALLBACK when the frame has to go through pyshark.
+    '''
+    if record.linktype == LINKTYPE_IEEE802_15_4_WITHFCS:
+        frame = record.data[:-2]
+    elif record.linktype == LINKTYPE_IEEE802_15_4_NOFCS:
+        frame = record.data
+    else:
+        return NATIVE_FALLBACK
+
+    pkt = NativePacket(record.number, record.timestamp, record.length)
+    try:
+        frame_type, payload = _dissect_wpan(pkt, frame)
+        if frame_type == 0:
+            _dissect_beacon(pkt, payload)
+        elif frame_type == 1 and payload:
+            nwk_payload = _dissect_nwk(pkt, payload)
+            if nwk_payload:
+                aps = _dissect_aps(pkt, nwk_payload)
+                if aps is not None:
+                    dst_endpoint, cluster, profile, aps_payload = aps
+                    if dst_endpoint == 0 or profile not in ZCL_PROFILES:
+                        raise _NativeFallback()  # ZDP and unknown profiles
+                    if aps_payload:
+                        _dissect_zcl(pkt, cluster, aps_payload)
+    except (_NativeFallback, struct.error, IndexError):
+        return NATIVE_FALLBACK
+    return pkt
+
+
+def nwk_security(record):
+    '''
+    (PAN id, key sequence number) of a frame with NWK security, formatted like pan_dst and an int.
+    The key sequence number is None when the frame is not secured with a network key.
+    Returns None for everything else.
+    '''
+    if record.linktype == LINKTYPE_IEEE802_15_4_WITHFCS:
+        frame = record.data[:-2]
+    elif record.linktype == LINKTYPE_IEEE802_15_4_NOFCS:
+        frame = record.data
+    else:
+        return None
+    pkt = NativePacket(record.number, record.timestamp, record.length)
+    try:
+        frame_type, payload = _dissect_wpan(pkt, frame)
+        if frame_type != 1 or len(payload) < 8:
+            return None
+        fcf = struct.unpack_from("<H", payload, 0)[0]
+        if not (fcf >> 9) & 0x1:
+            return None
+        offset = 8
+        offset += 8 * ((fcf >> 11) & 0x1) + 8 * ((fcf >> 12) & 0x1) + ((fcf >> 8) & 0x1)
+        if (fcf >> 10) & 0x1:
+            offset += 2 + payload[offset] * 2
+        # auxiliary header: security control, frame counter, source when the nonce is extended, key sequence number
+        security_control = payload[offset]
+        offset += 5 + 8 * ((security_control >> 5) & 0x1)
+        key_sequence = payload[offset] if (security_control >> 3) & 0x3 == 1 else None
+    except (_NativeFallback, struct.error, IndexError):
+        return None
+    pan = getattr(pkt.wpan, "dst_pan", None)
+    if pan is None:
+        return None
+    return pan, key_sequence
+
+
+def zigbee_native_dissector(record):
+    '''
+    Same return values as zigbee_packet_dissector plus NATIVE_FALLBACK.
+    '''
+    pkt = native_packet(record)
+    if pkt is NATIVE_FALLBACK:
+        return NATIVE_FALLBACK
+    return zigbee_packet_dissector(pkt)
@@ -5,25 +5,51 @@ import pyshark
 import os
 import sys
 import time
+import asyncio
 from apscheduler.schedulers.background import BackgroundScheduler
 from pyshark.capture.pipe_capture import PipeCapture
 
-from misc.zigsniff_utilities import report, create_work_directory, get_gps_loc
+from misc.zigsniff_utilities import report, create_work_directory
 from zigbee_packet_dissector import zigbee_packet_dissector
 import misc.zigsniff_config
-from misc.zigsniff_sqlite import create_db, nwk_add_dev_to_devices, match_nwk_addresses, wpan_add_dev_to_devices, match_wpan_addresses, parse_the_rest, zigsniff_reporter
-from misc.zigsniff_detections import zigbee_detections
-from misc.zigsniff_whsniff import start_whsniff_process
+from misc.zigsniff_sqlite import create_db, zigsniff_reporter
+from misc.zigsniff_store import open_device_store
+from misc.zigsniff_sticky import open_sticky_note_cache
+from misc.zigsniff_sink import open_detection_sink
+from misc.zigsniff_logging import configure_logging
+from misc.zigsniff_archive import configure_archive
+from misc.zigsniff_index import open_packet_index, PcapLocator
+from misc.zigsniff_backlog import open_encrypted_backlog
+from misc.zigsniff_keys import open_key_registry, tshark_key_options
+from misc.zigsniff_duplicates import open_duplicate_filter
+from misc.zigsniff_metrics import open_metrics, get_metrics
+from misc.zigsniff_profile import Profiler
+from misc.zigsniff_gps import GpsPoller, FakeGpsSource
+from misc.zigsniff_sources import sources_from_config, multi_source_capture, ChannelCounters, CaptureSource
+from misc.zigsniff_hopping import ChannelHopper
+from misc.zigsniff_whsniff import WhsniffReader
+from misc.zigsniff_pipeline import LivePipeline
+from misc.zigsniff_engine import AsyncEngine
+from misc.zigsniff_processing import process_dissector, process_decrypted
+from misc.zigsniff_offline import native_file_capture, sharded_file_capture
+from misc.zigsniff_fields import FieldsCapture
 
 # Script arguments
 argParser = argparse.ArgumentParser(prog="Zigsniff", description="Passive capturing of Zigbee traffic and analysis of resulting data.", epilog="Powered by: Project Entropia")
 argParser.add_argument("-p", "--pcap", type=str, help="Load Zigbee pcap file for processing.")
 argParser.add_argument("-l", "--live", help="Perform live capture using CC2531.", action='store_true')
+argParser.add_argument("--hop", help="Hop over the channels in the hopping section of the config with one dongle (live capture)", action='store_true')
 argParser.add_argument("-g", "--gps", help="Enable GPS by GPSD", action='store_true')
+argParser.add_argument("--gps-fake", type=str, help="Use a fixed 'lon,lat' or replay a zigsniff_gps_track.csv instead of gpsd (with -g)")
 argParser.add_argument("-c", "--channel", type=int, default=11, help="Channel to capture on (11-26).")
 argParser.add_argument("-C", "--config", type=str, default="zigsniff_config.json", help="Specify zigsniff config 'Default is zigsniff_config.json' (must be json!)")
 argParser.add_argument("-o", "--output", type=str, default="messages", help="Write logs to path")
 argParser.add_argument("-k", "--keyfile", type=str, default="zigbee_pc_keys", help="Pyshark/Wireshark Zigbee_pc_keys file for decryption using known keys")
+argParser.add_argument("-b", "--backend", type=str, default="native", choices=["native", "fields", "pyshark"], help="Dissection backend. native only sends encrypted/unknown frames through the fallback, fields asks tshark only for the fields we use (Default is native, live capture only dissects natively with the pipeline in the config, otherwise it uses pyshark for native)")
+argParser.add_argument("-f", "--fallback", type=str, default="pyshark", choices=["pyshark", "fields"], help="Backend for the frames the native dissector can not handle (Default is pyshark)")
+argParser.add_argument("--engine", type=str, default="threads", choices=["threads", "asyncio"], help="Live capture with threads or with one asyncio event loop for all sources (Default is threads)")
+argParser.add_argument("--profile", help="Profile the run (sampling, offline also cProfile). Written to the output directory on exit and on SIGUSR1", action='store_true')
+argParser.add_argument("-w", "--workers", type=int, default=1, help="Number of worker processes that dissect an offline pcap in parallel (Default is 1)")
 args = argParser.parse_args()
 
 if len(sys.argv) == 1:
@@ -40,6 +66,8 @@ report("Starting Zigsniff with options:", output)  # to start things off
 if args.live is not None:
     report(f"\tConfig file loaded", output)
     config = misc.zigsniff_config.config()
+    configure_logging(output, **config.logging)
+    configure_archive(output, **config.archive)
     args.channel = config.channel
     args.fifo_path = config.fifo_file_path
     args.report_period = config.report_period
@@ -56,83 +84,153 @@ for arg in vars(args): # report all arguments just for keepsake
 
 # maybe make a packet processor. we do some things duplicate given the arguments.
 
+def process_live_dissector(dissector, channel, pcap, gps_poller):
+    if dissector is not None and not isinstance(dissector, str):
+        time_difference = int(time.time()) - dissector["pkt_timestamp"]
+        if time_difference >= 60:
+            report(f"Timestamp from packet too old. stopping live capture. please restart: {time_difference}", output)
+            exit()
+        else:
+            # add gps if enabled
+            if gps_poller is not None:
+                gps = gps_poller.location()
+                if gps is not None:
+                    dissector['gps'] = gps
+
+    process_dissector(dissector, channel, pcap, output)
+    if dissector is not None and not isinstance(dissector, str):
+        get_metrics(output).observe("zigsniff_capture_to_store_lag_seconds", time.time() - dissector["pkt_timestamp"])
+    # what the backlog decrypted in the meantime is stored by us, not by its retry thread
+    process_decrypted(output)
+
+def live_capture(fifo, pans=None):
+    # capture is the wait for tshark and the dissection together. both get the keys the key registry picks for pans
+    if args.backend == "fields":
+        return get_metrics(output).timed(FieldsCapture(pipe=fifo, keyfile=args.keyfile, path=output, pans=pans), "capture")
+    keys = tshark_key_options(args.keyfile, pans, output)
+    return get_metrics(output).timed((zigbee_packet_dissector(packet) for packet in PipeCapture(pipe=fifo, custom_parameters=keys)), "capture")
+
+def fallback_capture(pipe):
+    # what the native dissector of the live pipeline can not handle
+    if args.fallback == "fields":
+        return FieldsCapture(pipe=pipe, keyfile=args.keyfile, path=output)
+    return (zigbee_packet_dissector(packet) for packet in PipeCapture(pipe=pipe, custom_parameters=tshark_key_options(args.keyfile, path=output)))
+
 if args.live:
     report("Live capture starting:", output)
-    # Start whsniff
-    start_whsniff_process(args.channel, args.fifo_path, args.pcap_path, output)
+    if config.metrics_enabled:
+        open_metrics(output, **config.metrics)
+    if args.profile:
+        Profiler(output, False, **config.profile).start()
+    if args.engine == "asyncio" and args.hop:
+        report("Channel hopping needs --engine threads", output)
+        exit()
+    # Start whsniff. with sources in the config every source starts its own capture further down
+    sources = sources_from_config(config.sources, output)
+    hopper = None
+    reader = None
+    pipeline = None
+    if args.hop:
+        hopper = ChannelHopper(args.fifo_path, args.pcap_path, output, **config.hopping).start()
+    elif not sources and args.engine == "threads":
+        # we read whsniff ourselves, it goes to the pcap and straight into a pipe to the parser
+        reader = WhsniffReader(args.channel, args.pcap_path, output, **config.capture).start()
+        if args.backend == "native" and config.pipeline_enabled:
+            # reading, dissecting and storing each get their own thread(s) with bounded queues in between
+            pipeline = LivePipeline(reader.pipe, output, fallback_capture, channel=args.channel, pcap_path=args.pcap_path, **config.pipeline)
+
+    key_registry = open_key_registry(output, args.keyfile)
+    duplicates = open_duplicate_filter(output, **config.duplicates) if config.duplicates_enabled else None
+
+    # gps is polled in the background, packets just take the latest fix
+    gps_poller = None
+    if args.gps is True:
+        gps_source = FakeGpsSource(args.gps_fake) if args.gps_fake else None
+        gps_poller = GpsPoller(output, gps_source, **config.gps).start()
 
     # in future start the webinterface at some point
 
-    # schedule the report function
-    scheduler = BackgroundScheduler(daemon=True)
-    scheduler.add_job(zigsniff_reporter, 'interval', seconds=config.report_period, args=[output, config.report_period])
-    scheduler.start()
+    # schedule the report function. the asyncio engine has its own timers
+    if args.engine == "threads":
+        scheduler = BackgroundScheduler(daemon=True)
+        scheduler.add_job(zigsniff_reporter, 'interval', seconds=config.report_period, args=[output, config.report_period, config.report_mode])
+        if reader is not None:
+            scheduler.add_job(reader.report, 'interval', seconds=config.report_period)
+        if pipeline is not None:
+            scheduler.add_job(pipeline.report, 'interval', seconds=config.report_period)
+        scheduler.add_job(key_registry.report, 'interval', seconds=config.report_period)
+        if duplicates is not None:
+            scheduler.add_job(duplicates.report, 'interval', seconds=config.report_period)
+        scheduler.start()
 
     # lets create the database
     create_db(output)  # Seeing that the folder now exists... lets create the sqlite file if needbe
-    # Start monitoring fifo file
-    with open(args.fifo_path, 'rb') as fifo:
-        capture = PipeCapture(pipe=fifo)
-        for packet in capture:
-            dissector = zigbee_packet_dissector(packet)
+    # devices live in memory, written behind. the asyncio engine flushes them on its database thread
+    open_device_store(output, config.flush_interval, config.flush_packets, args.engine == "threads")
+    open_sticky_note_cache(output, config.sticky_note_cache)
+    open_detection_sink(output, **config.detections)
+    index = open_packet_index(output, **config.index) if config.index_enabled else None
+    if config.backlog_enabled:
+        open_encrypted_backlog(output, args.keyfile, args.channel, **config.backlog)
+    if args.engine == "asyncio":
+        # every source on one event loop, storing happens on the engine's database thread
+        engine = AsyncEngine(output, lambda dissector, channel, pcap: process_live_dissector(dissector, channel, pcap, gps_poller), args.keyfile, **config.capture)
+        engine.every(config.report_period, zigsniff_reporter, output, config.report_period, config.report_mode, database=True)
+        engine.every(config.report_period, key_registry.report)
+        if config.backlog_enabled:
+            # a quiet channel still gets the frames the backlog decrypted, on the database thread like all storing
+            engine.every(1, process_decrypted, output, database=True)
+        if duplicates is not None:
+            engine.every(config.report_period, duplicates.report)
+        asyncio.run(engine.run(sources or [CaptureSource(args.channel, args.fifo_path, args.pcap_path)], config.report_period))
+    elif hopper is not None:
+        # the channel comes from the hop window the frame was captured in
+        if index is not None:
+            index.register(args.pcap_path, hopper.archive.locate)
+        with open(args.fifo_path, 'rb') as fifo:
+            for dissector in live_capture(fifo):
+                channel = args.channel
+                if dissector is not None and not isinstance(dissector, str):
+                    channel = hopper.channel_for_frame(dissector["pkt_number"])
+                    hopper.observe(channel, dissector)
+                process_live_dissector(dissector, channel, args.pcap_path, gps_poller)
+        hopper.stop()
+    elif sources:
+        # several dongles/channels. every source is read by its own thread, we store them all here
+        counters = ChannelCounters()
+        scheduler.add_job(counters.report, 'interval', seconds=config.report_period, args=[output])
+        if index is not None:
+            for source in sources:
+                index.register(source.pcap_path, source.locate)
+        for source, dissector in multi_source_capture(sources, live_capture, counters, output, config.source_queue_size):
+            process_live_dissector(dissector, source.channel, source.pcap_path, gps_poller)
             if dissector is not None and not isinstance(dissector, str):
-                time_difference = int(time.time()) - dissector["pkt_timestamp"]
-                if time_difference >= 60:
-                    report(f"Timestamp from packet too old. stopping live capture. please restart: {time_difference}", output)
-                    exit()
-                else:
-                    dissector['channel'] = int(args.channel)  # We have a packet and we add a channel to the output.
-
-                    # add gps if enabled
-                    if args.gps is True:
-                        gps = get_gps_loc()
-                        if gps is not None:
-                            dissector['gps'] = gps
-
-                    # First we need to make sure the device exists in the database. so we add it
-                    if "nwk_mac_src" in dissector or "nwk_sec_src" in dissector:
-                        if "nwk_mac_src" not in dissector:
-                            dissector["nwk_mac_src"] = dissector["nwk_sec_src"]
-                        nwk_add_dev_to_devices(dissector, output)
-                        try:
-                            # then we add all logical addresses to the database   ????
-                            match_nwk_addresses(dissector["nwk_mac_src"], dissector["nwk_addr_src"], dissector["pan_dst"], dissector["nwk_addr_dst"], output)
-                        except KeyError as e:
-                            report(f"Added record to database error: {e}", output)
-
-                    # if a device on logical level does not exist we can still add it from the wpan layer. but will have less details at start.
-                    if "wpan_mac_src" in dissector:
-                        wpan_add_dev_to_devices(dissector, output)
-
-                    # adding all wpan destination addresses to a device entry so we see on wpan layer to what devices a device is communicating with.
-                    if "wpan_addr_src" in dissector and "pan_dst" in dissector and "wpan_addr_dst" in dissector:
-                        try:
-                            match_wpan_addresses(dissector["wpan_addr_src"], dissector["pan_dst"], dissector["wpan_addr_dst"], output)
-                        except KeyError as e:
-                            report("Error in main wpan adding to database: " + str(e), output)
-
-                    # Here we feed it to a module that adds small details to the database to make more sense of a device's capabilities
-                    # May also help identify its purpose and functionality
-                    if "nwk_addr_src" in dissector:
-                        parse_the_rest(dissector, output)
-
-                    # If a specific packet is discovered we want to generate a message (might).
-                    # these packets are flagged with detection = 1. this indicates it has important information to create a .zmessage file.
-                    if dissector["detection"] == 1:
-                        dissector["pcap"] = str(args.pcap)  # add pcap name
-                        zigbee_detections(dissector, output)
-
-                    # process write files etc
-                    elif isinstance(dissector, str):
-                        # if it is an error please write it to file
-                        report(f"-Error in Zigbee dissector---------------------------------------------", output)
-                        report(f"{dissector}", output)
-                        report(f"-End of error in Zigbee dissector--------------------------------------", output)
+                counters.count(source.channel, "stored")
+        counters.report(output)
+    else:
+        # Start monitoring the capture
+        if index is not None:
+            index.register(args.pcap_path, reader.archive.locate)
+        if pipeline is not None:
+            # this thread is the store writer of the pipeline
+            with reader.pipe:
+                for dissector in pipeline.start():
+                    process_live_dissector(dissector, args.channel, args.pcap_path, gps_poller)
+            pipeline.report()
+        else:
+            with reader.pipe:
+                for dissector in live_capture(reader.pipe):
+                    process_live_dissector(dissector, args.channel, args.pcap_path, gps_poller)
+        reader.report()
 
     # if timejump occures restart whsniff or restart/kill application
 
 elif args.pcap is not None:
     report("Offline pcap processing starting:", output)
+    if config.metrics_enabled:
+        open_metrics(output, **config.metrics)
+    if args.profile:
+        Profiler(output, True, **config.profile).start()
 
     # check if pcap exists and if it is a pcap?
     if not os.path.isfile(args.pcap):
@@ -140,59 +238,40 @@ elif args.pcap is not None:
         exit()
     # here check and build the database. if it does not exist yet.
     create_db(output)  # Seeing that the folder now exists... lets create the sqlite file if needed
-    # open pcap with pyshark
-    capture = pyshark.FileCapture(args.pcap)
+    open_device_store(output, config.flush_interval, config.flush_packets)
+    open_sticky_note_cache(output, config.sticky_note_cache)
+    open_detection_sink(output, **config.detections)
+    if config.index_enabled:
+        open_packet_index(output, **config.index).register(args.pcap, PcapLocator(args.pcap).locate)
+    backlog = open_encrypted_backlog(output, args.keyfile, args.channel, **config.backlog) if config.backlog_enabled else None
+    key_registry = open_key_registry(output, args.keyfile)
+    duplicates = open_duplicate_filter(output, **config.duplicates) if config.duplicates_enabled else None
+    # open pcap with the native dissector (fallback for what it can not handle), tshark fields or pyshark for everything
+    if args.workers > 1:
+        if args.backend == "native":
+            capture = sharded_file_capture(args.pcap, output, args.workers, True, args.fallback, args.keyfile)
+        else:
+            capture = sharded_file_capture(args.pcap, output, args.workers, False, args.backend, args.keyfile)
+    elif args.backend == "native":
+        capture = native_file_capture(args.pcap, output, fallback=args.fallback, keyfile=args.keyfile)
+    elif args.backend == "fields":
+        capture = FieldsCapture(pcap_path=args.pcap, keyfile=args.keyfile, path=output)
+    else:
+        capture = (zigbee_packet_dissector(packet) for packet in pyshark.FileCapture(args.pcap, custom_parameters=tshark_key_options(args.keyfile, path=output)))
     try:
-        for packet in capture:
-            # put packet into the zigbee dissector.
-            dissector = zigbee_packet_dissector(packet)
-
-            if dissector is not None and not isinstance(dissector, str):
-                # Time jump problems do not exist in pcaps. no check needed
-                # We add the channel. If you gave the correct channel we will use that
-                dissector['channel'] = int(args.channel)  # We have a packet and we add a channel to the output.
-                # maybe add gps here? update?
-                #print(f"Packet: {dissector}")
-
-                # First we need to make sure the device exists in the database. so we add it
-                if "nwk_mac_src" in dissector or "nwk_sec_src" in dissector:
-                    if "nwk_mac_src" not in dissector:
-                        dissector["nwk_mac_src"] = dissector["nwk_sec_src"]
-                    nwk_add_dev_to_devices(dissector, output)
-                    try:
-                        # then we add all logical addresses to the database   ????
-                        match_nwk_addresses(dissector["nwk_mac_src"], dissector["nwk_addr_src"], dissector["pan_dst"], dissector["nwk_addr_dst"], output)
-                    except KeyError as e:
-                        report(f"Added record to database error: {e}", output)
-
-                # if a device on logical level does not exist we can still add it from the wpan layer. but will have less details at start.
-                if "wpan_mac_src" in dissector:
-                    wpan_add_dev_to_devices(dissector, output)
-
-                # adding all wpan destination addresses to a device entry so we see on wpan layer to what devices a device is communicating with.
-                if "wpan_addr_src" in dissector and "pan_dst" in dissector and "wpan_addr_dst" in dissector:
-                    try:
-                        match_wpan_addresses(dissector["wpan_addr_src"], dissector["pan_dst"], dissector["wpan_addr_dst"], output)
-                    except KeyError as e:
-                        report("Error in main wpan adding to database: " + str(e), output)
-
-                # Here we feed it to a module that adds small details to the database to make more sense of a device's capabilities
-                # May also help identify its purpose and functionality
-                if "nwk_addr_src" in dissector:
-                    parse_the_rest(dissector, output)
-
-                # If a specific packet is discovered we want to generate a message (might).
-                # these packets are flagged with detection = 1. this indicates it has important information to create a .zmessage file.
-                if dissector["detection"] == 1:
-                    dissector["pcap"] = str(args.pcap) # add pcap name
-                    zigbee_detections(dissector, output)
-
-                # process write files etc
-            elif isinstance(dissector, str):
-                # if it is an error please write it to file
-                report(f"-Error in Zigbee dissector----------------------------------------------------------------", output)
-                report(f"{dissector}", output)
-                report(f"-End of error in Zigbee dissector---------------------------------------------------------", output)
+        for dissector in get_metrics(output).timed(capture, "capture"):
+            # Time jump problems do not exist in pcaps. no check needed
+            # We add the channel. If you gave the correct channel we will use that
+            process_dissector(dissector, args.channel, args.pcap, output)
+            process_decrypted(output)
+        if backlog is not None:
+            # retries still running at the end of the pcap, their frames may find keys again
+            backlog.wait()
+            while process_decrypted(output):
+                backlog.wait()
+        key_registry.report()
+        if duplicates is not None:
+            duplicates.report()
 
         # die
     except Exception as e:
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+'''
+    Pulls the frames of one device and/or time range out of the archived captures using the packet index
+    (zigsniff_index.db) that zigsniff writes while ingesting. Writes a pcap or one json line per frame.
+'''
+import os
+import sys
+import json
+import sqlite3
+import argparse
+import datetime
+from itertools import groupby
+
+from misc.zigsniff_pcap import read_pcap_at, write_pcap_header, write_pcap_record
+
+argParser = argparse.ArgumentParser(prog="Zigsniff extract", description="Extract the frames of a device or time range from the captures zigsniff archived.", epilog="Powered by: Project Entropia")
+argParser.add_argument("-o", "--output", type=str, default="messages", help="Zigsniff work directory with zigsniff_index.db (Default is messages)")
+argParser.add_argument("-m", "--mac", type=str, help="64 bit address of the device")
+argParser.add_argument("-a", "--address", type=str, help="Short (nwk or wpan) source address like 0x1234")
+argParser.add_argument("-P", "--pan", type=str, help="PAN id like 0x1a62")
+argParser.add_argument("--cluster", type=str, help="Cluster like 0x0006")
+argParser.add_argument("-s", "--start", type=str, help="From this time, epoch or 'YYYY-mm-dd HH:MM:SS' (local time)")
+argParser.add_argument("-e", "--end", type=str, help="Until this time, epoch or 'YYYY-mm-dd HH:MM:SS' (local time)")
+argParser.add_argument("-f", "--format", type=str, default="pcap", choices=["pcap", "ndjson"], help="Output format (Default is pcap)")
+argParser.add_argument("-w", "--write", type=str, required=True, help="File to write the frames to")
+
+
+def parse_time(value: str):
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp())
+
+
+def index_query(args):
+    '''
+    Builds the query on the frames table. Every filter is covered by one of the indexes.
+    '''
+    where = []
+    parameters = []
+    if args.mac is not None:
+        where.append("mac=?")
+        parameters.append(args.mac)
+    if args.address is not None:
+        where.append("(nwk_src=? OR wpan_src=?)")
+        parameters += [args.address, args.address]
+    if args.pan is not None:
+        where.append("pan=?")
+        parameters.append(args.pan)
+    if args.cluster is not None:
+        where.append("cluster=?")
+        parameters.append(args.cluster)
+    if args.start is not None:
+        where.append("timestamp>=?")
+        parameters.append(parse_time(args.start))
+    if args.end is not None:
+        where.append("timestamp<=?")
+        parameters.append(parse_time(args.end))
+    query = "SELECT files.name, frames.offset, frames.number, frames.timestamp, frames.pan, frames.mac, frames.nwk_src, frames.wpan_src, frames.cluster FROM frames JOIN files ON files.id=frames.file_id"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    # per file in file order, so every file is opened once and read front to back
+    return query + " ORDER BY files.id, frames.offset;", parameters
+
+
+def capture_path(name: str, output: str):
+    '''
+    Archive segments are stored by name relative to the work directory and may have been gzipped since.
+    '''
+    path = name if os.path.isabs(name) else os.path.join(output, name)
+    if os.path.isfile(path):
+        return path
+    if os.path.isfile(path + ".gz"):
+        return path + ".gz"
+    return None
+
+
+def extract(args):
+    index_path = os.path.join(args.output, "zigsniff_index.db")
+    if not os.path.isfile(index_path):
+        print(f"No packet index in {args.output}")
+        exit()
+    connection = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+    query, parameters = index_query(args)
+    rows = connection.execute(query, parameters).fetchall()
+    connection.close()
+
+    frames = 0
+    missing = 0
+    with open(args.write, 'wb' if args.format == "pcap" else 'w') as target:
+        header_written = False
+        for name, file_rows in groupby(rows, key=lambda row: row[0]):
+            file_rows = list(file_rows)
+            path = capture_path(name, args.output)
+            if path is None:
+                # pushed out of the archive ring
+                missing += len(file_rows)
+                continue
+            for row, record in zip(file_rows, read_pcap_at(path, [row[1] for row in file_rows])):
+                if args.format == "pcap":
+                    if not header_written:
+                        write_pcap_header(target, record.linktype)
+                        header_written = True
+                    write_pcap_record(target, record.timestamp, record.data, record.length)
+                else:
+                    target.write(json.dumps({"file": name, "offset": row[1], "number": row[2], "timestamp": record.timestamp, "pan": row[4], "mac": row[5],
+                                             "nwk_src": row[6], "wpan_src": row[7], "cluster": row[8], "length": record.length, "data": record.data.hex()}) + "\n")
+                frames += 1
+    print(f"{frames} frames written to {args.write}" + (f", {missing} frames are in captures that do not exist anymore" if missing else ""))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        argParser.print_help()
+        sys.exit()
+    extract(argParser.parse_args())